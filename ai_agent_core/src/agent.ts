@@ -47,7 +47,6 @@ import pool, {
     removeActiveUserFromFile,  // <-- Import this
     getDocSearchStatus,
     setDocSearchStatus,
-    setFileProcessStatus,
 } from './db.js';
 import { callToolFunction, GetSocketIO } from "./api.js"
 
@@ -504,10 +503,6 @@ router.post('/processDocument', upload.array('files'), async (req: Request, res:
           maxContentLength: Infinity,
           maxBodyLength: Infinity
       });
-      // Check if the Python server returned a "success" status and update file process status
-      if (flaskRes.data && flaskRes.data.status === "success") {
-        await setFileProcessStatus(flaskRes.data.FileID, "finish");
-      }
       // 5. Return Python response to Client
       res.json(flaskRes.data);
 
@@ -2795,26 +2790,16 @@ router.post('/verify-answer', uploadFiles.array('files', 10), async (req: Reques
     try {
       const apiUrl = process.env.API_SERVER_URL;
       if (apiUrl) {
-        // Get question embedding (is_query: false = document/passage mode)
-        const questionEmbedRes = await fetch(`${apiUrl}/encode_embedding`, {
+        // Question and answer embeddings in one batch call (is_query: false = document/passage mode)
+        const embedRes = await fetch(`${apiUrl}/encode_embedding`, {
           method: 'POST',
           headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({ text: question, dimensions: 2048, is_query: false })
+          body: JSON.stringify({ texts: [question, answer], dimensions: 2048, is_query: false })
         });
-        if (questionEmbedRes.ok) {
-          const embedData: any = await questionEmbedRes.json();
-          questionEmbedding = embedData.embedding || [];
-        }
-
-        // Get answer embedding (is_query: false = document/passage mode)
-        const answerEmbedRes = await fetch(`${apiUrl}/encode_embedding`, {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({ text: answer, dimensions: 2048, is_query: false })
-        });
-        if (answerEmbedRes.ok) {
-          const embedData: any = await answerEmbedRes.json();
-          answerEmbedding = embedData.embedding || [];
+        if (embedRes.ok) {
+          const embedData: any = await embedRes.json();
+          questionEmbedding = embedData.embeddings?.[0] || [];
+          answerEmbedding = embedData.embeddings?.[1] || [];
         }
       }
     } catch (e) {
@@ -3858,28 +3843,17 @@ router.post('/submit-verified-answer', async (req: Request, res: Response) => {
       console.log('🔄 Generating embeddings...');
       const fullQuestionText = `${question}\n\n${answer}`;
       
-      // Generate question embedding (is_query: false = document mode)
-      const qEmbedRes = await fetch(`${process.env.API_SERVER_URL}/encode_embedding`, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ text: fullQuestionText, dimensions: 2048, is_query: false })
-      });
-      if (qEmbedRes.ok) {
-        const qEmbedData = await qEmbedRes.json() as { embedding: number[] };
-        questionEmbedding = qEmbedData.embedding || [];
-        console.log('✅ Question embedding generated, length:', questionEmbedding.length);
-      }
-      
-      // Generate answer embedding (is_query: false = document mode)
-      const aEmbedRes = await fetch(`${process.env.API_SERVER_URL}/encode_embedding`, {
+      // Generate question and answer embeddings in one batch call (is_query: false = document mode)
+      const embedRes = await fetch(`${process.env.API_SERVER_URL}/encode_embedding`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ text: answer, dimensions: 2048, is_query: false })
+        body: JSON.stringify({ texts: [fullQuestionText, answer], dimensions: 2048, is_query: false })
       });
-      if (aEmbedRes.ok) {
-        const aEmbedData = await aEmbedRes.json() as { embedding: number[] };
-        answerEmbedding = aEmbedData.embedding || [];
-        console.log('✅ Answer embedding generated, length:', answerEmbedding.length);
+      if (embedRes.ok) {
+        const embedData = await embedRes.json() as { embeddings: number[][] };
+        questionEmbedding = embedData.embeddings?.[0] || [];
+        answerEmbedding = embedData.embeddings?.[1] || [];
+        console.log('✅ Question/answer embeddings generated, lengths:', questionEmbedding.length, answerEmbedding.length);
       }
     } catch (embedError) {
       console.warn('⚠️ Failed to generate embeddings:', embedError);
@@ -142,6 +142,131 @@ CREATE TABLE IF NOT EXISTS document_page_embeddings (
 `;
 
 
+// Half-precision copy of the embeddings for the HNSW indexes (VECTOR(2048) is over
+// pgvector's 2000-dimension index limit). Generated, so every writer keeps it in sync.
+// document_page_embeddings also gets a 1-bit-per-dimension copy for the two-stage
+// global page search. The indexes themselves are built by the api_server
+// (utils/vector_index.py).
+const alterEmbeddingsAddHalfvecQuery = `
+DO $$
+DECLARE
+    tbl TEXT;
+BEGIN
+    -- halfvec needs pgvector >= 0.7; older servers keep exact search only
+    IF EXISTS (SELECT 1 FROM pg_type WHERE typname = 'halfvec') THEN
+        FOREACH tbl IN ARRAY ARRAY['document_embeddings', 'document_page_embeddings'] LOOP
+            IF NOT EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = tbl AND column_name = 'embedding_half'
+            ) THEN
+                EXECUTE format(
+                    'ALTER TABLE %I ADD COLUMN embedding_half HALFVEC(2048) '
+                    'GENERATED ALWAYS AS (embedding::halfvec(2048)) STORED',
+                    tbl
+                );
+            END IF;
+        END LOOP;
+
+        -- Bit-quantized page vectors: first stage of the global page search
+        -- (partial Hamming HNSW index WHERE chat_history_id = -1, built by the api_server)
+        IF NOT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'document_page_embeddings' AND column_name = 'embedding_bit'
+        ) THEN
+            ALTER TABLE document_page_embeddings ADD COLUMN embedding_bit BIT(2048)
+                GENERATED ALWAYS AS (binary_quantize(embedding)::bit(2048)) STORED;
+        END IF;
+    END IF;
+END
+$$;
+`;
+
+
+// Content hash used by the api_server to deduplicate identical uploads
+const alterUploadedFilesAddContentHashQuery = `
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'uploaded_files' AND column_name = 'content_sha256'
+    ) THEN
+        ALTER TABLE uploaded_files ADD COLUMN content_sha256 TEXT;
+    END IF;
+END
+$$;
+
+CREATE INDEX IF NOT EXISTS idx_uploaded_files_content_sha256
+ON uploaded_files(content_sha256);
+`;
+
+// --- INGESTION JOB QUEUE (drained by api_server ingest workers) ---
+const createIngestJobsTableQuery = `
+CREATE TABLE IF NOT EXISTS ingest_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    kind TEXT NOT NULL, -- 'process' | 'processDocument' | 'processText'
+    uploaded_file_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    chat_history_id INTEGER NOT NULL,
+    file_name TEXT NOT NULL,
+    object_name TEXT NOT NULL,
+    options JSONB DEFAULT '{}'::jsonb,
+    status TEXT NOT NULL DEFAULT 'queued', -- 'queued' | 'running' | 'done' | 'error'
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    worker_id TEXT,
+    last_error TEXT,
+    result JSONB,
+    available_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMPTZ,
+    heartbeat_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ,
+
+    CONSTRAINT fk_job_file
+        FOREIGN KEY (uploaded_file_id)
+        REFERENCES uploaded_files(id)
+        ON DELETE CASCADE
+);
+
+-- Workers claim with: WHERE status = 'queued' ... ORDER BY id FOR UPDATE SKIP LOCKED
+CREATE INDEX IF NOT EXISTS idx_ingest_jobs_claim
+ON ingest_jobs(status, available_at, id);
+
+CREATE INDEX IF NOT EXISTS idx_ingest_jobs_file
+ON ingest_jobs(uploaded_file_id);
+
+-- Live progress of a running job: {"pages", "resumed", "embedded", "stored"}
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'ingest_jobs' AND column_name = 'progress'
+    ) THEN
+        ALTER TABLE ingest_jobs ADD COLUMN progress JSONB;
+    END IF;
+END
+$$;
+`;
+
+// Pages embedded by an unfinished ingest job; a retried job skips them and
+// publishes all pages to document_page_embeddings in one transaction
+const createIngestPageCheckpointsTableQuery = `
+CREATE TABLE IF NOT EXISTS ingest_page_checkpoints (
+    uploaded_file_id INTEGER NOT NULL,
+    page_number INTEGER NOT NULL,
+    embedding VECTOR(2048),
+    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+
+    PRIMARY KEY (uploaded_file_id, page_number),
+
+    CONSTRAINT fk_checkpoint_file
+        FOREIGN KEY (uploaded_file_id)
+        REFERENCES uploaded_files(id)
+        ON DELETE CASCADE
+);
+`;
+
+
 const alterUsersTableQuery = `
 DO $$
 BEGIN
@@ -498,6 +623,9 @@ async function initializeDatabase() {
     await pool.query(createUploadedFilesTableQuery); // Using updated query
     console.log('DB: Uploaded files table created or already exists');
 
+    await pool.query(alterUploadedFilesAddContentHashQuery);
+    console.log('DB: content_sha256 column added to uploaded_files');
+
     await pool.query(createDocumentEmbeddingsTableQuery);
     console.log('DB: Document embeddings table created or already exists (w/ page_number)');
     
@@ -505,6 +633,15 @@ async function initializeDatabase() {
     await pool.query(createDocumentPageEmbeddingsTableQuery);
     console.log('DB: Document page embeddings table created or already exists');
 
+    await pool.query(alterEmbeddingsAddHalfvecQuery);
+    console.log('DB: embedding_half / embedding_bit columns added to embedding tables');
+
+    await pool.query(createIngestJobsTableQuery);
+    console.log('DB: Ingest jobs table created or already exists');
+
+    await pool.query(createIngestPageCheckpointsTableQuery);
+    console.log('DB: Ingest page checkpoints table created or already exists');
+
     // === VERIFIED ANSWERS INITIALIZATION ===
     await pool.query(createVerifiedAnswersTableQuery);
     console.log('DB: Verified answers table created or already exists');
@@ -0,0 +1,71 @@
+"""
+Standalone ingestion worker.
+
+Drains the 'ingest_jobs' queue filled by /process and /processDocument. Run it on
+any node that can reach Postgres and MinIO; all workers share the queue:
+
+    python ingest_worker.py --processes 4
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import threading
+
+import dotenv
+
+dotenv.load_dotenv()
+
+
+def worker_main(index: int, render_processes: int = None):
+    # Imported inside the child so every process loads its own model / DB state
+    from utils.ingest import run_ingest_job
+    from utils.job_queue import make_worker_id, run_ingest_worker
+    from utils.render_pool import start_render_pool
+    from utils.gpu_batching import GPU_BATCH_PROBE_AT_STARTUP
+    from utils.util import DOCLING_WARM_AT_STARTUP, warm_document_converters, warm_embedding_batch_sizes
+
+    start_render_pool(render_processes)
+    if DOCLING_WARM_AT_STARTUP:
+        warm_document_converters()
+    if GPU_BATCH_PROBE_AT_STARTUP:
+        warm_embedding_batch_sizes()
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+    run_ingest_worker(run_ingest_job, worker_id=make_worker_id(f"p{index}"), stop_event=stop_event)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingestion queue worker")
+    parser.add_argument("--processes", type=int, default=int(os.getenv("INGEST_WORKER_PROCESSES", "1")),
+                        help="Number of worker processes on this node")
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        worker_main(0)
+        return
+
+    # Split the cores between the per-process render pools
+    render_processes = max(1, (os.cpu_count() or 4) // args.processes)
+
+    # Not daemonic: the rasterization step starts its own child processes
+    ctx = multiprocessing.get_context("spawn")
+    processes = [ctx.Process(target=worker_main, args=(i, render_processes), name=f"ingest-worker-{i}") for i in range(args.processes)]
+    for p in processes:
+        p.start()
+
+    def _stop(*_):
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    for p in processes:
+        p.join()
+
+
+if __name__ == '__main__':
+    main()
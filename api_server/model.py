@@ -41,6 +41,9 @@ from langchain_text_splitters import RecursiveCharacterTextSplitter
 from utils.util import (
     # EditedFileSystem,
     encode_text_for_embedding,
+    encode_text_for_embedding_batched,
+    encode_texts_for_embedding_batched,
+    get_text_embedding_scheduler_stats,
     extract_docx_text,
     extract_excel_text,
     extract_image_text,
@@ -70,12 +73,23 @@ from utils.util import (
     search_similar_pages_by_active_user,
     search_similar_documents_by_active_user_all,
     search_similar_pages_by_active_user_all,
+    normalize_page_matches,
+    ThresholdEscalation,
     DeepInfraInference,
 )
 
-from utils.util import LOCAL
-
-conn = get_db_connection()
+from utils.util import LOCAL, DOCLING_WARM_AT_STARTUP, warm_document_converters, warm_embedding_batch_sizes
+from utils.job_queue import enqueue_ingest_job, get_ingest_jobs, start_ingest_worker_threads
+from utils.ingest import run_ingest_job
+from utils.render_pool import get_render_pool_stats, start_render_pool
+from utils.pdf_render import get_pdf_cache_stats
+from utils.db_pool import get_db_pool_stats
+from utils.office_convert import get_office_convert_stats
+from utils.gpu_batching import GPU_BATCH_PROBE_AT_STARTUP, get_gpu_batch_stats
+from utils.embedding_cache import get_embedding_cache_stats
+from utils.vector_index import VECTOR_INDEX_BUILD_AT_STARTUP, get_vector_index_stats, start_vector_index_build
+from utils.chat_vector_cache import get_chat_vector_cache_stats, invalidate_chat_vectors
+from utils.vectors import encode_vector_base64, encode_vector_bytes
 
 TEXT_FILE_EXTENSIONS = ['.txt', '.pdf', '.docx', '.pptx', '.odt', '.rtf']
 
@@ -177,7 +191,9 @@ def get_page(driver, url):
 @app.route('/test_db', methods=['GET'])
 def test_db():
     """Test database connection and check document_embeddings table"""
+    conn = None
     try:
+        conn = get_db_connection()
         cur = conn.cursor()
         
         # Count total records
@@ -212,6 +228,8 @@ def test_db():
             'error': str(e),
             'traceback': traceback.format_exc()
         }), 500
+    finally:
+        if conn: conn.close()
 
 
 @app.route('/test_embedding_save', methods=['POST'])
@@ -236,13 +254,17 @@ def test_embedding_save():
         save_vector_to_db(**test_data)
         
         # Verify save
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT COUNT(*) FROM document_embeddings WHERE user_id = %s AND file_name = %s",
-            (test_data['user_id'], test_data['file_name'])
-        )
-        count = cur.fetchone()[0]
-        cur.close()
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT COUNT(*) FROM document_embeddings WHERE user_id = %s AND file_name = %s",
+                (test_data['user_id'], test_data['file_name'])
+            )
+            count = cur.fetchone()[0]
+            cur.close()
+        finally:
+            conn.close()
         
         return jsonify({
             'status': 'success',
@@ -589,19 +611,80 @@ def Search_By_DuckDuckGo():
 #  UPDATED & NEW RAG ENDPOINTS
 # ==============================================================================
 
-def convert_page_worker(args):
-                    file_bytes, page_num_0_idx, dpi = args
-                    img_bytes = convert_pdf_page_to_image(file_bytes, page_num_0_idx, dpi)
-                    page_num_1_idx = page_num_0_idx + 1
-                    return (page_num_1_idx, img_bytes)
+# Uploads of one request run concurrently (hashing, MinIO put, DB insert, enqueue):
+# at most FILE_UPLOAD_PER_REQUEST files per request, FILE_UPLOAD_MAX_WORKERS overall.
+FILE_UPLOAD_MAX_WORKERS = int(os.getenv("FILE_UPLOAD_MAX_WORKERS", "8"))
+FILE_UPLOAD_PER_REQUEST = int(os.getenv("FILE_UPLOAD_PER_REQUEST", "4"))
+upload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=FILE_UPLOAD_MAX_WORKERS, thread_name_prefix="upload")
+
+
+def map_files_concurrently(fn, items, limit=FILE_UPLOAD_PER_REQUEST):
+    """
+    Runs fn(item) for every item on the shared upload pool, with at most `limit`
+    of them in flight for this request. Returns [(result, error)] in input order.
+    """
+    results = [None] * len(items)
+    pending = {}
+    next_index = 0
+    while next_index < len(items) or pending:
+        while next_index < len(items) and len(pending) < max(1, limit):
+            pending[upload_executor.submit(fn, items[next_index])] = next_index
+            next_index += 1
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            index = pending.pop(future)
+            try:
+                results[index] = (future.result(), None)
+            except Exception as e:
+                print(f"❌ Failed to queue {items[index]['file_name']}: {e}")
+                results[index] = (None, str(e))
+    return results
+
+
+def file_status_entry(item, job, error):
+    """Per-file result reported by /process and /processDocument."""
+    if job:
+        return {"name": item['file_name'], "status": "queued", "job_id": job['job_id'], "file_id": job['file_id']}
+    return {"name": item['file_name'], "status": "failed", "error": error or "upload or enqueue failed"}
+
+
+def enqueue_uploaded_file(kind, user_id, chat_history_id, file_name, file_bytes, options, upload_user_id=None):
+    """
+    Uploads a file to MinIO/DB and queues it for the ingest workers.
+    Returns {'job_id', 'file_id', 'file_name'} or None on failure.
+    """
+    uploaded_file_id, object_name = upload_file_to_minio_and_db(
+        user_id=user_id if upload_user_id is None else upload_user_id,
+        chat_history_id=chat_history_id,
+        file_name=file_name,
+        file_bytes=file_bytes
+    )
+    if not uploaded_file_id:
+        print(f"Failed to upload {file_name} to MinIO/DB. Skipping.")
+        return None
+
+    job_id = enqueue_ingest_job(
+        kind=kind,
+        uploaded_file_id=uploaded_file_id,
+        user_id=user_id,
+        chat_history_id=chat_history_id,
+        file_name=file_name,
+        object_name=object_name,
+        options=options
+    )
+    if not job_id:
+        return None
+    return {"job_id": job_id, "file_id": uploaded_file_id, "file_name": file_name}
+
 
 @app.route('/process', methods=['POST'])
 def process():
     """
-    Processes uploaded files using one of two methods:
+    Uploads files and queues them for ingestion. The ingest workers pick one of two methods:
     1. 'legacy_text': Extracts all text, embeds it, saves to 'document_embeddings'.
     2. 'new_page_image': Splits PDF into pages, embeds each page as an image,
                        saves to 'document_page_embeddings'.
+    Progress is visible in uploaded_files.file_process_status and via /jobs.
     
     FORM DATA required:
     - files: One or more files.
@@ -609,8 +692,6 @@ def process():
     - chat_history_id: ID of the current chat.
     - processing_mode: 'legacy_text' (default) or 'new_page_image'.
     """
-    clear_gpu()
-    
     try:
         files = request.files.getlist('files')
         user_id = int(request.form.get('user_id'))
@@ -622,11 +703,10 @@ def process():
     if not files:
         return jsonify({"error": "No files provided"}), 400
 
-    print(f"Processing {len(files)} files with mode: '{processing_mode}'")
-    
-    processed_files = []
-    n_pages = 0
+    print(f"Queueing {len(files)} files with mode: '{processing_mode}'")
     
+    # Read the request body on this thread; uploads then run concurrently
+    items, file_results = [], []
     for file in files:
         filename = file.filename
         file.seek(0) # Rewind file pointer
@@ -634,191 +714,44 @@ def process():
         
         if not file_bytes:
             print(f"Skipped file (empty): {filename}")
+            file_results.append({"name": filename, "status": "skipped", "error": "empty file"})
             continue
+        items.append({"file_name": filename, "file_bytes": file_bytes, "index": len(file_results)})
+        file_results.append(None)
 
-        # --- 1. Upload file to MinIO and get its DB ID ---
-        uploaded_file_id, object_name = upload_file_to_minio_and_db(
+    results = map_files_concurrently(
+        lambda item: enqueue_uploaded_file(
+            kind='process',
             user_id=user_id,
             chat_history_id=chat_history_id,
-            file_name=filename,
-            file_bytes=file_bytes
-        )
-        
-        if not uploaded_file_id:
-            print(f"Failed to upload {filename} to MinIO/DB. Skipping.")
-            continue
-        
-        # --- 2. Branch processing based on mode ---
-
-        n_pages = 1  # Default for non-PDF files
-        if filename.endswith('.pdf'):
-            pdf_file = fitz.open(stream=file_bytes, filetype='pdf')
-            n_pages = pdf_file.page_count
-        
-        # if (processing_mode == 'legacy_text') or (n_pages <= 25):
-        if (n_pages <= 5):
-            # --- LEGACY TEXT PROCESSING ---
-            print(f"Processing '{filename}' in legacy_text mode...")
-            file_text = ""
-            file_stream = io.BytesIO(file_bytes) # Use BytesIO for extractor functions
-            file_stream.filename = filename # Add filename attribute
-            
-            if filename.lower().endswith('.pdf'):
-                file_text = extract_pdf_text(file_stream)
-            elif filename.lower().endswith(('.png', '.jpg', '.jpeg', '.tiff', '.bmp', '.gif')):
-                file_text = extract_image_text(file_stream)
-            elif filename.lower().endswith(('.docx','.doc','.odt','.rtf')):
-                file_text = extract_docx_text(file_stream)
-            elif filename.lower().endswith(('.pptx','.ppt')):
-                file_text = extract_pptx_text(file_stream)
-            elif filename.lower().endswith(('.xlsx','.xlsm')):
-                file_text = extract_excel_text(file_stream)
-            elif filename.lower().endswith('.xls'):
-                file_text = extract_xls_text(file_stream)
-            else:
-                file_text = extract_txt_file(file_stream)
-
-            if not file_text.strip():
-                print(f"❌ Skipped file (empty or unsupported text): {filename}")
-                continue
-            
-            print(f"✅ Text extracted: {len(file_text)} characters")
-            
-            try:
-                data_vector = encode_text_for_embedding(file_text)
-                print(f"✅ Vector created: {len(data_vector)} dimensions")
-                
-                save_vector_to_db(
-                    user_id=user_id,
-                    chat_history_id=chat_history_id,
-                    uploaded_file_id=uploaded_file_id,
-                    file_name=filename,
-                    text=file_text,
-                    embedding=data_vector,
-                    page_number=-1
-                )
-                
-                # ✅ Verify save to DB
-                cur = conn.cursor()
-                cur.execute(
-                    "SELECT COUNT(*) FROM document_embeddings WHERE user_id = %s AND chat_history_id = %s AND uploaded_file_id = %s",
-                    (user_id, chat_history_id, uploaded_file_id)
-                )
-                count = cur.fetchone()[0]
-                cur.close()
-                print(f"✅ Verification: {count} record(s) saved in DB for '{filename}'")
-                
-                processed_files.append(filename)
-                
-            except Exception as e:
-                print(f"❌ Error saving to DB: {e}")
-                import traceback
-                traceback.print_exc()
-                continue
-
-        # elif (processing_mode == 'new_page_image') or (n_pages > 25):
-        elif (n_pages > 5):
-            # --- NEW IMAGE-PER-PAGE PROCESSING (BATCHED) ---
-            if not filename.lower().endswith('.pdf'):
-                print(f"Skipped file: 'new_page_image' mode only supports PDF. File: {filename}")
-                continue
-            
-            print(f"Processing '{filename}' in new_page_image mode...")
-            try:
-                pdf_doc = fitz.open(stream=file_bytes, filetype="pdf")
-                num_pages = pdf_doc.page_count
-                print(f"Found {num_pages} pages in '{filename}'.")
-                
-                pages_to_embed = [] # NEW: List to hold page data
-                
-                # # --- STAGE 1: Extract all page images ---
-                # for page_num_0_idx in range(num_pages):
-                #     page_num_1_idx = page_num_0_idx + 1
-                #     print(f"  - Converting page {page_num_1_idx}/{num_pages} to image...")
-                    
-                #     # a. Convert page to image
-                #     img_bytes = convert_pdf_page_to_image(file_bytes, page_num_0_idx)
-                #     if not img_bytes:
-                #         print(f"    - FAILED to render image for page {page_num_1_idx}. Skipping this page.")
-                #         continue
-                        
-                #     # Add to our list to process in a batch
-                #     pages_to_embed.append({
-                #         "page_num_1_idx": page_num_1_idx,
-                #         "img_bytes": img_bytes
-                #     })
-
-                start_process = time.time()
-                with multiprocessing.Pool(processes=10) as pool:  # Adjust processes as needed
-                    tasks = [(file_bytes, page_num_0_idx, 100) for page_num_0_idx in range(num_pages)]
-                    results = pool.map(convert_page_worker, tasks)
-
-                for page_num_1_idx, img_bytes in results:
-                    if not img_bytes:
-                        print(f" - FAILED to render image for page {page_num_1_idx}. Skipping this page.")
-                        continue
-                    # Add to our list to process in a batch
-                    pages_to_embed.append({
-                        "page_num_1_idx": page_num_1_idx,
-                        "img_bytes": img_bytes
-                    })
-                
-                pdf_doc.close()
-
-                if not pages_to_embed:
-                    print(f"No pages were successfully converted for '{filename}'. Skipping.")
-                    continue
-
-                # --- STAGE 2: Get all embeddings in one batch call ---
-                print(f"  - Sending {len(pages_to_embed)} images to embedding model in one batch...")
-                image_bytes_batch = [page['img_bytes'] for page in pages_to_embed]
-                
-                # NEW: Call wi(processing_mode == 'new_page_image') or th image_bytes_list
-                if not LOCAL:
-                    embeddings_list = get_image_embedding_jinna_api(image_bytes_list=image_bytes_batch) 
-                else :
-                    embeddings_list = get_image_embedding_jinna_api_local(image_bytes_list=image_bytes_batch)
-                
-                if not embeddings_list or len(embeddings_list) != len(pages_to_embed):
-                    print(f"    - FAILED to get embeddings or count mismatch. Expected {len(pages_to_embed)}, Got {len(embeddings_list) if embeddings_list else 0}.")
-                    continue
-                    
-                print(f"  - Received {len(embeddings_list)} embeddings. Saving to DB...")
-
-                # --- STAGE 3: Save embeddings to DB ---
-                for page_data, img_embedding in zip(pages_to_embed, embeddings_list):
-                    # c. Save page embedding to new table
-                    save_page_vector_to_db(
-                        user_id=user_id,
-                        chat_history_id=chat_history_id,
-                        uploaded_file_id=uploaded_file_id,
-                        page_number=page_data['page_num_1_idx'],
-                        embedding=img_embedding
-                    )
-                
-                processed_files.append(filename)
-                
-            except Exception as e:
-                print(f"Error processing PDF '{filename}' for image embedding: {e}")
-
-        else:
-            print(f"Skipped file: Unknown processing_mode '{processing_mode}'")
-    print(f"Process time: {time.time() - start_process} sec")
+            file_name=item['file_name'],
+            file_bytes=item['file_bytes'],
+            options={'processing_mode': processing_mode}
+        ),
+        items
+    )
+    jobs = []
+    for item, (job, error) in zip(items, results):
+        file_results[item['index']] = file_status_entry(item, job, error)
+        if job:
+            jobs.append(job)
+    if jobs:
+        # The chat's cached search matrices no longer cover all of its files
+        invalidate_chat_vectors(user_id, chat_history_id)
 
-    clear_gpu()
     return jsonify({
-        'reply': f"Processed {len(processed_files)}/{len(files)} files.",
-        'processed_files': processed_files
-    })
+        'reply': f"Queued {len(jobs)}/{len(files)} files for processing.",
+        'processed_files': [job['file_name'] for job in jobs],
+        'jobs': jobs,
+        'files': file_results
+    }), 202
 
 
 @app.route('/processDocument', methods=['POST'])
 def process_document_api():
     """
-    Endpoint to process documents for the Knowledge Base (forcing chat_history_id = -1).
+    Endpoint to queue documents for the Knowledge Base (forcing chat_history_id = -1).
     """
-    clear_gpu()
-    
     try:
         # 1. Get Form Data
         files = request.files.getlist('files')
@@ -840,197 +773,101 @@ def process_document_api():
     if not files and not text_input:
         return jsonify({"error": "No files or text provided"}), 400
 
-    processed_files = []
+    jobs = []
+    details = []
     
     # --- SCENARIO A: Text Input Only ---
     if text_input and not files:
-        print(f"Processing raw text input via {method} method...")
-        
-        # Create a dummy file record for pure text
-        uploaded_file_id, object_name = upload_file_to_minio_and_db(
-            user_id=0,
+        print(f"Queueing raw text input via {method} method...")
+        # Stored as a dummy text file record owned by the system user
+        job = enqueue_uploaded_file(
+            kind='processText',
+            user_id=user_id,
+            upload_user_id=0,
             chat_history_id=chat_history_id,
             file_name=f"text_snippet_{int(time.time())}.txt",
-            file_bytes=text_input.encode('utf-8')
+            file_bytes=text_input.encode('utf-8'),
+            options={'method': method}
         )
+        details.append(file_status_entry({"file_name": "Raw Text"}, job, None))
+        if job:
+            jobs.append(job)
 
-        if method == 'image':
-             # Logic if someone tries to "image encode" raw text (Use HyDE or Text-to-Image logic)
-             # For now, we reuse the local embedding function which handles text input via HyDE
-             if LOCAL:
-                 print("local101")
-                 embedding = get_image_embedding_jinna_api_local(text=text_input)
-             else:
-                 print("api101")
-                 embedding = get_image_embedding_jinna_api(text=text_input)
-             
-             if embedding:
-                 save_page_vector_to_db(user_id, chat_history_id, uploaded_file_id, 1, embedding)
-                 processed_files.append({"name": "Raw Text", "status": "indexed_as_multimodal_text"})
-
-        else:
-            # Standard Text Embedding
-            embedding = encode_text_for_embedding(text_input)
-            save_vector_to_db(user_id, chat_history_id, uploaded_file_id, "Raw Text Input", text_input, embedding, -1)
-            processed_files.append({"name": "Raw Text", "status": "indexed_as_legacy_text"})
-
-
-    # --- SCENARIO B: File Processing ---
+    # --- SCENARIO B: File Processing (concurrent uploads, results in upload order) ---
+    items = []
     for file in files:
-        start_process = time.time()
         filename = file.filename
         file.seek(0)
         file_bytes = file.read()
         
         if not file_bytes:
             continue
+        items.append({"file_name": filename, "file_bytes": file_bytes})
 
-        # 1. Upload to MinIO & DB
-        user_id = 0
-        uploaded_file_id, object_name = upload_file_to_minio_and_db(
-            user_id=user_id,
+    results = map_files_concurrently(
+        lambda item: enqueue_uploaded_file(
+            kind='processDocument',
+            user_id=0,
             chat_history_id=chat_history_id,
-            file_name=filename,
-            file_bytes=file_bytes
-        )
-        
-        if not uploaded_file_id:
-            print(f"Failed to upload {filename}. Skipping.")
-            continue
+            file_name=item['file_name'],
+            file_bytes=item['file_bytes'],
+            options={'method': method}
+        ),
+        items
+    )
+    for item, (job, error) in zip(items, results):
+        details.append(file_status_entry(item, job, error))
+        if job:
+            jobs.append(job)
 
-        # 2. Process based on Method
-        
-        # === METHOD: IMAGE (VLM / Multimodal Embeddings) ===
-        if method == 'image':
-            print(f"Processing '{filename}' via VLM/Image method...")
-            try:
-                pages_to_embed = []
-                
-                # A. Handle PDF
-                if filename.lower().endswith('.pdf'):
-                    pdf_doc = fitz.open(stream=file_bytes, filetype="pdf")
-                    num_pages = pdf_doc.page_count
-                    
-                    # Convert pages to images
-                    # for page_num_0_idx in range(num_pages):
-                    #     img_bytes = convert_pdf_page_to_image(file_bytes, page_num_0_idx)
-                    #     if img_bytes:
-                    #         pages_to_embed.append({
-                    #             "page_num_1_idx": page_num_0_idx + 1,
-                    #             "img_bytes": img_bytes
-                    #         })
-                    # pdf_doc.close()
-                    cvt_time = time.time()
-                    with multiprocessing.Pool(processes=10) as pool:  # Adjust processes as needed
-                        tasks = [(file_bytes, page_num_0_idx, 50) for page_num_0_idx in range(num_pages)]
-                        results = pool.map(convert_page_worker, tasks)
-
-                    for page_num_1_idx, img_bytes in results:
-                        if not img_bytes:
-                            print(f" - FAILED to render image for page {page_num_1_idx}. Skipping this page.")
-                            continue
-                        # Add to our list to process in a batch
-                        pages_to_embed.append({
-                            "page_num_1_idx": page_num_1_idx,
-                            "img_bytes": img_bytes
-                        })
-                    pdf_doc.close()
-                    print(f"convertPDFIMG_time : {time.time() - cvt_time} sec")
-                
-                # B. Handle Images
-                elif filename.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
-                    pages_to_embed.append({
-                        "page_num_1_idx": 1,
-                        "img_bytes": file_bytes
-                    })
-                
-                if not pages_to_embed:
-                    print(f"No pages extracted from {filename}.")
-                    continue
+    if not jobs:
+        return jsonify({"status": "error", "message": "No items could be queued.", "details": details, "jobs": []}), 500
 
-                # Batch Embed
-                image_bytes_batch = [p['img_bytes'] for p in pages_to_embed]
-                
-                # Select Embedding Provider
-                if LOCAL:
-                    # Use local model (e.g., Jina v4 / ColPali)
-                    print("local_101")
-                    embeddings_list = get_image_embedding_jinna_api_local(image_bytes_list=image_bytes_batch)
-                else:
-                    # Use API
-                    print("api_101")
-                    embeddings_list = get_image_embedding_jinna_api(image_bytes_list=image_bytes_batch)
-                
-                # Save embeddings
-                if embeddings_list and len(embeddings_list) == len(pages_to_embed):
-                    for page_data, img_embedding in zip(pages_to_embed, embeddings_list):
-                        save_page_vector_to_db(
-                            user_id=user_id,
-                            chat_history_id=chat_history_id,
-                            uploaded_file_id=uploaded_file_id,
-                            page_number=page_data['page_num_1_idx'],
-                            embedding=img_embedding
-                        )
-                    processed_files.append({"name": filename, "status": "indexed_as_images", "pages": len(embeddings_list)})
-                else:
-                    print(f"Failed to generate embeddings for {filename}")
+    return jsonify({
+        "status": "queued", 
+        "message": f"Queued {len(jobs)} items for processing.",
+        "details": details,
+        "jobs": jobs,
+        "FileID": jobs[-1]['file_id'],
+    }), 202
 
-            except Exception as e:
-                print(f"Error in image processing for {filename}: {e}")
-                import traceback
-                traceback.print_exc()
 
-        # === METHOD: TEXT (Legacy OCR/Extraction) ===
-        else:
-            print(f"Processing '{filename}' via Legacy Text method...")
-            try:
-                file_text = ""
-                # Wrap bytes for extractors
-                file_stream = io.BytesIO(file_bytes)
-                file_stream.filename = filename
-
-                # Select Extractor
-                if filename.lower().endswith('.pdf'):
-                    file_text = extract_pdf_text(file_stream)
-                elif filename.lower().endswith(('.png', '.jpg', '.jpeg', '.tiff', '.bmp', '.gif')):
-                    file_text = extract_image_text(file_stream)
-                elif filename.lower().endswith(('.docx','.doc','.odt','.rtf')):
-                    file_text = extract_docx_text(file_stream)
-                elif filename.lower().endswith(('.pptx','.ppt')):
-                    file_text = extract_pptx_text(file_stream)
-                elif filename.lower().endswith(('.xlsx','.xlsm')):
-                    file_text = extract_excel_text(file_stream)
-                elif filename.lower().endswith('.xls'):
-                    file_text = extract_xls_text(file_stream)
-                else:
-                    # Default to TXT extractor
-                    file_text = extract_txt_file(file_stream)
-
-                if file_text and file_text.strip():
-                    data_vector = encode_text_for_embedding(file_text)
-                    save_vector_to_db(
-                        user_id=user_id,
-                        chat_history_id=chat_history_id,
-                        uploaded_file_id=uploaded_file_id,
-                        file_name=filename,
-                        text=file_text,
-                        embedding=data_vector,
-                        page_number=-1
-                    )
-                    processed_files.append({"name": filename, "status": "indexed_as_text"})
-                else:
-                    print(f"No text extracted from {filename}")
+@app.route('/jobs', methods=['GET'])
+def get_jobs_api():
+    """
+    Returns the state of ingestion jobs.
+    Query: ?ids=1,2,3
+    """
+    try:
+        job_ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip()]
+    except ValueError:
+        return jsonify({"error": "'ids' must be a comma separated list of integers"}), 400
+    if not job_ids:
+        return jsonify({"error": "No job ids provided"}), 400
+    return jsonify({"jobs": get_ingest_jobs(job_ids)})
 
-            except Exception as e:
-                print(f"Error in text processing for {filename}: {e}")
-        print(f"Process time: {time.time() - start_process} sec")
 
-    clear_gpu()
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+def get_job_api(job_id):
+    jobs = get_ingest_jobs([job_id])
+    if not jobs:
+        return jsonify({"error": f"Job {job_id} not found"}), 404
+    return jsonify(jobs[0])
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_api():
+    """Runtime metrics of the ingestion/search helpers."""
     return jsonify({
-        "status": "success", 
-        "message": f"Successfully processed {len(processed_files)} items.",
-        "details": processed_files,
-        "FileID": uploaded_file_id,
+        "render_pool": get_render_pool_stats(),
+        "pdf_document_cache": get_pdf_cache_stats(),
+        "db_pool": get_db_pool_stats(),
+        "office_convert": get_office_convert_stats(),
+        "gpu_batching": get_gpu_batch_stats(),
+        "text_embedding_batcher": get_text_embedding_scheduler_stats(),
+        "embedding_cache": get_embedding_cache_stats(),
+        "vector_index": get_vector_index_stats(),
+        "chat_vector_cache": get_chat_vector_cache_stats(),
     })
 
 
@@ -1126,67 +963,68 @@ Output only the simulated excerpt.
         )
     print(f"Search prompt: {search_text}")
 
+    # Escalation factors: log(e + i) for i = 0, 2, 4, 6, 8. Every (table, query variant)
+    # is searched once at the widest threshold; ThresholdEscalation answers each level
+    # from the returned distances, so the query is embedded once per variant.
+    threshold_factors = [float(np.log(np.exp(1) + i)) for i in range(0,9,2)]
+    query_variants = [search_text, queryT]
+    legacy_search = None
+    page_search = None
+
     # =========================================================
     # METHOD 1: searchDoc (Search by active_users permission)
     # =========================================================
     if document_search_method == 'searchDoc':
         print(f"  - executing 'searchDoc' strategy for user {user_id}...")
-        for i in range(0,9,2):
-            print(f"Threshold : {threshold_text * float(np.log(np.exp(1) + i))}")
-            # 1. Legacy Text Search
-            for text in [search_text, queryT]:
-                legacy_results = search_similar_documents_by_active_user(
-                    query_text=text,
-                    user_id=user_id,
-                    top_k=top_k_text,
-                    threshold_text=threshold_text * float(np.log(np.exp(1) + i)),
-                )
-                if legacy_results:
-                    break
-
-            # 2. New Page Image Search
-            for text in [search_text, queryT]:
-                page_search_results = search_similar_pages_by_active_user(
-                    query_text=text,
-                    user_id=user_id,
-                    top_k=top_k_pages,
-                    threshold=threshold_page * float(np.log(np.exp(1) + i)),
-                )
-                if page_search_results:
-                    break
-
-            if legacy_results or page_search_results:
-                break
+        # 1. Legacy Text Search
+        legacy_search = ThresholdEscalation(
+            query_variants,
+            lambda text, threshold: search_similar_documents_by_active_user(
+                query_text=text,
+                user_id=user_id,
+                top_k=top_k_text,
+                threshold_text=threshold,
+            ),
+            threshold_text, threshold_factors,
+        )
+        # 2. New Page Image Search
+        page_search = ThresholdEscalation(
+            query_variants,
+            lambda text, threshold: search_similar_pages_by_active_user(
+                query_text=text,
+                user_id=user_id,
+                top_k=top_k_pages,
+                threshold=threshold,
+                normalize=False,
+            ),
+            threshold_page, threshold_factors, post=normalize_page_matches,
+        )
 
     elif document_search_method == 'searchdocAll':
         print(f"  - executing 'searchDocAll' strategy for user {user_id}...")
-        
-        for i in range(0,9,2):
-            print(f"Threshold : {threshold_text * float(np.log(np.exp(1) + i))}")
-            # 1. Legacy Text Search
-            for text in [search_text, queryT]:
-                legacy_results = search_similar_documents_by_active_user_all(
-                    query_text=text,
-                    user_id=user_id,
-                    top_k=top_k_text,
-                    threshold_text=threshold_text * float(np.log(np.exp(1) + i)),
-                )
-                if legacy_results:
-                    break
-
-            # 2. New Page Image Search
-            for text in [search_text, queryT]:
-                page_search_results = search_similar_pages_by_active_user_all(
-                    query_text=text,
-                    user_id=user_id,
-                    top_k=top_k_pages,
-                    threshold=threshold_page * float(np.log(np.exp(1) + i)),
-                )
-                if page_search_results:
-                    break
-                
-            if legacy_results or page_search_results:
-                break
+        # 1. Legacy Text Search
+        legacy_search = ThresholdEscalation(
+            query_variants,
+            lambda text, threshold: search_similar_documents_by_active_user_all(
+                query_text=text,
+                user_id=user_id,
+                top_k=top_k_text,
+                threshold_text=threshold,
+            ),
+            threshold_text, threshold_factors,
+        )
+        # 2. New Page Image Search
+        page_search = ThresholdEscalation(
+            query_variants,
+            lambda text, threshold: search_similar_pages_by_active_user_all(
+                query_text=text,
+                user_id=user_id,
+                top_k=top_k_pages,
+                threshold=threshold,
+                normalize=False,
+            ),
+            threshold_page, threshold_factors, post=normalize_page_matches,
+        )
 
     # =========================================================
     # METHOD 3: none (Search by current chat context)
@@ -1194,43 +1032,53 @@ Output only the simulated excerpt.
     elif document_search_method == 'none':
         print(f"  - executing 'none' (chat context) strategy for chat {chat_history_id}...")
         
-        # Check DB for Legacy Data
-        cur = conn.cursor()
-        cur.execute("SELECT 1 FROM document_embeddings WHERE user_id=%s AND chat_history_id=%s LIMIT 1", (user_id, chat_history_id))
-        has_legacy = cur.fetchone()
-        
-        # Check DB for New Page Data
-        cur.execute("SELECT 1 FROM document_page_embeddings WHERE user_id=%s AND chat_history_id=%s LIMIT 1", (user_id, chat_history_id))
-        has_pages = cur.fetchone()
-        cur.close()
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            # Check DB for Legacy Data
+            cur.execute("SELECT 1 FROM document_embeddings WHERE user_id=%s AND chat_history_id=%s LIMIT 1", (user_id, chat_history_id))
+            has_legacy = cur.fetchone()
+            
+            # Check DB for New Page Data
+            cur.execute("SELECT 1 FROM document_page_embeddings WHERE user_id=%s AND chat_history_id=%s LIMIT 1", (user_id, chat_history_id))
+            has_pages = cur.fetchone()
+            cur.close()
+        finally:
+            conn.close()
+
+        if has_legacy:
+            legacy_search = ThresholdEscalation(
+                query_variants,
+                lambda text, threshold: search_similar_documents_by_chat(
+                    query_text=text, 
+                    user_id=user_id, 
+                    chat_history_id=chat_history_id, 
+                    top_k=top_k_text,
+                    threshold_text=threshold,
+                ),
+                threshold_text, threshold_factors,
+            )
 
+        if has_pages:
+            page_search = ThresholdEscalation(
+                query_variants,
+                lambda text, threshold: search_similar_pages(
+                    query_text=text, 
+                    user_id=user_id, 
+                    chat_history_id=chat_history_id, 
+                    top_k=top_k_pages, 
+                    threshold=threshold,
+                    normalize=False,
+                ),
+                threshold_page, threshold_factors, post=normalize_page_matches,
+            )
 
-        for i in range(0,9,2):
-            print(f"Threshold : {threshold_text * float(np.log(np.exp(1) + i))}")
-            if has_legacy:
-                for text in [search_text, queryT]:
-                    legacy_results = search_similar_documents_by_chat(
-                        query_text=text, 
-                        user_id=user_id, 
-                        chat_history_id=chat_history_id, 
-                        top_k=top_k_text,
-                        threshold_text=threshold_text * float(np.log(np.exp(1) + i)),
-                    )
-                    if legacy_results:
-                        break
-
-            if has_pages:
-                for text in [search_text, queryT]:
-                    page_search_results = search_similar_pages(
-                        query_text=text, 
-                        user_id=user_id, 
-                        chat_history_id=chat_history_id, 
-                        top_k=top_k_pages, 
-                        threshold=threshold_page * float(np.log(np.exp(1) + i)),
-                    )
-                    if page_search_results:
-                        break
-            if legacy_results or page_search_results or ( not has_legacy and  not has_pages):
+    if legacy_search or page_search:
+        for factor in threshold_factors:
+            print(f"Threshold : {threshold_text * factor}")
+            legacy_results = legacy_search.at(factor) if legacy_search else []
+            page_search_results = page_search.at(factor) if page_search else []
+            if legacy_results or page_search_results:
                 break
 
 
@@ -1781,6 +1629,10 @@ class GemmaEmbeddings(Embeddings):
 
 
 # === VERIFIED ANSWERS ENDPOINT ===
+# Upper bound of "texts" in one /encode_embedding call
+EMBED_MAX_BATCH_TEXTS = int(os.getenv("EMBED_MAX_BATCH_TEXTS", "256"))
+
+
 @app.route('/encode_embedding', methods=['POST'])
 def encode_embedding():
     """สร้าง embedding จากข้อความ
@@ -1789,28 +1641,96 @@ def encode_embedding():
     {
         "text": "ข้อความที่ต้องการ embedding",
         "dimensions": 2048,  # optional (default: 2048 สำหรับ verified_answers)
-        "is_query": false   # optional - true=ค้นหา, false=บันทึกเอกสาร (cross-lingual support)
+        "is_query": false,  # optional - true=ค้นหา, false=บันทึกเอกสาร (cross-lingual support)
+        "encoding": "json"  # optional - "json" (list of floats), "base64" (float32 little-endian, base64)
+                            #            or "binary" (raw float32 little-endian bytes, application/octet-stream)
     }
+
+    Batch mode: send "texts" instead of "text", a list of strings and/or
+    {"text": ..., "is_query": ...} objects (items without is_query use the top-level
+    one). The response then carries "embeddings" ("embeddings_b64" for base64, rows
+    back to back for binary with an X-Embedding-Count header), in input order.
     """
     try:
         data = request.json
         text = data.get('text', '')
+        texts = data.get('texts')
         dimensions = data.get('dimensions', 2048)  # Default: 2048
         is_query = data.get('is_query', False)  # Default: False (document mode)
+        encoding = data.get('encoding', 'json')
         
+        if encoding not in ('json', 'base64', 'binary'):
+            return jsonify({'error': f"Unsupported encoding '{encoding}'"}), 400
+
+        if texts is not None:
+            if not isinstance(texts, list) or not texts:
+                return jsonify({'error': "'texts' must be a non-empty list"}), 400
+            if len(texts) > EMBED_MAX_BATCH_TEXTS:
+                return jsonify({'error': f"At most {EMBED_MAX_BATCH_TEXTS} texts per request"}), 400
+            batch_texts, batch_is_query = [], []
+            for item in texts:
+                if isinstance(item, dict):
+                    batch_texts.append(item.get('text', ''))
+                    batch_is_query.append(item.get('is_query', is_query))
+                else:
+                    batch_texts.append(item)
+                    batch_is_query.append(is_query)
+            if any(not isinstance(t, str) or not t.strip() for t in batch_texts):
+                return jsonify({'error': 'Every item of texts needs a non-empty text'}), 400
+
+            embeddings = encode_texts_for_embedding_batched(batch_texts, target_dimensions=dimensions, is_query=batch_is_query)
+            actual_dimensions = len(embeddings[0])
+
+            if encoding == 'binary':
+                response = app.response_class(b"".join(encode_vector_bytes(e) for e in embeddings),
+                                              mimetype='application/octet-stream')
+                response.headers['X-Embedding-Count'] = str(len(embeddings))
+                response.headers['X-Embedding-Dimensions'] = str(actual_dimensions)
+                response.headers['X-Embedding-Dtype'] = 'float32-le'
+                return response
+            if encoding == 'base64':
+                return jsonify({
+                    'success': True,
+                    'embeddings_b64': [encode_vector_base64(e) for e in embeddings],
+                    'dtype': 'float32-le',
+                    'count': len(embeddings),
+                    'dimensions': actual_dimensions,
+                    'requested_dimensions': dimensions
+                })
+            return jsonify({
+                'success': True,
+                'embeddings': [e.tolist() for e in embeddings],
+                'count': len(embeddings),
+                'dimensions': actual_dimensions,
+                'requested_dimensions': dimensions
+            })
+
         if not text:
             return jsonify({'error': 'No text provided'}), 400
         
-        # ใช้ encode_text_for_embedding จาก utils
+        # ใช้ encode_text_for_embedding จาก utils, batched with concurrent requests
         # is_query=True ใช้ retrieval.query, False ใช้ retrieval.passage
-        embedding = encode_text_for_embedding(text, target_dimensions=dimensions, is_query=is_query)
+        embedding = encode_text_for_embedding_batched(text, target_dimensions=dimensions, is_query=is_query)
         
         # ตรวจสอบ dimensions ที่ได้กลับมา
         actual_dimensions = len(embedding)
         
+        if encoding == 'binary':
+            response = app.response_class(encode_vector_bytes(embedding), mimetype='application/octet-stream')
+            response.headers['X-Embedding-Dimensions'] = str(actual_dimensions)
+            response.headers['X-Embedding-Dtype'] = 'float32-le'
+            return response
+        if encoding == 'base64':
+            return jsonify({
+                'success': True,
+                'embedding_b64': encode_vector_base64(embedding),
+                'dtype': 'float32-le',
+                'dimensions': actual_dimensions,
+                'requested_dimensions': dimensions
+            })
         return jsonify({
             'success': True,
-            'embedding': embedding,
+            'embedding': embedding.tolist(),
             'dimensions': actual_dimensions,
             'requested_dimensions': dimensions
         })
@@ -1927,4 +1847,27 @@ if __name__ == '__main__':
     #             n_class=n_class
 
     #         )
+
+    # The render pool forks, so create it before any worker/Flask threads exist
+    start_render_pool()
+
+    # Load the Docling pipelines now instead of on the first office upload
+    if DOCLING_WARM_AT_STARTUP:
+        warm_document_converters()
+    if GPU_BATCH_PROBE_AT_STARTUP:
+        warm_embedding_batch_sizes()
+
+    # HNSW indexes for the vector searches; built in the background, searches
+    # scan the tables until they exist
+    if VECTOR_INDEX_BUILD_AT_STARTUP:
+        start_vector_index_build()
+
+    # Ingest workers embedded in the API process; set to 0 when dedicated
+    # ingest_worker.py nodes drain the queue instead.
+    # One thread by default: it shares the in-process GPU embedding model and the
+    # render pool with the API; run more ingest_worker.py processes for throughput.
+    ingest_worker_count = int(os.getenv("INGEST_EMBEDDED_WORKERS", "1"))
+    if ingest_worker_count > 0:
+        start_ingest_worker_threads(run_ingest_job, ingest_worker_count)
+
     app.run(host='0.0.0.0', port=5000, debug=False)
@@ -0,0 +1,79 @@
+import pytest
+
+from utils.search_escalation import ThresholdEscalation, normalize_page_matches
+
+TOP_K = 3
+BASE_THRESHOLD = 0.4
+FACTORS = [1.0, 1.5, 2.0, 3.0]
+
+# Per query variant: the page rows a search would see, in storage order.
+# Equal distances (ties) sit both inside the top_k and across its cut-off.
+PAGES = {
+    "exact question": [],
+    "reworded question": [
+        {'page_embedding_id': 1, 'file_name': 'a.pdf', 'object_name': 'a', 'page_number': 1, 'distance': 0.9},
+        {'page_embedding_id': 2, 'file_name': 'a.pdf', 'object_name': 'a', 'page_number': 2, 'distance': 0.5},
+        {'page_embedding_id': 3, 'file_name': 'b.pdf', 'object_name': 'b', 'page_number': 1, 'distance': 0.5},
+        {'page_embedding_id': 4, 'file_name': 'b.pdf', 'object_name': 'b', 'page_number': 2, 'distance': 0.7},
+        {'page_embedding_id': 5, 'file_name': 'c.pdf', 'object_name': 'c', 'page_number': 1, 'distance': 0.7},
+        {'page_embedding_id': 6, 'file_name': 'c.pdf', 'object_name': 'c', 'page_number': 2, 'distance': 1.3},
+    ],
+    "keywords": [
+        {'page_embedding_id': 7, 'file_name': 'd.pdf', 'object_name': 'd', 'page_number': 1, 'distance': 0.3},
+        {'page_embedding_id': 8, 'file_name': 'd.pdf', 'object_name': 'd', 'page_number': 2, 'distance': 0.3},
+    ],
+}
+
+
+def fake_search(text, threshold):
+    """Stands in for SQL: WHERE distance <= threshold ORDER BY distance LIMIT top_k."""
+    rows = [row for row in PAGES[text] if row['distance'] <= threshold]
+    return sorted(rows, key=lambda row: row['distance'])[:TOP_K]
+
+
+def per_level_search(variants, factor, post=None):
+    """What /search_similar did before: one search per variant and threshold level."""
+    for text in variants:
+        if not text:
+            continue
+        rows = fake_search(text, BASE_THRESHOLD * factor)
+        if rows and post is not None:
+            rows = post(rows)
+        if rows:
+            return rows
+    return []
+
+
+@pytest.mark.parametrize("variants", [
+    ["exact question", "reworded question", "keywords"],
+    ["", "exact question", "keywords", "reworded question"],
+    ["reworded question", "reworded question"],
+])
+@pytest.mark.parametrize("post", [None, normalize_page_matches])
+def test_matches_per_level_search(variants, post):
+    calls = []
+
+    def run_search(text, threshold):
+        calls.append(text)
+        return fake_search(text, threshold)
+
+    escalation = ThresholdEscalation(variants, run_search, BASE_THRESHOLD, FACTORS, post=post)
+    for factor in FACTORS:
+        assert escalation.at(factor) == per_level_search(variants, factor, post=post)
+    # A variant is searched at most once, at the widest threshold; empty ones never
+    assert len(calls) == len(set(calls))
+    assert "" not in calls
+
+
+def test_empty_first_variant_falls_through():
+    escalation = ThresholdEscalation(["exact question", "reworded question"], fake_search, BASE_THRESHOLD, FACTORS)
+    assert escalation.at(1.0) == []
+    assert [row['page_embedding_id'] for row in escalation.at(1.5)] == [2, 3]
+    assert [row['page_embedding_id'] for row in escalation.at(3.0)] == [2, 3, 4]
+
+
+def test_normalize_page_matches_scores_ties_alike():
+    rows = fake_search("reworded question", BASE_THRESHOLD * 2.0)
+    scored = normalize_page_matches(rows)
+    # Distances 0.5, 0.5, 0.7: both ties score 1.0, the farthest page 0.0 is dropped
+    assert [(row['page_embedding_id'], row['similarity_score']) for row in scored] == [(2, 1.0), (3, 1.0)]
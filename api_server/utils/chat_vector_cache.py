@@ -0,0 +1,225 @@
+import collections
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from utils.vectors import to_float32
+
+# ==============================================================================
+#  IN-PROCESS PER-CHAT VECTOR MATRICES
+# ==============================================================================
+# Most chats hold a handful of files, so their vectors fit in one float32 matrix.
+# search_similar_documents_by_chat / search_similar_pages load a chat's rows on
+# first use and answer top-k with one matrix-vector product instead of a
+# Postgres join + scan.
+# Every search first runs one cheap version query over the same join:
+# (row count, max row id, has queued/running ingest jobs). A changed version
+# reloads the matrix, so writes from any process (other API workers,
+# ingest_worker.py nodes, deletes made by the Node app) are seen right away.
+# Chats with pending ingest jobs or more than CHAT_VECTOR_CACHE_MAX_ROWS rows
+# are not cached and go to SQL (and its HNSW index).
+# Kept free of util.py imports so it can be used from any module.
+
+CHAT_VECTOR_CACHE_ENABLED = os.getenv("CHAT_VECTOR_CACHE_ENABLED", "true").lower() == "true"
+CHAT_VECTOR_CACHE_MAX_ROWS = int(os.getenv("CHAT_VECTOR_CACHE_MAX_ROWS", "5000"))   # per chat and table
+CHAT_VECTOR_CACHE_MAX_BYTES = int(os.getenv("CHAT_VECTOR_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Same filters and columns as the SQL of the two chat searches; the distance is appended
+CHAT_TEXT_CHUNKS = "document_embeddings"
+CHAT_PAGES = "document_page_embeddings"
+_COLUMNS = {
+    CHAT_TEXT_CHUNKS: "t1.id, t2.file_name, t2.object_name, t1.page_number, t1.extracted_text",
+    CHAT_PAGES: "t1.id, t2.file_name, t2.object_name, t1.page_number",
+}
+_FROM_WHERE = """
+    FROM {table} AS t1
+    INNER JOIN uploaded_files AS t2 ON t1.uploaded_file_id = t2.id
+    WHERE t2.user_id = %s
+      AND t2.chat_history_id = %s
+      AND t1.embedding IS NOT NULL
+"""
+_VERSION_QUERY = """
+    SELECT count(*), max(t1.id),
+           EXISTS (
+               SELECT 1 FROM ingest_jobs AS j
+               WHERE j.user_id = %s
+                 AND j.chat_history_id = %s
+                 AND j.status IN ('queued', 'running')
+           )
+    {from_where}
+"""
+
+
+class _ChatVectors:
+    """Rows of one (table, user, chat): metadata tuples + float32 matrix with squared row norms."""
+
+    def __init__(self, rows: List[tuple], matrix: np.ndarray, version: Tuple[int, Optional[int]]):
+        self.rows = rows
+        self.matrix = matrix
+        self.sq_norms = np.einsum("ij,ij->i", matrix, matrix)
+        self.version = version
+
+    @property
+    def nbytes(self) -> int:
+        return self.matrix.nbytes + self.sq_norms.nbytes
+
+    def search(self, query_vector: np.ndarray, top_k: int, threshold: float) -> List[tuple]:
+        if not self.rows or top_k <= 0:
+            return []
+        # ||x - q||^2 = ||x||^2 - 2 x.q + ||q||^2
+        sq_dist = self.sq_norms - 2.0 * (self.matrix @ query_vector) + float(query_vector @ query_vector)
+        distances = np.sqrt(np.maximum(sq_dist, 0.0))
+        k = min(top_k, len(distances))
+        nearest = np.argpartition(distances, k - 1)[:k] if k < len(distances) else np.arange(len(distances))
+        nearest = nearest[np.argsort(distances[nearest], kind="stable")]
+        return [self.rows[i] + (float(distances[i]),) for i in nearest if distances[i] <= threshold]
+
+
+class ChatVectorCache:
+    def __init__(self, max_rows: int = CHAT_VECTOR_CACHE_MAX_ROWS, max_bytes: int = CHAT_VECTOR_CACHE_MAX_BYTES,
+                 enabled: bool = CHAT_VECTOR_CACHE_ENABLED):
+        self.enabled = enabled
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self._entries: "collections.OrderedDict[Tuple[str, int, int], _ChatVectors]" = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._load_locks = [threading.Lock() for _ in range(64)]  # striped by key
+        self._stats = {
+            "searches": 0, "loads": 0, "reloads": 0, "too_large": 0, "pending_ingest": 0,
+            "invalidations": 0, "evictions": 0, "load_sec": 0.0,
+        }
+
+    # --- entries -------------------------------------------------------------
+
+    def _get(self, key, version) -> Optional[_ChatVectors]:
+        # Called with _lock held; an entry of another version is stale
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.version != version:
+            self._drop(key)
+            self._stats["reloads"] += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _drop(self, key):
+        # Called with _lock held
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.nbytes
+
+    def _store(self, key, entry: _ChatVectors):
+        # Called with _lock held
+        self._drop(key)
+        if entry.nbytes > self.max_bytes:
+            return
+        self._entries[key] = entry
+        self._bytes += entry.nbytes
+        while self._bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+            self._stats["evictions"] += 1
+
+    def _load(self, cur, table: str, user_id: int, chat_history_id: int) -> _ChatVectors:
+        cur.execute(
+            f"SELECT {_COLUMNS[table]}, t1.embedding::real[] {_FROM_WHERE.format(table=table)} ORDER BY t1.id",
+            (user_id, chat_history_id)
+        )
+        records = cur.fetchall()
+        rows = [tuple(record[:-1]) for record in records]
+        matrix = (
+            np.ascontiguousarray(np.stack([to_float32(record[-1]) for record in records]))
+            if records else np.zeros((0, 0), dtype=np.float32)
+        )
+        # Version of what was actually read (rows may have changed since the version query)
+        version = (len(rows), rows[-1][0] if rows else None)
+        return _ChatVectors(rows, matrix, version)
+
+    # --- public API ----------------------------------------------------------
+
+    def search(self, cur, table: str, user_id: int, chat_history_id: int,
+               query_vector: Any, top_k: int, threshold: float) -> Optional[List[tuple]]:
+        """
+        Top-k rows of the chat within `threshold` (L2), shaped like the SQL rows
+        of the chat searches: (columns..., distance), nearest first.
+
+        Returns:
+            None when the cache is disabled, the chat is too large or still has
+            ingest jobs queued/running; the caller then runs its SQL query.
+        """
+        if not self.enabled:
+            return None
+        key = (table, user_id, chat_history_id)
+        cur.execute(
+            _VERSION_QUERY.format(from_where=_FROM_WHERE.format(table=table)),
+            (user_id, chat_history_id, user_id, chat_history_id)
+        )
+        row_count, max_id, ingest_pending = cur.fetchone()
+        version = (row_count, max_id)
+
+        if ingest_pending or row_count > self.max_rows:
+            with self._lock:
+                self._drop(key)
+                self._stats["pending_ingest" if ingest_pending else "too_large"] += 1
+            return None
+
+        with self._lock:
+            entry = self._get(key, version)
+        if entry is None:
+            with self._load_locks[hash(key) % len(self._load_locks)]:  # concurrent searches of a cold chat load it once
+                with self._lock:
+                    entry = self._get(key, version)
+                if entry is None:
+                    start = time.time()
+                    entry = self._load(cur, table, user_id, chat_history_id)
+                    with self._lock:
+                        self._store(key, entry)
+                        self._stats["loads"] += 1
+                        self._stats["load_sec"] += time.time() - start
+
+        with self._lock:
+            self._stats["searches"] += 1
+        return entry.search(to_float32(query_vector), top_k, threshold)
+
+    def invalidate(self, user_id: int, chat_history_id: int):
+        with self._lock:
+            for table in _COLUMNS:
+                key = (table, user_id, chat_history_id)
+                if key in self._entries:
+                    self._drop(key)
+                    self._stats["invalidations"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "enabled": self.enabled,
+                "chats": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "max_rows": self.max_rows,
+            })
+        stats["load_sec"] = round(stats["load_sec"], 4)
+        return stats
+
+
+chat_vector_cache = ChatVectorCache()
+
+
+def search_chat_vectors(cur, table: str, user_id: int, chat_history_id: int,
+                        query_vector: Any, top_k: int, threshold: float) -> Optional[List[tuple]]:
+    return chat_vector_cache.search(cur, table, user_id, chat_history_id, query_vector, top_k, threshold)
+
+
+def invalidate_chat_vectors(user_id: int, chat_history_id: int):
+    """Drops the cached vectors of a chat early (the version check would catch the change too)."""
+    chat_vector_cache.invalidate(user_id, chat_history_id)
+
+
+def get_chat_vector_cache_stats() -> Dict[str, Any]:
+    return chat_vector_cache.stats()
@@ -0,0 +1,141 @@
+import math
+import os
+import re
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# ==============================================================================
+#  TEXT CHUNKING (legacy 'document_embeddings' path)
+# ==============================================================================
+# Extracted text is split into overlapping, token-bounded chunks that never cross
+# a page boundary, so every stored row is a small passage with a page number.
+# Extractors mark page boundaries with PAGE_BREAK (form feed); text without page
+# breaks is treated as a single page of unknown number (-1).
+
+TEXT_CHUNK_TOKENS = int(os.getenv("TEXT_CHUNK_TOKENS", "512"))
+TEXT_CHUNK_OVERLAP_TOKENS = int(os.getenv("TEXT_CHUNK_OVERLAP_TOKENS", "64"))
+PAGE_BREAK = "\f"
+
+# Rough chars-per-token of multilingual BPE tokenizers, used when no tokenizer is given
+_APPROX_CHARS_PER_TOKEN = 4
+_WORD_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?。！？])\s+|\n")
+
+
+def approx_token_count(text: str) -> int:
+    """Token estimate without a tokenizer: words/punctuation, or chars/4 for unspaced scripts (e.g. Thai)."""
+    return max(len(_WORD_RE.findall(text)), math.ceil(len(text) / _APPROX_CHARS_PER_TOKEN))
+
+
+def split_pages(text: str) -> List[Tuple[int, str]]:
+    """
+    Splits extracted text on PAGE_BREAK.
+
+    Returns:
+        [(page_number_1_idx, page_text), ...], or [(-1, text)] when the text has
+        no page breaks. Empty pages are dropped but keep their numbering.
+    """
+    if PAGE_BREAK not in text:
+        return [(-1, text)] if text.strip() else []
+    return [
+        (page_num_1_idx, page_text)
+        for page_num_1_idx, page_text in enumerate(text.split(PAGE_BREAK), start=1)
+        if page_text.strip()
+    ]
+
+
+def _split_oversized(unit: str, max_tokens: int, count_tokens: Callable[[str], int]) -> List[str]:
+    """Breaks a unit longer than max_tokens into sentences, then words, then characters."""
+    if count_tokens(unit) <= max_tokens:
+        return [unit]
+
+    for pattern in (_SENTENCE_END_RE, re.compile(r"\s+")):
+        parts = [p for p in pattern.split(unit) if p and p.strip()]
+        if len(parts) > 1:
+            pieces: List[str] = []
+            for part in parts:
+                pieces.extend(_split_oversized(part, max_tokens, count_tokens))
+            return pieces
+
+    # A single unspaced run: fixed-size character windows
+    window = max(1, max_tokens * _APPROX_CHARS_PER_TOKEN)
+    while window > 1 and count_tokens(unit[:window]) > max_tokens:
+        window //= 2
+    return [unit[i:i + window] for i in range(0, len(unit), window)]
+
+
+def _join_units(units: List[Tuple[str, int, bool]]) -> str:
+    # Paragraphs are re-joined with a blank line, pieces of one paragraph with a space
+    text = units[0][0]
+    for unit, _, starts_paragraph in units[1:]:
+        text += ("\n\n" if starts_paragraph else " ") + unit
+    return text
+
+
+def chunk_pages(pages: Iterable[Tuple[int, str]],
+                chunk_tokens: int = TEXT_CHUNK_TOKENS,
+                overlap_tokens: int = TEXT_CHUNK_OVERLAP_TOKENS,
+                count_tokens: Optional[Callable[[str], int]] = None) -> List[Dict]:
+    """
+    Packs paragraphs (then sentences, then words) of each page into chunks of at
+    most `chunk_tokens` tokens. Consecutive chunks of a page share up to
+    `overlap_tokens` tokens of trailing text.
+
+    Args:
+        pages: [(page_number, page_text), ...], e.g. from split_pages().
+        count_tokens: Token counter of the embedding model; approx_token_count when None.
+
+    Returns:
+        [{"text", "page_number", "chunk_index", "tokens"}, ...] in document order.
+    """
+    count_tokens = count_tokens or approx_token_count
+    chunk_tokens = max(1, chunk_tokens)
+    overlap_tokens = max(0, min(overlap_tokens, chunk_tokens // 2))
+
+    chunks: List[Dict] = []
+    for page_number, page_text in pages:
+        # (text, tokens, starts_paragraph)
+        units: List[Tuple[str, int, bool]] = []
+        for paragraph in re.split(r"\n\s*\n", page_text):
+            if not paragraph.strip():
+                continue
+            for i, piece in enumerate(_split_oversized(paragraph.strip(), chunk_tokens, count_tokens)):
+                units.append((piece, count_tokens(piece), i == 0))
+
+        current: List[Tuple[str, int, bool]] = []
+        current_tokens = 0
+        for unit, unit_tokens, starts_paragraph in units:
+            if current and current_tokens + unit_tokens > chunk_tokens:
+                chunks.append({
+                    "text": _join_units(current),
+                    "page_number": page_number,
+                    "chunk_index": len(chunks),
+                    "tokens": current_tokens,
+                })
+                # Carry the tail of the previous chunk over as overlap
+                carried: List[Tuple[str, int, bool]] = []
+                carried_tokens = 0
+                for prev in reversed(current):
+                    prev_tokens = prev[1]
+                    if carried_tokens + prev_tokens > overlap_tokens or carried_tokens + prev_tokens + unit_tokens > chunk_tokens:
+                        break
+                    carried.insert(0, prev)
+                    carried_tokens += prev_tokens
+                current, current_tokens = carried, carried_tokens
+            current.append((unit, unit_tokens, starts_paragraph))
+            current_tokens += unit_tokens
+
+        if current:
+            chunks.append({
+                "text": _join_units(current),
+                "page_number": page_number,
+                "chunk_index": len(chunks),
+                "tokens": current_tokens,
+            })
+    return chunks
+
+
+def chunk_text(text: str, chunk_tokens: int = TEXT_CHUNK_TOKENS,
+               overlap_tokens: int = TEXT_CHUNK_OVERLAP_TOKENS,
+               count_tokens: Optional[Callable[[str], int]] = None) -> List[Dict]:
+    """split_pages() + chunk_pages() for a whole extracted document."""
+    return chunk_pages(split_pages(text), chunk_tokens, overlap_tokens, count_tokens)
@@ -0,0 +1,233 @@
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+import psycopg2
+import psycopg2.extensions
+
+from utils.vectors import register_vector_adapters
+
+# ==============================================================================
+#  PROCESS-WIDE POSTGRES CONNECTION POOL
+# ==============================================================================
+# get_db_connection() checks a connection out of this pool; the existing
+# `conn.close()` in every helper's `finally` hands it back instead of tearing
+# down the TCP/auth session. Up to DB_POOL_SIZE idle connections are kept, up to
+# DB_POOL_MAX_OVERFLOW extra ones are opened under load and closed on return.
+# Every new connection gets the numpy/pgvector adapters (see vectors.py).
+# Kept free of util.py imports so it can be used from any module.
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))                   # seconds to wait for a free connection
+DB_POOL_PRE_PING_AFTER = float(os.getenv("DB_POOL_PRE_PING_AFTER", "30"))     # health-check connections idle longer than this
+DB_POOL_RECYCLE = float(os.getenv("DB_POOL_RECYCLE", "1800"))                 # reopen connections older than this
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "60000"))  # 0 disables
+# Whole-document index writes (bulk COPY, checkpoint publish, dedup copy) can outlast
+# DB_STATEMENT_TIMEOUT_MS on large files; they run with this one instead (0 = no limit)
+DB_BULK_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_BULK_STATEMENT_TIMEOUT_MS", "0"))
+
+
+class DBPoolTimeout(psycopg2.OperationalError):
+    pass
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """psycopg2 connection whose close() returns it to the pool it came from."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool: Optional["DBConnectionPool"] = None
+        self._checked_out = False
+        self._created_at = time.time()
+        self._returned_at = self._created_at
+
+    def close(self):
+        if self._pool is not None and self._checked_out:
+            self._pool.release(self)
+        elif self._pool is None:
+            super().close()
+
+    def discard(self):
+        """Really closes the socket."""
+        if not self.closed:
+            super().close()
+
+
+class DBConnectionPool:
+    def __init__(self, size: int = DB_POOL_SIZE, max_overflow: int = DB_POOL_MAX_OVERFLOW,
+                 timeout: float = DB_POOL_TIMEOUT, statement_timeout_ms: int = DB_STATEMENT_TIMEOUT_MS):
+        self.size = max(1, size)
+        self.max_overflow = max(0, max_overflow)
+        self.timeout = timeout
+        self.statement_timeout_ms = statement_timeout_ms
+        self.pid = os.getpid()
+
+        self._idle: "deque[PooledConnection]" = deque()
+        self._open = 0          # idle + checked out
+        self._cond = threading.Condition()
+        self._stats = {
+            "created": 0,
+            "discarded": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "wait_sec": 0.0,
+            "timeouts": 0,
+            "health_check_failures": 0,
+            "connect_errors": 0,
+        }
+
+    def _connect(self) -> PooledConnection:
+        options = f"-c statement_timeout={self.statement_timeout_ms}" if self.statement_timeout_ms > 0 else None
+        conn = psycopg2.connect(
+            dbname=os.getenv("PGDATABASE", "ai_agent"),
+            user=os.getenv("PGUSER", "athip"),
+            password=os.getenv("PGPASSWORD", "123456"),
+            host=os.getenv("PGHOST", "localhost"),
+            port=os.getenv("PGPORT", "5432"),
+            options=options,
+            connection_factory=PooledConnection,
+        )
+        conn._pool = self
+        register_vector_adapters(conn)
+        return conn
+
+    def _is_healthy(self, conn: PooledConnection) -> bool:
+        if conn.closed:
+            return False
+        now = time.time()
+        if DB_POOL_RECYCLE > 0 and now - conn._created_at > DB_POOL_RECYCLE:
+            return False
+        if now - conn._returned_at < DB_POOL_PRE_PING_AFTER:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _drop(self, conn: PooledConnection):
+        # Called with the condition held
+        self._open -= 1
+        self._stats["discarded"] += 1
+        self._cond.notify()
+        try:
+            conn.discard()
+        except Exception:
+            pass
+
+    def getconn(self) -> PooledConnection:
+        start = time.time()
+        deadline = start + self.timeout
+        waited = False
+        while True:
+            with self._cond:
+                if self._idle:
+                    conn = self._idle.pop()   # most recently used first: its session is warmest
+                    reserved = False
+                elif self._open < self.size + self.max_overflow:
+                    self._open += 1
+                    conn, reserved = None, True
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise DBPoolTimeout(
+                            f"No database connection available within {self.timeout}s "
+                            f"(size={self.size}, max_overflow={self.max_overflow})"
+                        )
+                    if not waited:
+                        self._stats["waits"] += 1
+                        waited = True
+                    self._cond.wait(remaining)
+                    continue
+
+            # Health check / connect outside the lock
+            if reserved:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._open -= 1
+                        self._stats["connect_errors"] += 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._stats["created"] += 1
+            elif not self._is_healthy(conn):
+                with self._cond:
+                    self._stats["health_check_failures"] += 1
+                    self._drop(conn)
+                continue
+
+            with self._cond:
+                conn._checked_out = True
+                self._stats["checkouts"] += 1
+                if waited:
+                    self._stats["wait_sec"] += time.time() - start
+            return conn
+
+    def release(self, conn: PooledConnection):
+        conn._checked_out = False
+        # Never hand a half-finished transaction to the next caller
+        try:
+            if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            if not conn.closed and conn.autocommit:
+                conn.autocommit = False
+        except psycopg2.Error:
+            conn.discard()
+
+        with self._cond:
+            if conn.closed or len(self._idle) >= self.size or os.getpid() != self.pid:
+                self._drop(conn)
+                return
+            conn._returned_at = time.time()
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            while self._idle:
+                self._drop(self._idle.pop())
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                "size": self.size,
+                "max_overflow": self.max_overflow,
+                "open": self._open,
+                "idle": len(self._idle),
+                "checked_out": self._open - len(self._idle),
+                "overflow_in_use": max(0, self._open - self.size),
+                "statement_timeout_ms": self.statement_timeout_ms,
+            })
+        stats["wait_sec"] = round(stats["wait_sec"], 4)
+        return stats
+
+
+_pool: Optional[DBConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_db_pool() -> DBConnectionPool:
+    """The pool of this process; a forked child gets a fresh one instead of sharing sockets."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = DBConnectionPool()
+        return _pool
+
+
+def get_pooled_connection() -> PooledConnection:
+    return get_db_pool().getconn()
+
+
+def get_db_pool_stats() -> Dict[str, Any]:
+    return get_db_pool().stats()
@@ -0,0 +1,118 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+# ==============================================================================
+#  CROSS-REQUEST MICRO-BATCHING
+# ==============================================================================
+# Concurrent callers (e.g. /encode_embedding requests on Flask's threads) submit
+# single items; one scheduler thread collects them for up to EMBED_BATCH_MAX_WAIT_MS
+# or EMBED_BATCH_MAX_SIZE items, groups them by key (items of one group can share
+# a forward pass), sorts each group by length so padded sub-batches hold texts of
+# similar length, runs the group once and fans the results back out.
+# Kept free of util.py imports so it can be used from any module.
+
+EMBED_BATCHING_ENABLED = os.getenv("EMBED_BATCHING_ENABLED", "true").lower() == "true"
+EMBED_BATCH_MAX_WAIT_MS = float(os.getenv("EMBED_BATCH_MAX_WAIT_MS", "5"))
+EMBED_BATCH_MAX_SIZE = int(os.getenv("EMBED_BATCH_MAX_SIZE", "64"))
+
+
+class MicroBatchScheduler:
+    """
+    Coalesces concurrent submissions into batched calls of
+    `run_group(key, items) -> results` (one result per item, same order).
+    """
+
+    def __init__(self, run_group: Callable[[Hashable, List[Any]], Sequence[Any]],
+                 max_wait_ms: float = EMBED_BATCH_MAX_WAIT_MS,
+                 max_batch: int = EMBED_BATCH_MAX_SIZE,
+                 sort_key: Optional[Callable[[Any], int]] = None,
+                 name: str = "micro-batch"):
+        self.run_group = run_group
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.max_batch = max(1, max_batch)
+        self.sort_key = sort_key
+        self.name = name
+        self.pid = os.getpid()
+
+        self._queue: "queue.Queue[Tuple[Hashable, Any, Future]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {"items": 0, "batches": 0, "groups": 0, "max_batch_seen": 0, "errors": 0, "run_sec": 0.0}
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive() and self.pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive() or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self._thread.start()
+
+    def submit(self, key: Hashable, item: Any) -> Future:
+        self._ensure_started()
+        future = Future()
+        self._queue.put((key, item, future))
+        return future
+
+    def run(self, key: Hashable, items: Sequence[Any], timeout: Optional[float] = None) -> List[Any]:
+        """Submits every item and blocks until all results are in; re-raises the first error."""
+        futures = [self.submit(key, item) for item in items]
+        return [future.result(timeout=timeout) for future in futures]
+
+    def _collect(self) -> List[Tuple[Hashable, Any, Future]]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            groups: Dict[Hashable, List[Tuple[Any, Future]]] = {}
+            for key, item, future in batch:
+                if future.set_running_or_notify_cancel():
+                    groups.setdefault(key, []).append((item, future))
+
+            start = time.time()
+            for key, entries in groups.items():
+                if self.sort_key is not None:
+                    entries.sort(key=lambda entry: self.sort_key(entry[0]))
+                try:
+                    results = self.run_group(key, [item for item, _ in entries])
+                    if len(results) != len(entries):
+                        raise RuntimeError(f"{self.name}: expected {len(entries)} results, got {len(results)}")
+                except BaseException as e:
+                    with self._stats_lock:
+                        self._stats["errors"] += 1
+                    for _, future in entries:
+                        future.set_exception(e)
+                    continue
+                for (_, future), result in zip(entries, results):
+                    future.set_result(result)
+
+            with self._stats_lock:
+                self._stats["items"] += len(batch)
+                self._stats["batches"] += 1
+                self._stats["groups"] += len(groups)
+                self._stats["max_batch_seen"] = max(self._stats["max_batch_seen"], len(batch))
+                self._stats["run_sec"] += time.time() - start
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["run_sec"] = round(stats["run_sec"], 4)
+        stats["avg_batch"] = round(stats["items"] / stats["batches"], 2) if stats["batches"] else 0
+        stats["queued"] = self._queue.qsize()
+        stats["max_wait_ms"] = self.max_wait * 1000.0
+        stats["max_batch"] = self.max_batch
+        return stats
@@ -0,0 +1,186 @@
+import collections
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from utils.vectors import to_float32
+
+# ==============================================================================
+#  TWO-TIER EMBEDDING CACHE
+# ==============================================================================
+# Text embeddings are deterministic for a given model, task and output size, so
+# they are cached under (model id, task, is_query, target_dimensions, sha256(text)):
+#   tier 1: in-process LRU bounded by EMBED_CACHE_MAX_BYTES of vector data;
+#   tier 2: optional SQLite file (EMBED_CACHE_DISK_PATH) shared by the API and
+#           ingest worker processes of a node and kept across restarts.
+# Vectors are returned as read-only float32 arrays shared between callers.
+# Kept free of util.py imports so it can be used from any module.
+
+EMBED_CACHE_ENABLED = os.getenv("EMBED_CACHE_ENABLED", "true").lower() == "true"
+EMBED_CACHE_MAX_BYTES = int(os.getenv("EMBED_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+EMBED_CACHE_DISK_PATH = os.getenv("EMBED_CACHE_DISK_PATH", "")  # empty disables the disk tier
+
+
+def embedding_cache_key(model_id: str, task: str, is_query: bool, target_dimensions: int, text: str) -> str:
+    text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return f"{model_id}|{task}|{int(bool(is_query))}|{target_dimensions}|{text_hash}"
+
+
+class EmbeddingCache:
+    def __init__(self, max_bytes: int = EMBED_CACHE_MAX_BYTES, disk_path: str = EMBED_CACHE_DISK_PATH,
+                 enabled: bool = EMBED_CACHE_ENABLED):
+        self.enabled = enabled
+        self.max_bytes = max(0, max_bytes)
+        self.disk_path = disk_path
+        self._entries: "collections.OrderedDict[str, np.ndarray]" = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk: Optional[sqlite3.Connection] = None
+        self._disk_lock = threading.Lock()
+        self._disk_pid = None
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "disk_errors": 0}
+
+    # --- disk tier -----------------------------------------------------------
+
+    def _disk_conn(self) -> Optional[sqlite3.Connection]:
+        # Called with _disk_lock held; one connection per process
+        if not self.disk_path:
+            return None
+        if self._disk is None or self._disk_pid != os.getpid():
+            directory = os.path.dirname(self.disk_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.disk_path, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            self._disk, self._disk_pid = conn, os.getpid()
+        return self._disk
+
+    def _disk_get(self, key: str) -> Optional[np.ndarray]:
+        if not self.disk_path:
+            return None
+        try:
+            with self._disk_lock:
+                conn = self._disk_conn()
+                row = conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            self._disk_failed(e)
+            return None
+        return np.frombuffer(row[0], dtype="<f4").astype(np.float32) if row else None
+
+    def _disk_put(self, items: Sequence[tuple]):
+        if not self.disk_path or not items:
+            return
+        try:
+            with self._disk_lock:
+                conn = self._disk_conn()
+                conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(key, vector.astype("<f4", copy=False).tobytes()) for key, vector in items],
+                )
+                conn.commit()
+        except sqlite3.Error as e:
+            self._disk_failed(e)
+
+    def _disk_failed(self, error: Exception):
+        with self._lock:
+            self._stats["disk_errors"] += 1
+        print(f"⚠️ Embedding disk cache error ({self.disk_path}): {error}")
+
+    # --- memory tier ---------------------------------------------------------
+
+    def _remember(self, key: str, vector: np.ndarray):
+        # Called with _lock held
+        size = vector.nbytes
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old.nbytes
+        self._entries[key] = vector
+        self._bytes += size
+        while self._bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+            self._stats["evictions"] += 1
+
+    @staticmethod
+    def _freeze(vector: Any) -> np.ndarray:
+        vector = np.array(to_float32(vector), copy=True)
+        vector.flags.writeable = False
+        return vector
+
+    # --- public API ----------------------------------------------------------
+
+    def get(self, key: str, count_miss: bool = True) -> Optional[np.ndarray]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return vector
+
+        vector = self._disk_get(key)
+        with self._lock:
+            if vector is None:
+                if count_miss:
+                    self._stats["misses"] += 1
+                return None
+            vector = self._freeze(vector)
+            self._stats["disk_hits"] += 1
+            self._remember(key, vector)
+        return vector
+
+    def put(self, key: str, vector: Any) -> np.ndarray:
+        """Stores the vector and returns the cached (read-only) copy."""
+        return self.put_many([(key, vector)])[0]
+
+    def put_many(self, items: Sequence[tuple]) -> List[np.ndarray]:
+        frozen = [(key, self._freeze(vector)) for key, vector in items]
+        if not self.enabled:
+            return [vector for _, vector in frozen]
+        with self._lock:
+            for key, vector in frozen:
+                self._remember(key, vector)
+            self._stats["stores"] += len(frozen)
+        self._disk_put(frozen)
+        return [vector for _, vector in frozen]
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any]) -> np.ndarray:
+        vector = self.get(key)
+        if vector is None:
+            vector = self.put(key, compute())
+        return vector
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "disk_path": self.disk_path or None,
+            })
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+
+text_embedding_cache = EmbeddingCache()
+
+
+def get_embedding_cache_stats() -> Dict[str, Any]:
+    return text_embedding_cache.stats()
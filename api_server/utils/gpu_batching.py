@@ -0,0 +1,220 @@
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+# ==============================================================================
+#  ADAPTIVE GPU BATCH SIZING
+# ==============================================================================
+# Local embedding models are run with the largest batch that fits the GPU.
+# The size is learned per (model, input resolution bucket): optionally probed at
+# warmup by doubling until CUDA runs out of memory, grown at run time after
+# GPU_BATCH_GROW_AFTER OOM-free full batches (doubled up to GPU_BATCH_MAX, or
+# halfway to the smallest size that ran out of memory), and lowered whenever a
+# batch OOMs, in which case the batch is split in halves and retried instead of
+# failing the document.
+# So every bucket, probed or not, climbs to the largest size that fits.
+# Learned sizes live for the lifetime of the process.
+# Kept free of util.py imports so it can be used from any module.
+
+GPU_BATCH_INITIAL = int(os.getenv("GPU_BATCH_INITIAL", "4"))        # size used before anything is learned
+GPU_BATCH_MAX = int(os.getenv("GPU_BATCH_MAX", "64"))               # upper bound of probing and growth
+GPU_BATCH_GROW_AFTER = int(os.getenv("GPU_BATCH_GROW_AFTER", "8"))  # OOM-free full batches before doubling (0 = never)
+GPU_BATCH_PROBE_AT_STARTUP = os.getenv("GPU_BATCH_PROBE_AT_STARTUP", "false").lower() == "true"
+GPU_BATCH_PROBE_SIZES = os.getenv("GPU_BATCH_PROBE_SIZES", "850x1100")  # page sizes (px) probed at warmup
+GPU_RESOLUTION_BUCKET = int(os.getenv("GPU_RESOLUTION_BUCKET", "256"))  # px granularity of the resolution key
+
+_learned: Dict[Tuple[str, str], int] = {}
+_oom_sizes: Dict[Tuple[str, str], int] = {}   # smallest batch size that ran out of memory
+_fit_sizes: Dict[Tuple[str, str], int] = {}   # largest batch size that fit (below the OOM size)
+_clean_batches: Dict[Tuple[str, str], int] = {}  # full batches since the last change of size
+_lock = threading.Lock()
+_stats = {"batches": 0, "items": 0, "oom_splits": 0, "growths": 0, "probes": 0, "gpu_sec": 0.0}
+
+
+def is_oom_error(error: BaseException) -> bool:
+    """CUDA (or MPS/CPU allocator) out-of-memory, however the model wrapped it."""
+    oom_type = getattr(torch.cuda, "OutOfMemoryError", None)
+    if oom_type is not None and isinstance(error, oom_type):
+        return True
+    return "out of memory" in str(error).lower()
+
+
+def _release_gpu_memory():
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def resolution_bucket(images: Sequence[Any]) -> str:
+    """'WxH' of the largest image, rounded up to GPU_RESOLUTION_BUCKET pixels."""
+    width = max((getattr(img, "width", 0) for img in images), default=0)
+    height = max((getattr(img, "height", 0) for img in images), default=0)
+    step = max(1, GPU_RESOLUTION_BUCKET)
+    return f"{-(-width // step) * step}x{-(-height // step) * step}"
+
+
+def get_batch_size(model_name: str, bucket: str) -> int:
+    with _lock:
+        return _learned.get((model_name, bucket), GPU_BATCH_INITIAL)
+
+
+def get_learned_batch_size(model_name: str, default: int) -> int:
+    """Largest size learned for any resolution of the model, `default` when none is known yet."""
+    with _lock:
+        sizes = [size for (name, _), size in _learned.items() if name == model_name]
+    return max(sizes) if sizes else default
+
+
+def _set_batch_size(model_name: str, bucket: str, size: int):
+    with _lock:
+        _learned[(model_name, bucket)] = max(1, min(size, GPU_BATCH_MAX))
+        _clean_batches.pop((model_name, bucket), None)
+
+
+def _record_oom(model_name: str, bucket: str, failed_size: int):
+    key = (model_name, bucket)
+    with _lock:
+        _oom_sizes[key] = min(failed_size, _oom_sizes.get(key, failed_size))
+        if _fit_sizes.get(key, 0) >= failed_size:
+            _fit_sizes.pop(key)
+        # Back to the largest size known to fit, or half of the one that failed
+        _learned[key] = max(1, min(max(failed_size // 2, _fit_sizes.get(key, 0)), GPU_BATCH_MAX))
+        _clean_batches.pop(key, None)
+        _stats["oom_splits"] += 1
+
+
+def _record_success(model_name: str, bucket: str, batch_len: int) -> int:
+    """
+    Counts a batch that fit; after GPU_BATCH_GROW_AFTER full ones the learned
+    size doubles, or moves halfway to the smallest size that ran out of memory
+    once one is known, capped by GPU_BATCH_MAX. Returns the (possibly grown) size.
+    """
+    key = (model_name, bucket)
+    with _lock:
+        size = _learned.get(key, GPU_BATCH_INITIAL)
+        if batch_len > _fit_sizes.get(key, 0) and batch_len < _oom_sizes.get(key, GPU_BATCH_MAX + 1):
+            _fit_sizes[key] = batch_len
+        if GPU_BATCH_GROW_AFTER <= 0 or batch_len < size:
+            return size
+        _clean_batches[key] = _clean_batches.get(key, 0) + 1
+        oom_size = _oom_sizes.get(key)
+        grown = min(size * 2 if oom_size is None else (size + oom_size) // 2, GPU_BATCH_MAX)
+        if _clean_batches[key] < GPU_BATCH_GROW_AFTER or grown <= size:
+            return size
+        _learned[key] = grown
+        _clean_batches.pop(key, None)
+        _stats["growths"] += 1
+    print(f"📈 GPU batch size {size} -> {grown} ({model_name} @ {bucket})")
+    return grown
+
+
+def _rechunk(batches: List[List[Any]], size: int) -> List[List[Any]]:
+    items = [item for batch in batches for item in batch]
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def run_adaptive_batches(model_name: str, items: Sequence[Any],
+                         encode: Callable[[List[Any]], Sequence[Any]],
+                         bucket: Optional[str] = None) -> List[Any]:
+    """
+    Runs `encode` over `items` in batches of the learned size and returns the
+    concatenated per-item results in input order.
+
+    On out-of-memory the failing batch is split in halves and retried, and the
+    learned size for (model_name, bucket) is lowered so later calls start there.
+    An OOM on a single item is re-raised. After GPU_BATCH_GROW_AFTER full
+    batches without one the size doubles, including for the remaining items.
+    """
+    items = list(items)
+    if not items:
+        return []
+    bucket = bucket or resolution_bucket(items)
+    size = get_batch_size(model_name, bucket)
+
+    results: List[Any] = []
+    pending = _rechunk([items], size)
+    while pending:
+        batch = pending.pop(0)
+        start = time.time()
+        try:
+            with torch.no_grad():
+                output = encode(batch)
+        except Exception as e:
+            if not is_oom_error(e) or len(batch) == 1:
+                raise
+            _release_gpu_memory()
+            half = (len(batch) + 1) // 2
+            _record_oom(model_name, bucket, len(batch))
+            print(f"⚠️ GPU out of memory at batch size {len(batch)} ({model_name} @ {bucket}), splitting")
+            size = get_batch_size(model_name, bucket)
+            pending = [batch[:half], batch[half:]] + _rechunk(pending, size)
+            continue
+        results.extend(output)
+        with _lock:
+            _stats["batches"] += 1
+            _stats["items"] += len(batch)
+            _stats["gpu_sec"] += time.time() - start
+        grown = _record_success(model_name, bucket, len(batch))
+        if grown != size:
+            # Re-chunk what is left at the new size
+            size = grown
+            pending = _rechunk(pending, size)
+    return results
+
+
+def probe_batch_size(model_name: str, bucket: str, make_items: Callable[[int], List[Any]],
+                     encode: Callable[[List[Any]], Sequence[Any]],
+                     max_size: int = GPU_BATCH_MAX) -> int:
+    """
+    Doubles the batch size from 1 until `encode` runs out of memory or max_size
+    is reached, and records the largest size that worked.
+    """
+    best = 0
+    size = 1
+    while size <= max_size:
+        try:
+            with torch.no_grad():
+                encode(make_items(size))
+            best = size
+        except Exception as e:
+            if not is_oom_error(e):
+                raise
+            break
+        finally:
+            _release_gpu_memory()
+        size *= 2
+    best = max(1, best)
+    _set_batch_size(model_name, bucket, best)
+    with _lock:
+        _fit_sizes[(model_name, bucket)] = best
+        if size <= max_size:
+            # Stopped by an OOM: run-time growth stays below that size
+            _oom_sizes[(model_name, bucket)] = size
+    with _lock:
+        _stats["probes"] += 1
+    print(f"📏 Batch size for {model_name} @ {bucket}: {best}")
+    return best
+
+
+def parse_probe_sizes(spec: str = GPU_BATCH_PROBE_SIZES) -> List[Tuple[int, int]]:
+    """'850x1100,425x550' -> [(850, 1100), (425, 550)]"""
+    sizes = []
+    for part in spec.split(","):
+        if "x" in part:
+            width, height = part.lower().split("x", 1)
+            sizes.append((int(width), int(height)))
+    return sizes
+
+
+def get_gpu_batch_stats() -> Dict[str, Any]:
+    with _lock:
+        stats = dict(_stats)
+        stats["learned"] = {f"{name}@{bucket}": size for (name, bucket), size in _learned.items()}
+        stats["oom_at"] = {f"{name}@{bucket}": size for (name, bucket), size in _oom_sizes.items()}
+    stats["gpu_sec"] = round(stats["gpu_sec"], 4)
+    stats["initial"] = GPU_BATCH_INITIAL
+    stats["max"] = GPU_BATCH_MAX
+    stats["grow_after"] = GPU_BATCH_GROW_AFTER
+    return stats
@@ -0,0 +1,311 @@
+import io
+import time
+from typing import Any, Dict, List, Optional
+
+from PIL import Image
+
+from utils.util import (
+    LOCAL,
+    clear_gpu,
+    copy_file_embeddings,
+    encode_texts_for_embedding,
+    extract_docx_text,
+    extract_excel_text,
+    extract_image_text,
+    extract_pdf_text,
+    extract_pptx_text,
+    extract_txt_file,
+    extract_xls_text,
+    get_embedding_token_counter,
+    get_file_from_minio,
+    get_image_embedding_jinna_api,
+    get_image_embedding_jinna_api_local,
+    EmbeddingBulkWriter,
+)
+from utils.chat_vector_cache import invalidate_chat_vectors
+from utils.chunking import chunk_text
+from utils.gpu_batching import get_learned_batch_size
+from utils.ingest_pipeline import INGEST_EMBED_BATCH_SIZE, run_page_pipeline
+from utils.job_queue import PageCheckpoint, PermanentIngestError, find_indexed_duplicate
+from utils.office_convert import convert_office_to_pdf, is_office_document
+from utils.pdf_render import RawPageImage, open_pdf_document
+from utils.render_pool import iter_pdf_pages_pooled
+
+# ==============================================================================
+#  INGESTION HANDLERS (run by ingest workers, see utils/job_queue.py)
+# ==============================================================================
+# These hold the processing that /process and /processDocument used to run
+# inline. Each handler raises on failure so the queue can retry the job, or
+# PermanentIngestError when retrying cannot help.
+
+# PDFs with more pages than this are indexed page-by-page as images (/process)
+PAGE_IMAGE_MIN_PAGES = 5
+
+
+def extract_file_text(file_name: str, file_bytes: bytes) -> str:
+    """Picks the text extractor from the file extension."""
+    file_stream = io.BytesIO(file_bytes)  # Use BytesIO for extractor functions
+    file_stream.filename = file_name
+
+    lower_name = file_name.lower()
+    if lower_name.endswith('.pdf'):
+        return extract_pdf_text(file_stream)
+    elif lower_name.endswith(('.png', '.jpg', '.jpeg', '.tiff', '.bmp', '.gif')):
+        return extract_image_text(file_stream)
+    elif lower_name.endswith(('.docx', '.doc', '.odt', '.rtf')):
+        return extract_docx_text(file_stream)
+    elif lower_name.endswith(('.pptx', '.ppt')):
+        return extract_pptx_text(file_stream)
+    elif lower_name.endswith(('.xlsx', '.xlsm')):
+        return extract_excel_text(file_stream)
+    elif lower_name.endswith('.xls'):
+        return extract_xls_text(file_stream)
+    # Default to TXT extractor
+    return extract_txt_file(file_stream)
+
+
+def embed_page_images(image_bytes_batch: List[bytes]) -> Optional[List[Any]]:
+    """Embeds page images with the local Jina model (float32 arrays) or the Jina API (lists)."""
+    if LOCAL:
+        return get_image_embedding_jinna_api_local(image_bytes_list=image_bytes_batch)
+    return get_image_embedding_jinna_api(image_bytes_list=image_bytes_batch)
+
+
+def index_text_chunks(user_id: int, chat_history_id: int, uploaded_file_id: int,
+                      file_name: str, text: str) -> int:
+    """
+    Splits text into page-aware, overlapping chunks, embeds them in batches and
+    saves one 'document_embeddings' row per chunk. Returns the number of chunks.
+    """
+    chunks = chunk_text(text, count_tokens=get_embedding_token_counter())
+    if not chunks:
+        raise PermanentIngestError(f"No text extracted from {file_name}")
+
+    vectors = encode_texts_for_embedding([chunk["text"] for chunk in chunks])
+    if len(vectors) != len(chunks):
+        raise RuntimeError(f"Failed to embed text of {file_name}: expected {len(chunks)} vectors, got {len(vectors)}")
+    print(f"✅ {len(chunks)} chunks embedded for {file_name}")
+
+    with EmbeddingBulkWriter(uploaded_file_id) as writer:
+        writer.add_texts(user_id, chat_history_id, [
+            (chunk["text"], vector, chunk["page_number"]) for chunk, vector in zip(chunks, vectors)
+        ])
+    return len(chunks)
+
+
+def index_text_file(user_id: int, chat_history_id: int, uploaded_file_id: int,
+                    file_name: str, file_bytes: bytes) -> Dict[str, Any]:
+    """Legacy text path: extract the text, chunk and embed it, save to 'document_embeddings'."""
+    file_text = extract_file_text(file_name, file_bytes)
+    if not file_text or not file_text.strip():
+        raise PermanentIngestError(f"No text extracted from {file_name}")
+    print(f"✅ Text extracted: {len(file_text)} characters")
+
+    chunk_count = index_text_chunks(user_id, chat_history_id, uploaded_file_id, file_name, file_text)
+    return {"name": file_name, "status": "indexed_as_text", "chunks": chunk_count}
+
+
+def index_page_images(user_id: int, chat_history_id: int, uploaded_file_id: int,
+                      file_name: str, pages_to_embed: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Embeds rendered pages and saves them to 'document_page_embeddings'."""
+    if not pages_to_embed:
+        raise PermanentIngestError(f"No pages extracted from {file_name}")
+
+    print(f"  - Sending {len(pages_to_embed)} images to embedding model in one batch...")
+    embeddings_list = embed_page_images([page['img_bytes'] for page in pages_to_embed])
+    if not embeddings_list or len(embeddings_list) != len(pages_to_embed):
+        raise RuntimeError(
+            f"Failed to get embeddings or count mismatch. Expected {len(pages_to_embed)}, "
+            f"Got {len(embeddings_list) if embeddings_list else 0}."
+        )
+
+    print(f"  - Received {len(embeddings_list)} embeddings. Saving to DB...")
+    with EmbeddingBulkWriter(uploaded_file_id) as writer:
+        writer.add_pages(user_id, chat_history_id, [
+            (page_data['page_num_1_idx'], img_embedding)
+            for page_data, img_embedding in zip(pages_to_embed, embeddings_list)
+        ])
+    return {"name": file_name, "status": "indexed_as_images", "pages": len(embeddings_list)}
+
+
+def _raw_page_to_image(raw: RawPageImage) -> Image.Image:
+    # Wraps the rendered pixels without a PNG encode/decode round trip
+    return Image.frombuffer(raw.mode, (raw.width, raw.height), raw.data, "raw", raw.mode, 0, 1)
+
+
+def index_pdf_pages_streaming(user_id: int, chat_history_id: int, uploaded_file_id: int,
+                              file_name: str, file_bytes: bytes, dpi: int,
+                              checkpoint: PageCheckpoint,
+                              n_pages: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Page-image path for PDFs: renders, decodes, embeds and saves pages as a
+    stream (see utils/ingest_pipeline.py) into 'document_page_embeddings'.
+
+    Embedded pages are committed to the job's checkpoint batch by batch, and pages
+    finished by an earlier attempt of the job are neither rendered nor embedded again.
+    """
+    if n_pages is None:
+        n_pages = open_pdf_document(file_bytes).page_count
+    done_pages = checkpoint.completed_pages()
+    todo_pages_0_idx = [page_num_0_idx for page_num_0_idx in range(n_pages) if page_num_0_idx + 1 not in done_pages]
+    if done_pages:
+        print(f"⏩ Resuming '{file_name}': {len(done_pages)}/{n_pages} pages already embedded")
+    checkpoint.report(pages=n_pages, resumed=len(done_pages))
+
+    render_timings = {}
+    pages = iter_pdf_pages_pooled(
+        file_bytes, dpi=dpi,
+        page_numbers_0_idx=todo_pages_0_idx,
+        timings=render_timings,
+        # Pixels stay in-process for the local model; the Jina API needs an encoded image
+        image_format="raw" if LOCAL else "png",
+    ) if todo_pages_0_idx else []
+
+    if LOCAL:
+        preprocess = _raw_page_to_image
+        embed_batch = lambda images: get_image_embedding_jinna_api_local(pil_images=images)
+        # Feed the GPU micro-batches as large as the batch size it was found to take
+        batch_size = max(INGEST_EMBED_BATCH_SIZE, get_learned_batch_size("jinaai/jina-embeddings-v4", 0))
+    else:
+        preprocess = lambda img_bytes: img_bytes
+        embed_batch = lambda images: get_image_embedding_jinna_api(image_bytes_list=images)
+        batch_size = INGEST_EMBED_BATCH_SIZE
+
+    # Batches land in the checkpoint table, then all pages are published at once
+    pipeline_stats = run_page_pipeline(pages, preprocess, embed_batch, store_batch=checkpoint.save_pages,
+                                       batch_size=batch_size)
+    with EmbeddingBulkWriter(uploaded_file_id) as writer:
+        stored = writer.add_pages_from_checkpoints(user_id, chat_history_id)
+        if not stored:
+            raise PermanentIngestError(f"No pages extracted from {file_name}")
+    checkpoint.report(stored=stored)
+    return {
+        "name": file_name,
+        "status": "indexed_as_images",
+        "pages": stored,
+        "resumed_pages": len(done_pages),
+        "render_timings": render_timings,
+        "pipeline": pipeline_stats,
+    }
+
+
+def ingest_chat_file(user_id: int, chat_history_id: int, uploaded_file_id: int,
+                     file_name: str, file_bytes: bytes, options: Dict[str, Any],
+                     checkpoint: PageCheckpoint) -> Dict[str, Any]:
+    """
+    /process: short files are indexed as text into 'document_embeddings',
+    PDFs (and office documents converted to PDF) over PAGE_IMAGE_MIN_PAGES
+    pages are indexed page-by-page as images.
+    """
+    n_pages = 1  # Default for non-PDF files
+    pdf_bytes = None
+    if file_name.lower().endswith('.pdf'):
+        pdf_bytes = file_bytes
+    elif is_office_document(file_name):
+        pdf_bytes = convert_office_to_pdf(file_bytes, file_name)
+    if pdf_bytes:
+        n_pages = open_pdf_document(pdf_bytes).page_count
+
+    if n_pages <= PAGE_IMAGE_MIN_PAGES:
+        print(f"Processing '{file_name}' in legacy_text mode...")
+        return index_text_file(user_id, chat_history_id, uploaded_file_id, file_name, file_bytes)
+
+    print(f"Processing '{file_name}' in new_page_image mode ({n_pages} pages)...")
+    return index_pdf_pages_streaming(user_id, chat_history_id, uploaded_file_id, file_name, pdf_bytes,
+                                     dpi=100, n_pages=n_pages, checkpoint=checkpoint)
+
+
+def ingest_knowledge_file(user_id: int, chat_history_id: int, uploaded_file_id: int,
+                          file_name: str, file_bytes: bytes, options: Dict[str, Any],
+                          checkpoint: PageCheckpoint) -> Dict[str, Any]:
+    """/processDocument: 'image' method embeds pages/images, 'text' method embeds extracted text."""
+    method = options.get('method', 'text')
+    if method != 'image':
+        print(f"Processing '{file_name}' via Legacy Text method...")
+        return index_text_file(user_id, chat_history_id, uploaded_file_id, file_name, file_bytes)
+
+    print(f"Processing '{file_name}' via VLM/Image method...")
+    if file_name.lower().endswith('.pdf'):
+        return index_pdf_pages_streaming(user_id, chat_history_id, uploaded_file_id, file_name, file_bytes,
+                                         dpi=50, checkpoint=checkpoint)
+    if is_office_document(file_name):
+        pdf_bytes = convert_office_to_pdf(file_bytes, file_name)
+        if not pdf_bytes:
+            raise RuntimeError(f"Could not convert {file_name} to PDF")
+        return index_pdf_pages_streaming(user_id, chat_history_id, uploaded_file_id, file_name, pdf_bytes,
+                                         dpi=50, checkpoint=checkpoint)
+
+    if not file_name.lower().endswith(('.png', '.jpg', '.jpeg', '.webp')):
+        raise PermanentIngestError(f"Unsupported file type for the image method: {file_name}")
+    pages_to_embed = [{"page_num_1_idx": 1, "img_bytes": file_bytes}]
+    return index_page_images(user_id, chat_history_id, uploaded_file_id, file_name, pages_to_embed)
+
+
+def ingest_knowledge_text(user_id: int, chat_history_id: int, uploaded_file_id: int,
+                          file_name: str, file_bytes: bytes, options: Dict[str, Any],
+                          checkpoint: PageCheckpoint) -> Dict[str, Any]:
+    """/processDocument with raw text input and no files."""
+    text_input = file_bytes.decode('utf-8', errors='ignore')
+    method = options.get('method', 'text')
+
+    if method == 'image':
+        # Reuse the image embedding function which handles text input via HyDE
+        if LOCAL:
+            embedding = get_image_embedding_jinna_api_local(text=text_input)
+        else:
+            embedding = get_image_embedding_jinna_api(text=text_input)
+        if embedding is None or len(embedding) == 0:
+            raise RuntimeError("Failed to embed raw text input")
+        with EmbeddingBulkWriter(uploaded_file_id) as writer:
+            writer.add_pages(user_id, chat_history_id, [(1, embedding)])
+        return {"name": "Raw Text", "status": "indexed_as_multimodal_text"}
+
+    chunk_count = index_text_chunks(user_id, chat_history_id, uploaded_file_id, "Raw Text Input", text_input)
+    return {"name": "Raw Text", "status": "indexed_as_legacy_text", "chunks": chunk_count}
+
+
+INGEST_HANDLERS = {
+    'process': ingest_chat_file,
+    'processDocument': ingest_knowledge_file,
+    'processText': ingest_knowledge_text,
+}
+
+
+def run_ingest_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Queue handler: reuses the embeddings of an identical, already indexed file when
+    there is one, otherwise fetches the uploaded object from MinIO and dispatches on job['kind'].
+    """
+    handler = INGEST_HANDLERS.get(job['kind'])
+    if handler is None:
+        raise PermanentIngestError(f"Unknown ingest job kind '{job['kind']}'")
+
+    # Same bytes already indexed the same way: copy the rows instead of re-running VLM/embeddings
+    source_file_id = find_indexed_duplicate(job)
+    if source_file_id:
+        copied = copy_file_embeddings(source_file_id, job['user_id'], job['chat_history_id'], job['uploaded_file_id'])
+        if copied:
+            invalidate_chat_vectors(job['user_id'], job['chat_history_id'])
+            return {"name": job['file_name'], "status": "deduplicated", "source_file_id": source_file_id, "rows": copied}
+
+    file_bytes = get_file_from_minio(job['object_name'])
+    if not file_bytes:
+        raise RuntimeError(f"Object '{job['object_name']}' not found in MinIO")
+
+    start_process = time.time()
+    clear_gpu()
+    try:
+        return handler(
+            user_id=job['user_id'],
+            chat_history_id=job['chat_history_id'],
+            uploaded_file_id=job['uploaded_file_id'],
+            file_name=job['file_name'],
+            file_bytes=file_bytes,
+            options=job.get('options') or {},
+            checkpoint=PageCheckpoint(job['id'], job['uploaded_file_id']),
+        )
+    finally:
+        # New rows (or a partial, failed attempt) for this chat: drop its cached search matrices
+        invalidate_chat_vectors(job['user_id'], job['chat_history_id'])
+        clear_gpu()
+        print(f"Process time: {time.time() - start_process} sec")
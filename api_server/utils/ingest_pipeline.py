@@ -0,0 +1,208 @@
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+# ==============================================================================
+#  STREAMING PAGE INGEST PIPELINE
+# ==============================================================================
+# render -> preprocess -> embed (micro-batches) -> store, one thread per stage,
+# connected by bounded queues. A large document streams through with a constant
+# number of pages in memory, and the GPU embeds batch N while the render pool is
+# already producing the pages of batch N+1.
+
+INGEST_RENDER_QUEUE_DEPTH = int(os.getenv("INGEST_RENDER_QUEUE_DEPTH", "16"))      # rendered pages waiting for preprocess
+INGEST_PREPROCESS_QUEUE_DEPTH = int(os.getenv("INGEST_PREPROCESS_QUEUE_DEPTH", "16"))  # preprocessed pages waiting for embed
+INGEST_STORE_QUEUE_DEPTH = int(os.getenv("INGEST_STORE_QUEUE_DEPTH", "4"))         # embedded batches waiting for insert
+INGEST_EMBED_BATCH_SIZE = int(os.getenv("INGEST_EMBED_BATCH_SIZE", "8"))
+
+_DONE = object()
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+class _Stage:
+    """Book-keeping shared by the stage threads of one pipeline run."""
+
+    def __init__(self):
+        self.abort = threading.Event()
+        self.errors: List[BaseException] = []
+        self.busy_sec: Dict[str, float] = {"render": 0.0, "preprocess": 0.0, "embed": 0.0, "store": 0.0}
+        self.counts: Dict[str, int] = {"rendered": 0, "render_failed": 0, "embedded": 0, "stored": 0, "batches": 0}
+
+    def fail(self, error: BaseException):
+        self.errors.append(error)
+        self.abort.set()
+
+    def put(self, q: "queue.Queue", item):
+        # Blocking put that gives up when another stage failed
+        while True:
+            if self.abort.is_set():
+                if item is _DONE:
+                    return  # downstream stages stop on the abort flag
+                raise PipelineAborted()
+            try:
+                q.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def get(self, q: "queue.Queue"):
+        while True:
+            if self.abort.is_set():
+                raise PipelineAborted()
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+
+def run_page_pipeline(
+    pages: Iterable[Tuple[int, Optional[Any]]],
+    preprocess: Callable[[Any], Any],
+    embed_batch: Callable[[List[Any]], Optional[List[Any]]],
+    store_batch: Callable[[List[Tuple[int, Any]]], None],
+    batch_size: int = INGEST_EMBED_BATCH_SIZE,
+    render_queue_depth: int = INGEST_RENDER_QUEUE_DEPTH,
+    preprocess_queue_depth: int = INGEST_PREPROCESS_QUEUE_DEPTH,
+    store_queue_depth: int = INGEST_STORE_QUEUE_DEPTH,
+) -> Dict[str, Any]:
+    """
+    Streams pages through the four ingest stages.
+
+    Args:
+        pages: Iterable of (page_num_1_idx, rendered page or None when rendering failed),
+               e.g. render_pool.iter_pdf_pages_pooled(). Consumed on its own thread.
+        preprocess: Turns a rendered page into the embedding model's input.
+        embed_batch: Embeds a list of preprocessed inputs, returns one vector per input.
+        store_batch: Persists [(page_num_1_idx, embedding), ...].
+        batch_size: Micro-batch size of the embed stage.
+        *_queue_depth: Bounds of the queues between the stages.
+
+    Returns:
+        Per-stage counters and busy times. Raises the first stage error.
+    """
+    state = _Stage()
+    rendered_q = queue.Queue(maxsize=max(1, render_queue_depth))
+    preprocessed_q = queue.Queue(maxsize=max(1, preprocess_queue_depth))
+    embedded_q = queue.Queue(maxsize=max(1, store_queue_depth))
+    batch_size = max(1, batch_size)
+
+    def render_stage():
+        try:
+            iterator = iter(pages)
+            while True:
+                start = time.time()
+                try:
+                    page_num_1_idx, page = next(iterator)
+                except StopIteration:
+                    break
+                state.busy_sec["render"] += time.time() - start
+                if page is None:
+                    state.counts["render_failed"] += 1
+                    continue
+                state.counts["rendered"] += 1
+                state.put(rendered_q, (page_num_1_idx, page))
+        except PipelineAborted:
+            pass
+        except BaseException as e:
+            state.fail(e)
+        finally:
+            if hasattr(pages, "close"):
+                pages.close()
+            state.put(rendered_q, _DONE)
+
+    def preprocess_stage():
+        try:
+            while True:
+                item = state.get(rendered_q)
+                if item is _DONE:
+                    break
+                page_num_1_idx, page = item
+                start = time.time()
+                model_input = preprocess(page)
+                state.busy_sec["preprocess"] += time.time() - start
+                state.put(preprocessed_q, (page_num_1_idx, model_input))
+        except PipelineAborted:
+            pass
+        except BaseException as e:
+            state.fail(e)
+        finally:
+            state.put(preprocessed_q, _DONE)
+
+    def embed_stage():
+        try:
+            finished = False
+            while not finished:
+                batch = []
+                item = state.get(preprocessed_q)
+                if item is _DONE:
+                    break
+                batch.append(item)
+                # Fill the micro-batch with whatever is already waiting, never stall for more
+                while len(batch) < batch_size:
+                    try:
+                        item = preprocessed_q.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _DONE:
+                        finished = True
+                        break
+                    batch.append(item)
+
+                start = time.time()
+                embeddings = embed_batch([model_input for _, model_input in batch])
+                state.busy_sec["embed"] += time.time() - start
+                if not embeddings or len(embeddings) != len(batch):
+                    raise RuntimeError(
+                        f"Failed to get embeddings or count mismatch. Expected {len(batch)}, "
+                        f"Got {len(embeddings) if embeddings else 0}."
+                    )
+                state.counts["embedded"] += len(batch)
+                state.counts["batches"] += 1
+                state.put(embedded_q, [(page_num_1_idx, emb) for (page_num_1_idx, _), emb in zip(batch, embeddings)])
+        except PipelineAborted:
+            pass
+        except BaseException as e:
+            state.fail(e)
+        finally:
+            state.put(embedded_q, _DONE)
+
+    def store_stage():
+        try:
+            while True:
+                rows = state.get(embedded_q)
+                if rows is _DONE:
+                    break
+                start = time.time()
+                store_batch(rows)
+                state.busy_sec["store"] += time.time() - start
+                state.counts["stored"] += len(rows)
+        except PipelineAborted:
+            pass
+        except BaseException as e:
+            state.fail(e)
+
+    wall_start = time.time()
+    threads = [
+        threading.Thread(target=target, name=f"ingest-{name}", daemon=True)
+        for name, target in (("render", render_stage), ("preprocess", preprocess_stage),
+                             ("embed", embed_stage), ("store", store_stage))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if state.errors:
+        raise state.errors[0]
+
+    stats = dict(state.counts)
+    stats["busy_sec"] = {stage: round(sec, 4) for stage, sec in state.busy_sec.items()}
+    stats["wall_sec"] = round(time.time() - wall_start, 4)
+    stats["batch_size"] = batch_size
+    print(f"🚰 Ingest pipeline finished: {stats}")
+    return stats
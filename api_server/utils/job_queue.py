@@ -0,0 +1,522 @@
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from psycopg2.extras import Json, RealDictCursor, execute_values
+
+from utils.util import get_db_connection
+from utils.vectors import to_float32
+
+# ==============================================================================
+#  DURABLE INGESTION JOB QUEUE (table: ingest_jobs, see ai_agent_core/src/db.ts)
+# ==============================================================================
+# /process and /processDocument only upload the file and enqueue a job row.
+# Worker threads (embedded in model.py) or worker processes (ingest_worker.py,
+# possibly on other nodes) claim rows with FOR UPDATE SKIP LOCKED, so any number
+# of workers can drain the same queue without double-processing a job.
+
+INGEST_POLL_INTERVAL = float(os.getenv("INGEST_POLL_INTERVAL", "2"))
+INGEST_HEARTBEAT_INTERVAL = float(os.getenv("INGEST_HEARTBEAT_INTERVAL", "30"))
+# A running job whose heartbeat is older than this is considered orphaned
+# (worker crashed / node died) and becomes claimable again.
+INGEST_STALE_AFTER = int(os.getenv("INGEST_STALE_AFTER", "600"))
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", "3"))
+INGEST_RETRY_DELAY = int(os.getenv("INGEST_RETRY_DELAY", "30"))
+
+# uploaded_files.file_process_status values understood by the agent UI
+FILE_STATUS_PROCESS = "process"
+FILE_STATUS_FINISH = "finish"
+FILE_STATUS_ERROR = "error"
+
+
+class PermanentIngestError(ValueError):
+    """A failure that no retry can fix (nothing extractable, unsupported file); the job fails at once."""
+
+
+def make_worker_id(suffix: str = "") -> str:
+    """Builds a worker id that is unique across nodes and processes."""
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    if suffix:
+        worker_id += f":{suffix}"
+    return worker_id
+
+
+def _set_file_status(cur, uploaded_file_id: int, status: str):
+    cur.execute(
+        "UPDATE uploaded_files SET file_process_status = %s WHERE id = %s;",
+        (status, uploaded_file_id)
+    )
+
+
+def enqueue_ingest_job(kind: str, uploaded_file_id: int, user_id: int, chat_history_id: int,
+                       file_name: str, object_name: str, options: Optional[Dict[str, Any]] = None,
+                       max_attempts: int = INGEST_MAX_ATTEMPTS) -> Optional[int]:
+    """
+    Inserts a 'queued' job for an already uploaded file and marks the file as 'process'.
+
+    Args:
+        kind: Handler name, e.g. 'process', 'processDocument' or 'processText'.
+        options: Handler specific settings (method, processing_mode, ...), stored as JSONB.
+
+    Returns:
+        The new job id, or None on failure.
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        if not conn:
+            raise Exception("Could not connect to database")
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO ingest_jobs
+                (kind, uploaded_file_id, user_id, chat_history_id, file_name, object_name, options, max_attempts)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING id;
+            """,
+            (kind, uploaded_file_id, user_id, chat_history_id, file_name, object_name,
+             Json(options or {}), max_attempts)
+        )
+        job_id = cur.fetchone()[0]
+        _set_file_status(cur, uploaded_file_id, FILE_STATUS_PROCESS)
+        conn.commit()
+        cur.close()
+        print(f"📥 Queued ingest job {job_id} ({kind}) for '{file_name}' (file id {uploaded_file_id})")
+        return job_id
+    except Exception as e:
+        print(f"❌ Error enqueuing ingest job for '{file_name}': {e}")
+        if conn:
+            conn.rollback()
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+
+def claim_ingest_job(worker_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Atomically claims the oldest runnable job.
+
+    Queued jobs are claimable once their available_at has passed; running jobs are
+    reclaimed when their heartbeat is older than INGEST_STALE_AFTER seconds.
+    A stale job that was on its last attempt is marked 'error' (with its file)
+    instead, since no worker will finish or fail it anymore.
+    SKIP LOCKED lets concurrent workers pick different rows instead of blocking.
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        if not conn:
+            return None
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute(
+            """
+            UPDATE ingest_jobs
+            SET status = 'error', worker_id = NULL, finished_at = CURRENT_TIMESTAMP,
+                last_error = 'Worker stopped during the last attempt (heartbeat lapsed)'
+            WHERE id IN (
+                SELECT id FROM ingest_jobs
+                WHERE status = 'running'
+                  AND heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+                  AND attempts >= max_attempts
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, uploaded_file_id;
+            """,
+            (INGEST_STALE_AFTER,)
+        )
+        for abandoned in cur.fetchall():
+            print(f"❌ Ingest job {abandoned['id']} was abandoned on its last attempt, marking it failed")
+            _set_file_status(cur, abandoned['uploaded_file_id'], FILE_STATUS_ERROR)
+            cur.execute("DELETE FROM ingest_page_checkpoints WHERE uploaded_file_id = %s;",
+                        (abandoned['uploaded_file_id'],))
+
+        cur.execute(
+            """
+            UPDATE ingest_jobs
+            SET status = 'running',
+                attempts = attempts + 1,
+                worker_id = %s,
+                started_at = CURRENT_TIMESTAMP,
+                heartbeat_at = CURRENT_TIMESTAMP,
+                last_error = NULL
+            WHERE id = (
+                SELECT id FROM ingest_jobs
+                WHERE (status = 'queued' AND available_at <= CURRENT_TIMESTAMP)
+                   OR (status = 'running'
+                       AND heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+                       AND attempts < max_attempts)
+                ORDER BY id
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING id, kind, uploaded_file_id, user_id, chat_history_id,
+                      file_name, object_name, options, attempts, max_attempts, worker_id;
+            """,
+            (worker_id, INGEST_STALE_AFTER)
+        )
+        job = cur.fetchone()
+        if job:
+            _set_file_status(cur, job['uploaded_file_id'], FILE_STATUS_PROCESS)
+        conn.commit()
+        cur.close()
+        return dict(job) if job else None
+    except Exception as e:
+        print(f"❌ Error claiming ingest job: {e}")
+        if conn:
+            conn.rollback()
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+
+def heartbeat_ingest_job(job_id: int, worker_id: str) -> bool:
+    """Refreshes heartbeat_at so long running jobs are not reclaimed as stale."""
+    conn = None
+    try:
+        conn = get_db_connection()
+        if not conn:
+            return False
+        cur = conn.cursor()
+        cur.execute(
+            "UPDATE ingest_jobs SET heartbeat_at = CURRENT_TIMESTAMP "
+            "WHERE id = %s AND worker_id = %s AND status = 'running';",
+            (job_id, worker_id)
+        )
+        updated = cur.rowcount > 0
+        conn.commit()
+        cur.close()
+        return updated
+    except Exception as e:
+        print(f"⚠️ Heartbeat failed for ingest job {job_id}: {e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+
+def complete_ingest_job(job: Dict[str, Any], result: Optional[Dict[str, Any]] = None) -> bool:
+    """
+    Marks a job as done and its file as 'finish'. Does nothing (returns False)
+    when the job is no longer running under this worker, e.g. it was reclaimed
+    after its heartbeat lapsed.
+    """
+    updated = False
+    conn = None
+    try:
+        conn = get_db_connection()
+        if not conn:
+            raise Exception("Could not connect to database")
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE ingest_jobs
+            SET status = 'done', result = %s, finished_at = CURRENT_TIMESTAMP
+            WHERE id = %s AND worker_id = %s AND status = 'running';
+            """,
+            (Json(result or {}), job['id'], job['worker_id'])
+        )
+        updated = cur.rowcount > 0
+        if updated:
+            _set_file_status(cur, job['uploaded_file_id'], FILE_STATUS_FINISH)
+        else:
+            print(f"⚠️ Ingest job {job['id']} is no longer ours ({job['worker_id']}), result dropped")
+        conn.commit()
+        cur.close()
+    except Exception as e:
+        print(f"❌ Error completing ingest job {job['id']}: {e}")
+        if conn:
+            conn.rollback()
+    finally:
+        if conn:
+            conn.close()
+    return updated
+
+
+def fail_ingest_job(job: Dict[str, Any], error: str, retry: bool = True) -> bool:
+    """
+    Records a failed attempt. The job is re-queued with a delay while attempts
+    remain and `retry` is set, otherwise it is marked 'error' together with its file.
+    Does nothing (returns False) when the job is no longer running under this worker.
+    """
+    final = not retry or job['attempts'] >= job['max_attempts']
+    updated = False
+    conn = None
+    try:
+        conn = get_db_connection()
+        if not conn:
+            raise Exception("Could not connect to database")
+        cur = conn.cursor()
+        if final:
+            cur.execute(
+                """
+                UPDATE ingest_jobs
+                SET status = 'error', last_error = %s, finished_at = CURRENT_TIMESTAMP
+                WHERE id = %s AND worker_id = %s AND status = 'running';
+                """,
+                (error, job['id'], job['worker_id'])
+            )
+            updated = cur.rowcount > 0
+            if updated:
+                _set_file_status(cur, job['uploaded_file_id'], FILE_STATUS_ERROR)
+                # No retry will resume from them
+                cur.execute("DELETE FROM ingest_page_checkpoints WHERE uploaded_file_id = %s;", (job['uploaded_file_id'],))
+        else:
+            cur.execute(
+                """
+                UPDATE ingest_jobs
+                SET status = 'queued', last_error = %s, worker_id = NULL,
+                    available_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                WHERE id = %s AND worker_id = %s AND status = 'running';
+                """,
+                (error, INGEST_RETRY_DELAY * job['attempts'], job['id'], job['worker_id'])
+            )
+            updated = cur.rowcount > 0
+        if not updated:
+            print(f"⚠️ Ingest job {job['id']} is no longer ours ({job['worker_id']}), failure not recorded")
+        conn.commit()
+        cur.close()
+    except Exception as e:
+        print(f"❌ Error recording failure of ingest job {job['id']}: {e}")
+        if conn:
+            conn.rollback()
+    finally:
+        if conn:
+            conn.close()
+    return updated
+
+
+def find_indexed_duplicate(job: Dict[str, Any]) -> Optional[int]:
+    """
+    Returns the id of another file with the same content that a finished job of
+    the same kind and options already indexed, or None.
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        if not conn:
+            return None
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT src.id
+            FROM uploaded_files f
+            JOIN uploaded_files src
+              ON src.content_sha256 = f.content_sha256
+             AND src.file_size_bytes = f.file_size_bytes
+             AND src.id <> f.id
+            JOIN ingest_jobs j ON j.uploaded_file_id = src.id
+            WHERE f.id = %s
+              AND f.content_sha256 IS NOT NULL
+              AND j.kind = %s
+              AND j.options = %s
+              AND j.status = 'done'
+            ORDER BY j.finished_at DESC
+            LIMIT 1;
+            """,
+            (job['uploaded_file_id'], job['kind'], Json(job.get('options') or {}))
+        )
+        row = cur.fetchone()
+        cur.close()
+        return row[0] if row else None
+    except Exception as e:
+        print(f"⚠️ Duplicate lookup failed for job {job['id']}: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+
+def get_ingest_jobs(job_ids: List[int]) -> List[Dict[str, Any]]:
+    """Returns the public state of the given jobs (used by the /jobs status route)."""
+    if not job_ids:
+        return []
+    conn = None
+    try:
+        conn = get_db_connection()
+        if not conn:
+            return []
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute(
+            """
+            SELECT j.id AS job_id, j.kind, j.uploaded_file_id AS file_id, j.file_name,
+                   j.status, j.attempts, j.max_attempts, j.last_error, j.result, j.progress,
+                   j.created_at, j.started_at, j.finished_at,
+                   f.file_process_status
+            FROM ingest_jobs j
+            LEFT JOIN uploaded_files f ON f.id = j.uploaded_file_id
+            WHERE j.id = ANY(%s)
+            ORDER BY j.id;
+            """,
+            (list(job_ids),)
+        )
+        rows = []
+        for row in cur.fetchall():
+            row = dict(row)
+            for key in ('created_at', 'started_at', 'finished_at'):
+                if row[key] is not None:
+                    row[key] = row[key].isoformat()
+            rows.append(row)
+        cur.close()
+        return rows
+    except Exception as e:
+        print(f"❌ Error reading ingest jobs {job_ids}: {e}")
+        return []
+    finally:
+        if conn:
+            conn.close()
+
+
+class PageCheckpoint:
+    """
+    Per-page progress of one ingest job (table: ingest_page_checkpoints).
+
+    Each embedded batch is committed as soon as it is produced, so a job that is
+    retried after a crash or a reclaimed stale heartbeat only renders and embeds
+    the pages that are not checkpointed yet. The pages are published to
+    'document_page_embeddings' together, see EmbeddingBulkWriter.add_pages_from_checkpoints().
+    """
+
+    def __init__(self, job_id: int, uploaded_file_id: int):
+        self.job_id = job_id
+        self.uploaded_file_id = uploaded_file_id
+        self.progress: Dict[str, int] = {"pages": 0, "resumed": 0, "embedded": 0, "stored": 0}
+
+    def completed_pages(self) -> Set[int]:
+        """1-indexed page numbers that were already embedded by an earlier attempt."""
+        conn = None
+        try:
+            conn = get_db_connection()
+            if not conn:
+                return set()
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT page_number FROM ingest_page_checkpoints WHERE uploaded_file_id = %s;",
+                (self.uploaded_file_id,)
+            )
+            pages = {row[0] for row in cur.fetchall()}
+            cur.close()
+            return pages
+        except Exception as e:
+            # Resuming is an optimisation: without checkpoints every page is redone
+            print(f"⚠️ Could not read checkpoints of file {self.uploaded_file_id}: {e}")
+            return set()
+        finally:
+            if conn:
+                conn.close()
+
+    def save_pages(self, rows: List[Tuple[int, Any]]):
+        """Commits [(page_num_1_idx, embedding), ...]; raises so the pipeline aborts on failure."""
+        if not rows:
+            return
+        conn = get_db_connection()
+        if not conn:
+            raise Exception("Could not connect to database")
+        try:
+            cur = conn.cursor()
+            execute_values(
+                cur,
+                """
+                INSERT INTO ingest_page_checkpoints (uploaded_file_id, page_number, embedding)
+                VALUES %s
+                ON CONFLICT (uploaded_file_id, page_number) DO UPDATE SET embedding = EXCLUDED.embedding;
+                """,
+                [(self.uploaded_file_id, page_number, to_float32(embedding)) for page_number, embedding in rows]
+            )
+            self.progress["embedded"] += len(rows)
+            self._write_progress(cur)
+            conn.commit()
+            cur.close()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def report(self, **progress: int):
+        """Updates the counters shown by the /jobs status route."""
+        self.progress.update(progress)
+        conn = None
+        try:
+            conn = get_db_connection()
+            if not conn:
+                return
+            cur = conn.cursor()
+            self._write_progress(cur)
+            conn.commit()
+            cur.close()
+        except Exception as e:
+            print(f"⚠️ Could not record progress of ingest job {self.job_id}: {e}")
+        finally:
+            if conn:
+                conn.close()
+
+    def _write_progress(self, cur):
+        cur.execute("UPDATE ingest_jobs SET progress = %s WHERE id = %s;", (Json(self.progress), self.job_id))
+
+
+def _heartbeat_loop(job_id: int, worker_id: str, stop_event: threading.Event):
+    while not stop_event.wait(INGEST_HEARTBEAT_INTERVAL):
+        heartbeat_ingest_job(job_id, worker_id)
+
+
+def run_ingest_worker(handler: Callable[[Dict[str, Any]], Dict[str, Any]],
+                      worker_id: Optional[str] = None,
+                      stop_event: Optional[threading.Event] = None,
+                      poll_interval: float = INGEST_POLL_INTERVAL):
+    """
+    Claim/execute loop. `handler(job)` does the actual ingestion and returns a
+    JSON-serialisable result dict; any exception counts as a failed attempt,
+    and a PermanentIngestError fails the job without retrying.
+    """
+    worker_id = worker_id or make_worker_id(uuid.uuid4().hex[:6])
+    stop_event = stop_event or threading.Event()
+    print(f"👷 Ingest worker '{worker_id}' started")
+
+    while not stop_event.is_set():
+        job = claim_ingest_job(worker_id)
+        if not job:
+            stop_event.wait(poll_interval)
+            continue
+
+        print(f"👷 [{worker_id}] Job {job['id']} ({job['kind']}) '{job['file_name']}' "
+              f"attempt {job['attempts']}/{job['max_attempts']}")
+        start_job = time.time()
+        beat_stop = threading.Event()
+        beat = threading.Thread(target=_heartbeat_loop, args=(job['id'], worker_id, beat_stop), daemon=True)
+        beat.start()
+        try:
+            result = handler(job)
+            complete_ingest_job(job, result)
+            print(f"✅ [{worker_id}] Job {job['id']} done in {time.time() - start_job:.2f} sec")
+        except Exception as e:
+            traceback.print_exc()
+            fail_ingest_job(job, f"{type(e).__name__}: {e}", retry=not isinstance(e, PermanentIngestError))
+            print(f"❌ [{worker_id}] Job {job['id']} failed after {time.time() - start_job:.2f} sec: {e}")
+        finally:
+            beat_stop.set()
+            beat.join()
+
+    print(f"👷 Ingest worker '{worker_id}' stopped")
+
+
+def start_ingest_worker_threads(handler: Callable[[Dict[str, Any]], Dict[str, Any]],
+                                count: int,
+                                stop_event: Optional[threading.Event] = None) -> List[threading.Thread]:
+    """Starts `count` daemon worker threads in the current process."""
+    threads = []
+    for i in range(count):
+        thread = threading.Thread(
+            target=run_ingest_worker,
+            kwargs={"handler": handler, "worker_id": make_worker_id(f"t{i}"), "stop_event": stop_event},
+            name=f"ingest-worker-{i}",
+            daemon=True,
+        )
+        thread.start()
+        threads.append(thread)
+    return threads
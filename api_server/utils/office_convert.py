@@ -0,0 +1,126 @@
+import collections
+import hashlib
+import os
+import pathlib
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Optional
+
+# ==============================================================================
+#  OFFICE -> PDF CONVERSION
+# ==============================================================================
+# DOCX/PPTX/XLSX (and their legacy/OpenDocument siblings) are converted to a
+# paged PDF by a headless LibreOffice process, so they go through the same
+# text-layer fast path and parallel render pool as uploaded PDFs. Callers fall
+# back to their previous handling when this returns None (converter missing,
+# timeout, broken file).
+# Kept free of util.py imports so it can be used from any module.
+
+OFFICE_TO_PDF_ENABLED = os.getenv("OFFICE_TO_PDF_ENABLED", "true").lower() == "true"
+OFFICE_CONVERTER_BINARY = os.getenv("OFFICE_CONVERTER_BINARY", "soffice")
+OFFICE_CONVERT_TIMEOUT = float(os.getenv("OFFICE_CONVERT_TIMEOUT", "180"))         # seconds per document
+OFFICE_CONVERT_MAX_PARALLEL = int(os.getenv("OFFICE_CONVERT_MAX_PARALLEL", "2"))  # concurrent converter processes
+OFFICE_PDF_CACHE_SIZE = int(os.getenv("OFFICE_PDF_CACHE_SIZE", "4"))             # converted documents kept in memory
+
+OFFICE_TO_PDF_EXTENSIONS = (
+    '.docx', '.doc', '.odt', '.rtf',
+    '.pptx', '.ppt', '.odp',
+    '.xlsx', '.xlsm', '.xls', '.ods',
+)
+
+_convert_slots = threading.BoundedSemaphore(max(1, OFFICE_CONVERT_MAX_PARALLEL))
+
+# content hash -> PDF bytes; the chat ingest path converts once to count pages
+# and the text extractor asks for the same document again
+_pdf_cache: "collections.OrderedDict[str, bytes]" = collections.OrderedDict()
+_cache_lock = threading.Lock()
+_stats = {"converted": 0, "failed": 0, "cache_hits": 0, "convert_sec": 0.0}
+
+
+def is_office_document(file_name: str) -> bool:
+    return bool(file_name) and file_name.lower().endswith(OFFICE_TO_PDF_EXTENSIONS)
+
+
+def _find_converter() -> Optional[str]:
+    return shutil.which(OFFICE_CONVERTER_BINARY) or shutil.which("libreoffice")
+
+
+def convert_office_to_pdf(file_bytes: bytes, file_name: str) -> Optional[bytes]:
+    """
+    Converts an office document to PDF with `soffice --headless --convert-to pdf`.
+
+    Returns:
+        The PDF bytes, or None when the file is not an office document, the
+        conversion is disabled or unavailable, or it failed.
+    """
+    if not OFFICE_TO_PDF_ENABLED or not is_office_document(file_name):
+        return None
+
+    key = hashlib.sha1(file_bytes).hexdigest()
+    with _cache_lock:
+        cached = _pdf_cache.get(key)
+        if cached is not None:
+            _pdf_cache.move_to_end(key)
+            _stats["cache_hits"] += 1
+            return cached
+
+    binary = _find_converter()
+    if binary is None:
+        print(f"⚠️ Office converter '{OFFICE_CONVERTER_BINARY}' not found, '{file_name}' is not converted to PDF.")
+        return None
+
+    ext = os.path.splitext(file_name)[1].lower()
+    start = time.time()
+    pdf_bytes = None
+    with _convert_slots, tempfile.TemporaryDirectory(prefix="office2pdf-") as work_dir:
+        src_path = os.path.join(work_dir, "document" + ext)
+        with open(src_path, "wb") as f:
+            f.write(file_bytes)
+
+        # A private profile per call: soffice processes sharing a profile block each other
+        profile_url = pathlib.Path(work_dir, "profile").as_uri()
+        cmd = [
+            binary, f"-env:UserInstallation={profile_url}",
+            "--headless", "--norestore", "--nolockcheck",
+            "--convert-to", "pdf", "--outdir", work_dir, src_path,
+        ]
+        try:
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=OFFICE_CONVERT_TIMEOUT)
+            out_path = os.path.join(work_dir, "document.pdf")
+            if os.path.exists(out_path):
+                with open(out_path, "rb") as f:
+                    pdf_bytes = f.read()
+            else:
+                print(f"❌ Office to PDF conversion of '{file_name}' produced no output: "
+                      f"{proc.stderr.decode('utf-8', errors='ignore').strip()}")
+        except subprocess.TimeoutExpired:
+            print(f"❌ Office to PDF conversion of '{file_name}' timed out after {OFFICE_CONVERT_TIMEOUT}s")
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"❌ Office to PDF conversion of '{file_name}' failed: {e}")
+
+    elapsed = time.time() - start
+    with _cache_lock:
+        _stats["convert_sec"] += elapsed
+        if not pdf_bytes:
+            _stats["failed"] += 1
+            return None
+        _stats["converted"] += 1
+        _pdf_cache[key] = pdf_bytes
+        while len(_pdf_cache) > max(0, OFFICE_PDF_CACHE_SIZE):
+            _pdf_cache.popitem(last=False)
+
+    print(f"📄 Converted '{file_name}' to PDF in {elapsed:.2f}s")
+    return pdf_bytes
+
+
+def get_office_convert_stats() -> Dict[str, Any]:
+    with _cache_lock:
+        stats = dict(_stats)
+        stats["cached"] = len(_pdf_cache)
+    stats["convert_sec"] = round(stats["convert_sec"], 4)
+    stats["converter"] = _find_converter()
+    stats["enabled"] = OFFICE_TO_PDF_ENABLED
+    return stats
@@ -0,0 +1,214 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+import fitz  # PyMuPDF
+
+# ==============================================================================
+#  RANGE-BASED PDF RENDERER + OPEN DOCUMENT CACHE
+# ==============================================================================
+# Parsing a PDF (xref table, page tree) is paid once per document and process:
+# open fitz.Document handles are kept in a small LRU keyed by the SHA-256 of the
+# file content, and pages are rendered from that handle as a generator.
+# Kept free of util.py imports so render pool workers stay lightweight.
+
+PDF_DOC_CACHE_SIZE = int(os.getenv("PDF_DOC_CACHE_SIZE", "8"))
+
+
+class RawPageImage(NamedTuple):
+    """Uncompressed pixels of a rendered page (image_format="raw"), rows packed, no alpha."""
+    width: int
+    height: int
+    mode: str      # PIL mode, "RGB"
+    data: bytes
+
+_doc_cache: "OrderedDict[str, Tuple[fitz.Document, threading.Lock]]" = OrderedDict()
+_doc_cache_lock = threading.Lock()
+_doc_cache_stats = {"hits": 0, "misses": 0}
+
+
+def pdf_content_hash(pdf_bytes: bytes) -> str:
+    """SHA-256 hex digest of a file's bytes."""
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+
+def _get_cached_document(pdf_bytes: Optional[bytes] = None, path: Optional[str] = None,
+                         content_hash: Optional[str] = None) -> Tuple[fitz.Document, threading.Lock]:
+    if content_hash is None:
+        if pdf_bytes is None:
+            raise ValueError("content_hash is required when opening a PDF by path")
+        content_hash = pdf_content_hash(pdf_bytes)
+
+    with _doc_cache_lock:
+        entry = _doc_cache.get(content_hash)
+        if entry is not None:
+            _doc_cache.move_to_end(content_hash)
+            _doc_cache_stats["hits"] += 1
+            return entry
+
+    # Parse outside the cache lock; a concurrent miss on the same file just parses twice
+    if pdf_bytes is not None:
+        pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
+    else:
+        pdf_document = fitz.open(path)
+    entry = (pdf_document, threading.Lock())
+
+    with _doc_cache_lock:
+        _doc_cache_stats["misses"] += 1
+        existing = _doc_cache.get(content_hash)
+        if existing is not None:
+            return existing
+        _doc_cache[content_hash] = entry
+        while len(_doc_cache) > PDF_DOC_CACHE_SIZE:
+            # Evicted handles are closed by PyMuPDF once the last generator using them is done
+            _doc_cache.popitem(last=False)
+    return entry
+
+
+def open_pdf_document(pdf_bytes: Optional[bytes] = None, path: Optional[str] = None,
+                      content_hash: Optional[str] = None) -> fitz.Document:
+    """
+    Returns a shared, already parsed fitz.Document for the given content.
+
+    Args:
+        pdf_bytes: The byte content of the entire PDF, or
+        path: A file holding the PDF (content_hash is then required).
+        content_hash: SHA-256 of the content, computed from pdf_bytes when omitted.
+
+    The handle is shared: do not close it.
+    """
+    return _get_cached_document(pdf_bytes, path, content_hash)[0]
+
+
+def iter_pdf_page_images(pdf_bytes: Optional[bytes] = None,
+                         page_numbers_0_idx: Optional[Iterable[int]] = None,
+                         dpi: int = 100,
+                         path: Optional[str] = None,
+                         content_hash: Optional[str] = None,
+                         image_format: str = "png") -> Iterator[Tuple[int, Optional[Union[bytes, RawPageImage]]]]:
+    """
+    Renders pages of a PDF, opening (or reusing) the document only once.
+
+    Args:
+        pdf_bytes / path / content_hash: See open_pdf_document.
+        page_numbers_0_idx: A range or list of 0-indexed pages; all pages when None.
+        dpi: The resolution in dots per inch for the output images.
+        image_format: Pixmap output format ("png", "jpeg", ...), or "raw" for a
+                      RawPageImage with the RGB samples and no encoding at all.
+                      Use "raw" when the pixels stay in-process (embedding) and an
+                      encoded format when the image leaves it (MinIO, VLM APIs).
+
+    Yields:
+        (page_number_0_indexed, image) in the requested order; image is None when
+        a page is out of bounds or fails to render.
+    """
+    pdf_document, doc_lock = _get_cached_document(pdf_bytes, path, content_hash)
+    if page_numbers_0_idx is None:
+        page_numbers_0_idx = range(pdf_document.page_count)
+
+    for page_num_0_idx in page_numbers_0_idx:
+        if not 0 <= page_num_0_idx < pdf_document.page_count:
+            print(f"Error: Page {page_num_0_idx} out of bounds.")
+            yield page_num_0_idx, None
+            continue
+        try:
+            # MuPDF documents are not thread-safe; serialise access per document
+            with doc_lock:
+                pix = pdf_document.load_page(page_num_0_idx).get_pixmap(dpi=dpi, alpha=False)
+            if image_format == "raw":
+                yield page_num_0_idx, RawPageImage(pix.width, pix.height, "RGB", pix.samples)
+            else:
+                yield page_num_0_idx, pix.tobytes(image_format)
+        except Exception as e:
+            print(f"❌ Error converting PDF page {page_num_0_idx} to image: {e}")
+            yield page_num_0_idx, None
+
+
+# ==============================================================================
+#  TEXT-LAYER CLASSIFIER (skip the VLM for born-digital pages)
+# ==============================================================================
+
+PDF_TEXT_LAYER_ENABLED = os.getenv("PDF_TEXT_LAYER_ENABLED", "true").lower() == "true"
+PDF_TEXT_MIN_CHARS = int(os.getenv("PDF_TEXT_MIN_CHARS", "100"))                  # fewer chars: likely scanned / title page
+PDF_TEXT_MIN_COVERAGE = float(os.getenv("PDF_TEXT_MIN_COVERAGE", "0.05"))         # text block area / page area
+PDF_TEXT_MAX_IMAGE_RATIO = float(os.getenv("PDF_TEXT_MAX_IMAGE_RATIO", "0.3"))    # image area / page area
+PDF_TEXT_MAX_DRAWINGS = int(os.getenv("PDF_TEXT_MAX_DRAWINGS", "150"))            # vector paths (diagrams, schematics)
+PDF_TEXT_MAX_BAD_CHAR_RATIO = float(os.getenv("PDF_TEXT_MAX_BAD_CHAR_RATIO", "0.05"))  # U+FFFD from broken font maps
+
+
+def _rect_area(rect) -> float:
+    return max(0.0, rect.width) * max(0.0, rect.height)
+
+
+def classify_pdf_page(page: "fitz.Page") -> Dict[str, Any]:
+    """
+    Decides whether a page's native text layer can replace VLM transcription.
+
+    Returns:
+        {"text", "chars", "text_coverage", "image_ratio", "drawings", "has_fonts", "use_text_layer"}
+    """
+    page_rect = page.rect
+    page_area = _rect_area(page_rect) or 1.0
+
+    text = page.get_text("text", sort=True)  # sort=True: reading order (top-left to bottom-right)
+    chars = len(text.strip())
+    bad_chars = text.count("\ufffd")
+    text_area = sum(
+        _rect_area(fitz.Rect(block[:4]) & page_rect)
+        for block in page.get_text("blocks")
+        if block[6] == 0  # block_type 0 = text
+    )
+    image_area = sum(_rect_area(fitz.Rect(info["bbox"]) & page_rect) for info in page.get_image_info())
+    try:
+        drawings = len(page.get_drawings())
+    except Exception:
+        drawings = 0
+    has_fonts = bool(page.get_fonts())
+
+    result = {
+        "text": text,
+        "chars": chars,
+        "text_coverage": round(min(1.0, text_area / page_area), 4),
+        "image_ratio": round(min(1.0, image_area / page_area), 4),
+        "drawings": drawings,
+        "has_fonts": has_fonts,
+    }
+    result["use_text_layer"] = bool(
+        PDF_TEXT_LAYER_ENABLED
+        and has_fonts
+        and chars >= PDF_TEXT_MIN_CHARS
+        and result["text_coverage"] >= PDF_TEXT_MIN_COVERAGE
+        and result["image_ratio"] <= PDF_TEXT_MAX_IMAGE_RATIO
+        and drawings <= PDF_TEXT_MAX_DRAWINGS
+        and bad_chars <= PDF_TEXT_MAX_BAD_CHAR_RATIO * max(chars, 1)
+    )
+    return result
+
+
+def classify_pdf_pages(pdf_bytes: Optional[bytes] = None, path: Optional[str] = None,
+                       content_hash: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Runs classify_pdf_page() over every page of a PDF (cached document handle).
+
+    Returns:
+        One dict per page in page order, with "page_num_1_idx" added.
+    """
+    pdf_document, doc_lock = _get_cached_document(pdf_bytes, path, content_hash)
+    plan = []
+    for page_num_0_idx in range(pdf_document.page_count):
+        try:
+            with doc_lock:
+                page_info = classify_pdf_page(pdf_document.load_page(page_num_0_idx))
+        except Exception as e:
+            print(f"❌ Error reading text layer of page {page_num_0_idx}: {e}")
+            page_info = {"text": "", "chars": 0, "use_text_layer": False}
+        page_info["page_num_1_idx"] = page_num_0_idx + 1
+        plan.append(page_info)
+    return plan
+
+
+def get_pdf_cache_stats() -> dict:
+    with _doc_cache_lock:
+        return {"open_documents": len(_doc_cache), "capacity": PDF_DOC_CACHE_SIZE, **_doc_cache_stats}
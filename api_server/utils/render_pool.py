@@ -0,0 +1,203 @@
+import collections
+import math
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from utils.pdf_render import iter_pdf_page_images, open_pdf_document, pdf_content_hash
+
+# ==============================================================================
+#  PERSISTENT PAGE RASTERIZATION POOL
+# ==============================================================================
+# One long-lived process pool per process, created once (ideally at startup,
+# before any threads exist, because it forks). A document is spooled once to a
+# temp file (in /dev/shm when available) and workers receive only
+# (path, page numbers, dpi), so the PDF bytes are never pickled per page.
+
+RENDER_POOL_PROCESSES = int(os.getenv("RENDER_POOL_PROCESSES", str(os.cpu_count() or 4)))
+RENDER_POOL_MAX_PAGES_PER_TASK = int(os.getenv("RENDER_POOL_MAX_PAGES_PER_TASK", "16"))
+RENDER_SPOOL_DIR = os.getenv("RENDER_SPOOL_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir())
+
+_render_pool = None
+_render_pool_size = 0
+_render_pool_lock = threading.Lock()
+
+_render_stats_lock = threading.Lock()
+_render_stats = {
+    "documents": 0,
+    "pages": 0,
+    "failed_pages": 0,
+    "tasks": 0,
+    "spool_sec": 0.0,
+    "render_sec": 0.0,   # summed worker time
+    "wall_sec": 0.0,     # end-to-end time seen by callers
+    "last": None,        # timings of the most recent document
+}
+
+
+def _render_range_worker(args: Tuple[str, str, Sequence[int], int, str]) -> Tuple[List[Tuple[int, Any]], float]:
+    """Pool worker: renders a run of pages from the spooled PDF, reusing the worker's open handle."""
+    path, content_hash, page_numbers_0_idx, dpi, image_format = args
+    start = time.time()
+    rendered = [
+        (page_num_0_idx + 1, img_bytes)
+        for page_num_0_idx, img_bytes in iter_pdf_page_images(
+            path=path, content_hash=content_hash, page_numbers_0_idx=page_numbers_0_idx, dpi=dpi,
+            image_format=image_format,
+        )
+    ]
+    return rendered, time.time() - start
+
+
+def _noop(_):
+    return os.getpid()
+
+
+def start_render_pool(processes: Optional[int] = None):
+    """
+    Creates the rasterization pool if it does not exist yet and returns it.
+    Call it at startup so the fork happens before worker/Flask threads start.
+    """
+    global _render_pool, _render_pool_size
+    with _render_pool_lock:
+        if _render_pool is None:
+            size = max(1, processes or RENDER_POOL_PROCESSES)
+            start = time.time()
+            _render_pool = multiprocessing.get_context("fork").Pool(processes=size)
+            _render_pool.map(_noop, range(size))
+            _render_pool_size = size
+            print(f"✅ Render pool started with {size} processes in {time.time() - start:.2f} sec")
+        return _render_pool
+
+
+def shutdown_render_pool():
+    global _render_pool, _render_pool_size
+    with _render_pool_lock:
+        if _render_pool is not None:
+            _render_pool.close()
+            _render_pool.join()
+            _render_pool = None
+            _render_pool_size = 0
+
+
+def _split_pages(page_numbers: List[int], workers: int) -> List[List[int]]:
+    """Contiguous runs of pages, about one per worker, capped at RENDER_POOL_MAX_PAGES_PER_TASK."""
+    per_task = max(1, min(RENDER_POOL_MAX_PAGES_PER_TASK, math.ceil(len(page_numbers) / workers)))
+    return [page_numbers[i:i + per_task] for i in range(0, len(page_numbers), per_task)]
+
+
+def iter_pdf_pages_pooled(pdf_bytes: bytes, dpi: int = 100,
+                          page_numbers_0_idx: Optional[Sequence[int]] = None,
+                          max_inflight_tasks: Optional[int] = None,
+                          timings: Optional[Dict[str, Any]] = None,
+                          image_format: str = "png") -> Iterator[Tuple[int, Any]]:
+    """
+    Renders PDF pages on the shared pool and yields them in page order as soon
+    as their run is done.
+
+    At most `max_inflight_tasks` runs (default: 2 per pool process) are queued or
+    finished-but-unconsumed at any time, so a slow consumer bounds memory instead
+    of letting the pool render the whole document ahead.
+
+    Args:
+        pdf_bytes: The byte content of the entire PDF.
+        dpi: Output resolution.
+        page_numbers_0_idx: Pages to render; all pages when None.
+        timings: Optional dict filled with per-stage timings once the generator is exhausted.
+        image_format: "png" (default), another pixmap format, or "raw" for
+                      uncompressed pdf_render.RawPageImage pixels, which skips the
+                      PNG encode in the worker and the decode in the consumer.
+
+    Yields:
+        (page_num_1_idx, image or None when the page failed to render)
+    """
+    wall_start = time.time()
+    pool = start_render_pool()
+
+    spool_start = time.time()
+    content_hash = pdf_content_hash(pdf_bytes)
+    if page_numbers_0_idx is None:
+        page_numbers_0_idx = range(open_pdf_document(pdf_bytes, content_hash=content_hash).page_count)
+    page_numbers = list(page_numbers_0_idx)
+
+    with tempfile.NamedTemporaryFile(dir=RENDER_SPOOL_DIR, suffix=".pdf", delete=False) as spool:
+        spool.write(pdf_bytes)
+        spool_path = spool.name
+    spool_sec = time.time() - spool_start
+
+    render_sec, failed = 0.0, 0
+    tasks = _split_pages(page_numbers, _render_pool_size) if page_numbers else []
+    max_inflight_tasks = max(1, max_inflight_tasks or 2 * _render_pool_size)
+    render_start = time.time()
+    try:
+        pending = collections.deque()
+        next_task = 0
+        while next_task < len(tasks) or pending:
+            while next_task < len(tasks) and len(pending) < max_inflight_tasks:
+                pending.append(pool.apply_async(_render_range_worker, ((spool_path, content_hash, tasks[next_task], dpi, image_format),)))
+                next_task += 1
+            rendered, worker_sec = pending.popleft().get()
+            render_sec += worker_sec
+            for page_num_1_idx, img_bytes in rendered:
+                if not img_bytes:
+                    failed += 1
+                    print(f" - FAILED to render image for page {page_num_1_idx}.")
+                yield page_num_1_idx, img_bytes
+    finally:
+        os.unlink(spool_path)
+
+    stage_timings = {
+        "pages": len(page_numbers),
+        "failed_pages": failed,
+        "tasks": len(tasks),
+        "dpi": dpi,
+        "image_format": image_format,
+        "spool_sec": round(spool_sec, 4),
+        "render_wall_sec": round(time.time() - render_start, 4),
+        "render_worker_sec": round(render_sec, 4),
+        "wall_sec": round(time.time() - wall_start, 4),
+    }
+    with _render_stats_lock:
+        _render_stats["documents"] += 1
+        _render_stats["pages"] += len(page_numbers)
+        _render_stats["failed_pages"] += failed
+        _render_stats["tasks"] += len(tasks)
+        _render_stats["spool_sec"] += spool_sec
+        _render_stats["render_sec"] += render_sec
+        _render_stats["wall_sec"] += stage_timings["wall_sec"]
+        _render_stats["last"] = stage_timings
+    print(f"🖼️ Rendered {len(page_numbers) - failed}/{len(page_numbers)} pages at {dpi} dpi: {stage_timings}")
+    if timings is not None:
+        timings.update(stage_timings)
+
+
+def render_pdf_pages_pooled(pdf_bytes: bytes, dpi: int = 100,
+                            page_numbers_0_idx: Optional[Sequence[int]] = None) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Renders PDF pages to PNG on the shared pool.
+
+    Returns:
+        ([{'page_num_1_idx', 'img_bytes'}, ...] in page order, timings dict).
+        Pages that fail to render are left out.
+    """
+    timings = {}
+    pages = [
+        {"page_num_1_idx": page_num_1_idx, "img_bytes": img_bytes}
+        for page_num_1_idx, img_bytes in iter_pdf_pages_pooled(pdf_bytes, dpi, page_numbers_0_idx, timings=timings)
+        if img_bytes
+    ]
+    return pages, timings
+
+
+def get_render_pool_stats() -> Dict[str, Any]:
+    """Pool size and cumulative per-stage timings."""
+    with _render_stats_lock:
+        stats = dict(_render_stats)
+    stats["processes"] = _render_pool_size
+    stats["running"] = _render_pool is not None
+    for key in ("spool_sec", "render_sec", "wall_sec"):
+        stats[key] = round(stats[key], 4)
+    return stats
@@ -0,0 +1,99 @@
+from typing import Any, Callable, Dict, List, Optional
+
+# ==============================================================================
+#  PAGE MATCHES & THRESHOLD ESCALATION (/search_similar)
+# ==============================================================================
+# /search_similar widens the distance threshold step by step until a query
+# variant finds something. ThresholdEscalation answers every step from one
+# search per variant; normalize_page_matches turns page rows into scored results.
+# Kept free of util.py imports so it can be used from any module.
+
+
+def _page_match_rows(results) -> List[Dict[str, Any]]:
+    """(id, file_name, object_name, page_number, distance) rows -> raw page match dicts."""
+    return [
+        {
+            'page_embedding_id': row[0],
+            'file_name': row[1],
+            'object_name': row[2],
+            'page_number': row[3],
+            'distance': row[4],
+        }
+        for row in results
+    ]
+
+
+def normalize_page_matches(matches: List[Dict[str, Any]], similarity_threshold: float = 0.5) -> List[Dict[str, Any]]:
+    """
+    Min-max normalizes the distances of a page result set into 'similarity_score'
+    (1.0 = closest match) and keeps the pages scoring >= similarity_threshold.
+    """
+    if not matches:
+        print("ℹ️ No pages found, returning empty list.")
+        return []
+
+    # Get all distances to find min/max for normalization
+    all_distances = [item['distance'] for item in matches]
+    min_dist = min(all_distances)
+    max_dist = max(all_distances)
+    dist_range = max_dist - min_dist
+
+    print(f"ℹ️ Normalizing distances: min={min_dist:.4f}, max={max_dist:.4f}, range={dist_range:.4f}")
+
+    processed_results = []
+    for item in matches:
+        # Handle division by zero if all distances are identical (dist_range == 0)
+        if dist_range == 0:
+            similarity_score = 1.0
+        else:
+            # Min-Max normalization, then lower distance = higher similarity
+            similarity_score = 1.0 - (item['distance'] - min_dist) / dist_range
+        processed_results.append({
+            **item,
+            'similarity_score': similarity_score,
+            'double-precision': f'{similarity_score:.10f}'  # Show full precision
+        })
+
+    print(f"processed_results : {processed_results}")
+
+    final_filtered_results = [item for item in processed_results if item['similarity_score'] >= similarity_threshold]
+    print(f"ℹ️ Filtered to {len(final_filtered_results)} pages (similarity_score >= {similarity_threshold}).")
+    return final_filtered_results
+
+
+class ThresholdEscalation:
+    """
+    Threshold escalation of /search_similar without re-querying per level.
+
+    Each query variant is searched (and so embedded) at most once, at the widest
+    threshold, with ORDER BY distance LIMIT top_k. The top_k rows within a
+    narrower threshold are a prefix of that result, so every level is answered
+    by filtering the returned distances; `post` (e.g. normalize_page_matches)
+    is applied to the rows of a level, as the per-level searches did.
+    """
+
+    def __init__(self, variants: List[str], run_search: Callable[[str, float], List[Dict[str, Any]]],
+                 base_threshold: float, factors: List[float],
+                 post: Optional[Callable[[List[Dict[str, Any]]], List[Dict[str, Any]]]] = None):
+        self.variants = [text for text in dict.fromkeys(variants) if text]
+        self.run_search = run_search  # run_search(text, threshold) -> rows with 'distance', ascending
+        self.base_threshold = base_threshold
+        self.max_threshold = base_threshold * max(factors)
+        self.post = post
+        self._rows: Dict[str, List[Dict[str, Any]]] = {}
+
+    def _candidates(self, text: str) -> List[Dict[str, Any]]:
+        if text not in self._rows:
+            self._rows[text] = self.run_search(text, self.max_threshold) or []
+        return self._rows[text]
+
+    def at(self, factor: float) -> List[Dict[str, Any]]:
+        """Results of the first variant with matches at base_threshold * factor."""
+        threshold = self.base_threshold * factor
+        for text in self.variants:
+            rows = [row for row in self._candidates(text) if row['distance'] <= threshold]
+            if rows and self.post is not None:
+                rows = self.post(rows)
+            if rows:
+                return rows
+        return []
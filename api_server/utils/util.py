@@ -1,5 +1,6 @@
 import io
 import base64
+import hashlib
 import uuid
 import re
 import os
@@ -8,6 +9,7 @@ import requests
 import dotenv
 import psycopg2
 import fitz  # PyMuPDF
+import threading
 import time
 import mimetypes # For guessing mime types
 import numpy as np
@@ -45,9 +47,28 @@ from unstructured.partition.auto import partition
 from unstructured.documents.elements import Image as UnstructuredImage
 
 from minio import Minio
+from minio.commonconfig import CopySource
 from minio.error import S3Error
 from typing import List, Optional, Dict, Any, Union
 
+from utils.chunking import PAGE_BREAK
+from utils.db_pool import DB_BULK_STATEMENT_TIMEOUT_MS, get_pooled_connection
+from utils.vectors import copy_rows_binary, fit_dimensions, to_float32
+from utils.pdf_render import classify_pdf_pages, iter_pdf_page_images
+from utils.render_pool import iter_pdf_pages_pooled
+from utils.office_convert import convert_office_to_pdf, is_office_document
+from utils.embed_scheduler import EMBED_BATCHING_ENABLED, MicroBatchScheduler
+from utils.embedding_cache import embedding_cache_key, text_embedding_cache
+from utils.chat_vector_cache import CHAT_PAGES, CHAT_TEXT_CHUNKS, search_chat_vectors
+from utils.vector_index import prepare_binary_rerank_query, prepare_nearest_neighbour_query
+from utils.search_escalation import ThresholdEscalation, _page_match_rows, normalize_page_matches
+from utils.gpu_batching import (
+    parse_probe_sizes,
+    probe_batch_size,
+    resolution_bucket,
+    run_adaptive_batches,
+)
+
 
 # from vllm import LLM, SamplingParams
 # from vllm.config import PoolerConfig
@@ -57,6 +78,8 @@ dotenv.load_dotenv()
 
 LOCAL = os.getenv("LOCAL", True)
 API_OLLAMA = os.getenv("API_OLLAMA", "http://127.0.0.1:11434/api/generate")
+# Parallel request slots of the Ollama server; caps Ollama calls and VLM batches in flight
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
 
 LOCAL = True if LOCAL == "True" else False
 
@@ -132,16 +155,12 @@ minio_bucket_name = os.getenv("MINIO_BUCKET", "user-files")
 
 # --- NEW: Database Connection Helper ---
 def get_db_connection():
-    """Helper function to get a new database connection."""
+    """
+    Helper function to check a connection out of the process-wide pool.
+    `conn.close()` returns it to the pool (see utils/db_pool.py).
+    """
     try:
-        conn = psycopg2.connect(
-            dbname=os.getenv("PGDATABASE", "ai_agent"),
-            user=os.getenv("PGUSER", "athip"),
-            password=os.getenv("PGPASSWORD", "123456"),
-            host=os.getenv("PGHOST", "localhost"),
-            port=os.getenv("PGPORT", "5432"),
-        )
-        return conn
+        return get_pooled_connection()
     except psycopg2.DatabaseError as e:
         print(f"❌ Failed to connect to database: {e}")
         return None
@@ -155,6 +174,11 @@ def upload_file_to_minio_and_db(user_id: int, chat_history_id: int, file_name: s
     Uploads a file to MinIO and creates a record in the 'uploaded_files' table.
     Mirrors the logic from database.js.
 
+    The SHA-256 of the content is stored in 'content_sha256'. When the same bytes
+    were uploaded before, the existing MinIO object is copied server-side instead
+    of uploading the bytes again (every row keeps its own object, so deleting one
+    file never breaks another).
+
     Returns:
         (uploaded_file_id, object_name) or (None, None) on failure.
     """
@@ -164,6 +188,7 @@ def upload_file_to_minio_and_db(user_id: int, chat_history_id: int, file_name: s
             mime_type = 'application/octet-stream' # Default
             
     file_size = len(file_bytes)
+    content_sha256 = hashlib.sha256(file_bytes).hexdigest()
     object_name = f"user_{user_id}/chat_{chat_history_id}/{int(time.time())}-{file_name}"
     
     print(f"📦 DEBUG upload_file_to_minio_and_db:")
@@ -173,34 +198,49 @@ def upload_file_to_minio_and_db(user_id: int, chat_history_id: int, file_name: s
     print(f"  - file_size: {file_size} bytes")
     print(f"  - mime_type: {mime_type}")
     print(f"  - object_name: {object_name}")
+    print(f"  - content_sha256: {content_sha256}")
     
     conn = None
     try:
-        # 1. Upload to MinIO
-        print("  - Attempting MinIO upload...")
-        file_stream = io.BytesIO(file_bytes)
-        minio_client.put_object(
-            minio_bucket_name,
-            object_name,
-            file_stream,
-            file_size,
-            content_type=mime_type
-        )
-        print(f"✅ MinIO: File '{object_name}' uploaded successfully.")
-
-        # 2. Insert record into PostgreSQL
-        print("  - Attempting DB insert...")
         conn = get_db_connection()
         if not conn:
             raise Exception("Could not connect to database")
-            
         cur = conn.cursor()
+
+        # 1. Upload to MinIO (or copy an identical object already stored)
+        cur.execute(
+            "SELECT object_name FROM uploaded_files WHERE content_sha256 = %s AND file_size_bytes = %s ORDER BY id DESC LIMIT 1;",
+            (content_sha256, file_size)
+        )
+        existing = cur.fetchone()
+        copied = False
+        if existing:
+            try:
+                minio_client.copy_object(minio_bucket_name, object_name, CopySource(minio_bucket_name, existing[0]))
+                copied = True
+                print(f"♻️ MinIO: Identical content found, copied '{existing[0]}' -> '{object_name}'.")
+            except S3Error as copy_error:
+                print(f"⚠️ MinIO copy of '{existing[0]}' failed ({copy_error}), uploading instead...")
+        if not copied:
+            print("  - Attempting MinIO upload...")
+            file_stream = io.BytesIO(file_bytes)
+            minio_client.put_object(
+                minio_bucket_name,
+                object_name,
+                file_stream,
+                file_size,
+                content_type=mime_type
+            )
+            print(f"✅ MinIO: File '{object_name}' uploaded successfully.")
+
+        # 2. Insert record into PostgreSQL
+        print("  - Attempting DB insert...")
         query = """
-            INSERT INTO uploaded_files (user_id, chat_history_id, file_name, object_name, mime_type, file_size_bytes)
-            VALUES (%s, %s, %s, %s, %s, %s)
+            INSERT INTO uploaded_files (user_id, chat_history_id, file_name, object_name, mime_type, file_size_bytes, content_sha256)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
             RETURNING id;
         """
-        values = (user_id, chat_history_id, file_name, object_name, mime_type, file_size)
+        values = (user_id, chat_history_id, file_name, object_name, mime_type, file_size, content_sha256)
         cur.execute(query, values)
         uploaded_file_id = cur.fetchone()[0]
         
@@ -245,6 +285,8 @@ def get_file_from_minio(object_name: str) -> Optional[bytes]:
 def convert_pdf_page_to_image(pdf_bytes: bytes, page_number_0_indexed: int, dpi: int = 100) -> Optional[bytes]:
     """
     Extracts a single page from a PDF as a high-quality PNG image.
+    The parsed document is reused across calls (see utils/pdf_render.py);
+    use iter_pdf_page_images to render several pages.
     
     Args:
         pdf_bytes: The byte content of the entire PDF.
@@ -252,26 +294,11 @@ def convert_pdf_page_to_image(pdf_bytes: bytes, page_number_0_indexed: int, dpi:
         dpi: The resolution in dots per inch for the output image.
     """
     try:
-        pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
-        if page_number_0_indexed >= len(pdf_document):
-            print(f"Error: Page {page_number_0_indexed} out of bounds.")
-            pdf_document.close()
-            return None
-            
-        page = pdf_document.load_page(page_number_0_indexed)
-        
-        # Render page to a pixmap (image)
-        # Use high DPI (e.g., 200) for good quality
-        pix = page.get_pixmap(dpi=dpi) 
-        
-        # Convert pixmap to PNG bytes
-        img_bytes = pix.tobytes("png")
-        pdf_document.close()
-        return img_bytes
-        
+        for _, img_bytes in iter_pdf_page_images(pdf_bytes, [page_number_0_indexed], dpi=dpi):
+            return img_bytes
     except Exception as e:
         print(f"❌ Error converting PDF page {page_number_0_indexed} to image: {e}")
-        return None
+    return None
 
 
 # ==============================================================================
@@ -329,16 +356,8 @@ def extract_images_from_pdf_with_docling(pdf_bytes: bytes) -> list:
         # pipeline_options.ocr_options = ocr_options
 
 
-        pipeline_options = VlmPipelineOptions(
-        vlm_options=vlm_model_specs.SMOLDOCLING_TRANSFORMERS,  # <-- change the model here
-            # accelerator_options = AcceleratorOptions(
-            #     num_threads=8, device=AcceleratorDevice.CPU
-            # )
-        )
-        
-        converter = DocumentConverter(
-            format_options={InputFormat.PDF: PdfFormatOption(pipeline_cls=VlmPipeline, pipeline_options=pipeline_options)}
-        )
+        # SmolDocling VLM pipeline, reused across calls (see get_document_converter)
+        converter = get_document_converter("vlm_local", InputFormat.PDF)
 
         # converter = DocumentConverter()
         
@@ -519,6 +538,102 @@ def generate_vlm_pipeline_options(mode: str = 'local', **kwargs) -> VlmPipelineO
 
     else:
         raise ValueError(f"Invalid mode '{mode}' specified. Choose 'local' or 'remote'.")
+
+
+# ==============================================================================
+#  DOCLING CONVERTER REGISTRY
+# ==============================================================================
+# A DocumentConverter loads its layout/OCR/VLM models when a format's pipeline is
+# first used, and caches that pipeline on the instance. Converters are therefore
+# built once per pipeline mode and process, and each format's pipeline is
+# initialized once on its converter, instead of per uploaded file.
+#   'default'    : Docling's standard pipelines (DOCX/PPTX/XLSX/HTML/... fallback)
+#   'vlm_local'  : PDF through the local SmolDocling VLM pipeline
+#   'vlm_remote' : PDF through the OpenRouter VLM pipeline
+
+DOCLING_WARM_AT_STARTUP = os.getenv("DOCLING_WARM_AT_STARTUP", "false").lower() == "true"
+DOCLING_WARM_FORMATS = [f.strip() for f in os.getenv("DOCLING_WARM_FORMATS", "docx,pptx,xlsx").split(",") if f.strip()]
+DOCLING_WARM_MODES = [m.strip() for m in os.getenv("DOCLING_WARM_MODES", "default").split(",") if m.strip()]
+
+_DOCLING_FORMATS_BY_EXT = {
+    "pdf": InputFormat.PDF,
+    "docx": InputFormat.DOCX,
+    "pptx": InputFormat.PPTX,
+    "xlsx": InputFormat.XLSX,
+    "html": InputFormat.HTML,
+    "htm": InputFormat.HTML,
+    "md": InputFormat.MD,
+    "csv": InputFormat.CSV,
+}
+
+_docling_converters: Dict[str, DocumentConverter] = {}
+_docling_initialized_formats: Dict[str, set] = {}
+_docling_lock = threading.Lock()
+
+
+def docling_input_format(file_ext: str) -> Optional[InputFormat]:
+    """InputFormat of a file extension ('.docx' or 'docx'), None when Docling has to sniff it."""
+    return _DOCLING_FORMATS_BY_EXT.get(file_ext.lower().lstrip("."))
+
+
+def _build_document_converter(mode: str) -> DocumentConverter:
+    if mode == "default":
+        return DocumentConverter()
+    if mode in ("vlm_local", "vlm_remote"):
+        pipeline_options = generate_vlm_pipeline_options(mode=mode[len("vlm_"):])
+        return DocumentConverter(
+            format_options={InputFormat.PDF: PdfFormatOption(pipeline_cls=VlmPipeline, pipeline_options=pipeline_options)}
+        )
+    raise ValueError(f"Invalid converter mode '{mode}'. Choose 'default', 'vlm_local' or 'vlm_remote'.")
+
+
+def get_document_converter(mode: str = "default", input_format: Optional[InputFormat] = None) -> DocumentConverter:
+    """
+    The process-wide DocumentConverter of a pipeline mode, created on first use.
+
+    Args:
+        mode: 'default', 'vlm_local' or 'vlm_remote'.
+        input_format: When given, that format's pipeline (and its models) is
+                      initialized once on the converter before it is returned.
+    """
+    with _docling_lock:
+        converter = _docling_converters.get(mode)
+        if converter is None:
+            start = time.time()
+            converter = _build_document_converter(mode)
+            _docling_converters[mode] = converter
+            _docling_initialized_formats[mode] = set()
+            print(f"🧰 Created Docling converter '{mode}' in {time.time() - start:.2f}s")
+
+        if input_format is not None and input_format not in _docling_initialized_formats[mode]:
+            start = time.time()
+            converter.initialize_pipeline(input_format)
+            _docling_initialized_formats[mode].add(input_format)
+            print(f"🧰 Initialized Docling '{mode}' pipeline for {input_format.value} in {time.time() - start:.2f}s")
+    return converter
+
+
+def warm_document_converters(formats: Optional[List[str]] = None, modes: Optional[List[str]] = None) -> bool:
+    """
+    Builds the converters and format pipelines ahead of the first request.
+    Defaults to DOCLING_WARM_MODES x DOCLING_WARM_FORMATS.
+
+    Returns:
+        True when every converter was warmed.
+    """
+    formats = DOCLING_WARM_FORMATS if formats is None else formats
+    modes = DOCLING_WARM_MODES if modes is None else modes
+    ok = True
+    for mode in modes:
+        # VLM converters only handle PDF
+        mode_formats = ["pdf"] if mode.startswith("vlm_") else formats
+        for file_ext in mode_formats:
+            try:
+                get_document_converter(mode, docling_input_format(file_ext))
+            except Exception as e:
+                ok = False
+                print(f"❌ Could not warm Docling converter '{mode}' for '{file_ext}': {e}")
+    return ok
     
 
 # def extract_and_process_content(file_storage, option: str = 'describe', pipeline_mode: str = 'ocr', with_images: bool = True) -> str:
@@ -959,14 +1074,118 @@ def OpenRouterInference(prompt: str, system_prompt: str = "", image_bytes_list:
 
 
 
+# In-flight VLM requests per provider, shared by every document being extracted
+VLM_MAX_INFLIGHT = {
+    "deepinfra": int(os.getenv("VLM_MAX_INFLIGHT_DEEPINFRA", "4")),
+    "ollama": int(os.getenv("VLM_MAX_INFLIGHT_OLLAMA", str(OLLAMA_NUM_PARALLEL))),
+}
+VLM_BATCH_RETRIES = int(os.getenv("VLM_BATCH_RETRIES", "2"))
+VLM_RETRY_DELAY = float(os.getenv("VLM_RETRY_DELAY", "2"))
+_vlm_slots = {provider: threading.BoundedSemaphore(max(1, limit)) for provider, limit in VLM_MAX_INFLIGHT.items()}
+
+# DeepInfraInference / ollama_describe_image report failures as text
+_VLM_ERROR_PREFIXES = (
+    "Error calling DeepInfra API",
+    "Error parsing DeepInfra response",
+    "Error calling Ollama vision API",
+    "An unexpected error occurred",
+)
+
+
+def _is_vlm_error(result) -> bool:
+    if result is None:
+        return True
+    if isinstance(result, list):
+        return any(_is_vlm_error(item) for item in result)
+    return isinstance(result, str) and result.startswith(_VLM_ERROR_PREFIXES)
+
+
+def run_vlm_batches(provider: str, batches: List[Any], call) -> List[Any]:
+    """
+    Runs call(batch) for every batch concurrently, at most VLM_MAX_INFLIGHT[provider]
+    requests at a time across the whole process. A batch whose answer is an error
+    is retried VLM_BATCH_RETRIES times with exponential backoff.
+
+    Returns:
+        The results in batch order.
+
+    Raises:
+        RuntimeError: a batch still failed after its last attempt. The error text
+        is never returned as content; the ingest job retries or fails instead.
+    """
+    slots = _vlm_slots[provider]
+
+    def run_one(batch):
+        result = None
+        for attempt in range(VLM_BATCH_RETRIES + 1):
+            with slots:
+                try:
+                    result = call(batch)
+                except Exception as e:
+                    result = f"An unexpected error occurred: {e}"
+            if not _is_vlm_error(result):
+                return result
+            if attempt < VLM_BATCH_RETRIES:
+                print(f"⚠️ VLM batch failed ({provider}, attempt {attempt + 1}), retrying...")
+                time.sleep(VLM_RETRY_DELAY * (2 ** attempt))
+        print(f"❌ VLM batch failed after {VLM_BATCH_RETRIES + 1} attempts ({provider}).")
+        raise RuntimeError(f"VLM batch failed after {VLM_BATCH_RETRIES + 1} attempts ({provider}): {result}")
+
+    if not batches:
+        return []
+    workers = max(1, min(len(batches), VLM_MAX_INFLIGHT[provider]))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"vlm-{provider}") as pool:
+        return list(pool.map(run_one, batches))
+
+
+def contiguous_page_batches(page_numbers: List[int], batch_size: int) -> List[List[int]]:
+    """
+    Groups indexes of `page_numbers` into batches of at most batch_size that only
+    contain consecutive pages, e.g. pages [1, 2, 5, 6, 7] -> [[0, 1], [2, 3, 4]].
+    """
+    batches: List[List[int]] = []
+    for i, page_num in enumerate(page_numbers):
+        if batches and len(batches[-1]) < batch_size and page_numbers[batches[-1][-1]] == page_num - 1:
+            batches[-1].append(i)
+        else:
+            batches.append([i])
+    return batches
+
+
+# A multi-page VLM answer starts every page with this marker line, e.g. "<<<PAGE 7>>>"
+VLM_PAGE_MARKER_RE = re.compile(r"^[ \t]*<<<PAGE (\d+)>>>[ \t]*$", re.MULTILINE)
+
+
+def split_page_marked_text(text: str, batch_pages: List[int]) -> Optional[List[str]]:
+    """
+    Splits a VLM answer covering batch_pages on its page markers.
+
+    Returns:
+        One text per page of batch_pages, or None when the markers do not name
+        exactly those pages in order.
+    """
+    markers = list(VLM_PAGE_MARKER_RE.finditer(text))
+    if [int(m.group(1)) for m in markers] != list(batch_pages):
+        return None
+    ends = [m.start() for m in markers[1:]] + [len(text)]
+    return [text[m.end():end].strip() for m, end in zip(markers, ends)]
+
+
+def join_page_texts(page_texts: Dict[int, str], page_count: int) -> str:
+    """Pages 1..page_count in order, each followed by PAGE_BREAK (missing pages stay empty)."""
+    return "".join(f"{page_texts.get(page_num, '')}{PAGE_BREAK}" for page_num in range(1, page_count + 1))
+
+
 def extract_and_process_content(file_storage, option: str = 'describe', pipeline_mode: str = 'ocr', with_images: bool = True) -> str:
     """
     UPDATED: This function now processes files by converting them to images 
     and sending them to a VLM for analysis.
     
     - For PDFs: Converts each page to an image and sends all page images.
+    - For office documents (DOCX, PPTX, XLSX, ...): Converted to PDF first, then as PDFs.
     - For Images: Sends the single image.
-    - Other types (DOCX, TXT, etc.) fall back to the legacy OCR text extraction.
+    - Other types (TXT, etc.), and office files that cannot be converted, fall
+      back to the legacy OCR text extraction.
     """
     
     # --- Step 1: Get file bytes ---
@@ -985,33 +1204,56 @@ def extract_and_process_content(file_storage, option: str = 'describe', pipeline
 
     file_ext = os.path.splitext(file_storage.filename)[1].lower()
     image_bytes_list = []
+    image_page_numbers = []   # 1-indexed page of each entry of image_bytes_list
+    page_texts = None         # PDFs: {page_num_1_idx: text}, from the text layer and the VLM
+    page_count = 0
+    
+    # Office documents are paged as PDF so they share the text-layer fast path
+    # and the render pool; Docling below stays the fallback
+    if is_office_document(file_storage.filename):
+        pdf_bytes = convert_office_to_pdf(file_bytes, file_storage.filename)
+        if pdf_bytes:
+            file_bytes = pdf_bytes
+            file_ext = '.pdf'
     
     # --- Step 2: Convert file to list of images ---
     
     if file_ext == '.pdf':
-        print(f"Processing PDF '{file_storage.filename}': Converting pages to images...")
+        print(f"Processing PDF '{file_storage.filename}': Classifying pages...")
         try:
-            pdf_document = fitz.open(stream=file_bytes, filetype="pdf")
-            page_count = len(pdf_document)
-            print(f"PDF has {page_count} pages.")
+            # Born-digital pages come straight from the text layer; only
+            # scanned / graphic pages are rendered and sent to the VLM.
+            page_plan = classify_pdf_pages(file_bytes)
+            page_count = len(page_plan)
+            page_texts = {page["page_num_1_idx"]: page["text"] for page in page_plan if page["use_text_layer"]}
+            vlm_pages_0_idx = [page["page_num_1_idx"] - 1 for page in page_plan if not page["use_text_layer"]]
+            print(f"PDF has {page_count} pages: {len(page_texts)} from the text layer, {len(vlm_pages_0_idx)} for the VLM.")
             
-            for page_num_0_idx in range(page_count):
-                page_image_bytes = convert_pdf_page_to_image(file_bytes, page_num_0_idx, dpi=200)
+            # Pages are rasterized in parallel on the shared render pool
+            pages = iter_pdf_pages_pooled(file_bytes, dpi=200, page_numbers_0_idx=vlm_pages_0_idx) if vlm_pages_0_idx else []
+            for page_num_1_idx, page_image_bytes in pages:
                 if page_image_bytes:
                     image_bytes_list.append(page_image_bytes)
+                    image_page_numbers.append(page_num_1_idx)
                 else:
-                    print(f"⚠️ Warning: Could not convert page {page_num_0_idx + 1}")
+                    print(f"⚠️ Warning: Could not convert page {page_num_1_idx}")
             
-            pdf_document.close()
             print(f"✅ Successfully converted {len(image_bytes_list)} pages to images.")
             
         except Exception as e:
             return f"Error opening or converting PDF: {e}"
+        
+        if not image_bytes_list and page_texts:
+            full_content = join_page_texts(page_texts, page_count)
+            if option == 'summarize':
+                return summarize_text_with_llm(full_content)
+            return full_content
             
 
     elif file_ext in ['.png', '.jpg', '.jpeg', '.webp', '.bmp', '.gif']:
         print(f"Processing single image: '{file_storage.filename}'")
         image_bytes_list.append(file_bytes)
+        image_page_numbers.append(1)
         
     else:
         # Fallback for unsupported types: Try the old OCR logic
@@ -1039,17 +1281,9 @@ def extract_and_process_content(file_storage, option: str = 'describe', pipeline
             # pipeline_options_powerpoint = PowerPointPipelineOptions()
             # pipeline_options_excel = ExcelPipelineOptions()
             
-            # Use a generic converter for fallback
-            converter = DocumentConverter(
-                # format_options={
-                #     InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options),
-                #     InputFormat.DOCX: PdfFormatOption(pipeline_options=pipeline_options_word), 
-                #     InputFormat.PPTX: PdfFormatOption(pipeline_options=pipeline_options_powerpoint),
-                #     InputFormat.XLSX: PdfFormatOption(pipeline_options=pipeline_options_excel),
-                #     # InputFormat.XLS: PdfFormatOption(pipeline_options=pipeline_options),
-                #     # InputFormat.TXT: PdfFormatOption(pipeline_options=pipeline_options),
-                # }
-            )
+            # Use the shared generic converter for fallback; its pipeline for this
+            # format is only initialized by the first file of that type
+            converter = get_document_converter("default", docling_input_format(file_ext))
             
             result = converter.convert(doc_stream)
             doc = result.document
@@ -1234,48 +1468,84 @@ Checkpoint# 1: อ่านค่าสถานะจาก Dip-switch เพ
 ### Relevance Filter
 If a specific user question is provided and this page contains no relevant information to answer it, do not extract content of that section.
 """)
-    # Add context about the images
-    page_references = [f"- Document Page {i+1}" for i in range(len(image_bytes_list))]
-    reference_text = "\n".join(page_references)
+    # --- Step 4: Call OpenRouterInference ---
+    print(f"Sending {len(image_bytes_list)} images to DeepInfraInference VLM...")
 
-    # This prompt is sent as the 'user' message
-    final_user_prompt = f"""
+    # Batches never span a text-layer page, so every VLM answer can be put back at its pages
+    vlm_texts = {}  # page_num_1_idx -> text
+    batch_size = 10
+    batches = contiguous_page_batches(image_page_numbers, batch_size)
 
-    I am providing you with {len(image_bytes_list)} images from the file '{file_storage.filename}'. These images represent the pages of the document in sequential order: {reference_text}
+    def describe_batch_remote(batch):
+        batch_pages = [image_page_numbers[i] for i in batch]
+        print(f"Processing pages {batch_pages[0]} to {batch_pages[-1]}...")
+        # Add context about the images
+        reference_text = "\n".join(f"- Document Page {page_num}" for page_num in batch_pages)
 
-    Please analyze all these pages as a single, continuous document and generate the full Markdown extraction as requested in the system prompt. Begin processing from Page 1 and continue sequentially to the end. """
+        # This prompt is sent as the 'user' message
+        final_user_prompt = f"""
 
-    # --- Step 4: Call OpenRouterInference ---
-    print(f"Sending {len(image_bytes_list)} images to DeepInfraInference VLM...")
+    I am providing you with {len(batch)} images from the file '{file_storage.filename}'. These images represent the pages of the document in sequential order: {reference_text}
 
-    vlm_response = ""
-    batch_size = 10
-    for i in range(len(image_bytes_list)//batch_size + 2): # Process in batches of 15
-        print(f"Processing images {(i)*batch_size + 1} to {min((i+1)*batch_size, len(image_bytes_list))}...")
-        if (i)*batch_size >= len(image_bytes_list):
-            break
-
-        if not LOCAL:
-            vlm_response += DeepInfraInference(
-                prompt=final_user_prompt,
-                system_prompt=vlm_system_prompt, # The user's detailed instructions go here
-                image_bytes_list=image_bytes_list[(i)*batch_size:(i+1)*batch_size], # Send in batches of 15 images
-                model_name= "meta-llama/Llama-4-Scout-17B-16E-Instruct" #"Qwen/Qwen3-VL-8B-Instruct" #"deepseek-ai/DeepSeek-OCR" #"Qwen/Qwen2.5-VL-32B-Instruct" # Using a strong VLM Qwen/Qwen3-VL-8B-Instruct Qwen/Qwen3-VL-30B-A3B-Instruct Qwen/Qwen2.5-VL-32B-Instruct
-            ) + "\n\n"
-            print(vlm_response)
-        else :
-             # System prompt for OpenRouter VLM
-            vlm_system_prompt = ("You're an image expert."
-                             "If the image contains text, extract and summarize it...")
-            # Prompt for OpenRouter VLM
-            final_user_prompt = ("Please describe the image in detail in a text format that allows you to understand its details.")
-            vlm_response_L = ollama_describe_image(
-                image_bytes=image_bytes_list[(i)*batch_size:(i+1)*batch_size],
-                model="qwen3-vl:2b-instruct",
-                prompt=final_user_prompt,
-                system_prompt=vlm_system_prompt
-                )
-            vlm_response += "\n\n".join(vlm_response_L) + "\n\n"
+    Please analyze all these pages as a single, continuous document and generate the full Markdown extraction as requested in the system prompt. Begin processing from Page {batch_pages[0]} and continue sequentially to the end.
+
+    Start the extraction of every page with a line containing only its marker, e.g. <<<PAGE {batch_pages[0]}>>>, and write one marker for each of the {len(batch)} pages. """
+
+        vlm_text = DeepInfraInference(
+            prompt=final_user_prompt,
+            system_prompt=vlm_system_prompt, # The user's detailed instructions go here
+            image_bytes_list=[image_bytes_list[i] for i in batch],
+            model_name= "meta-llama/Llama-4-Scout-17B-16E-Instruct" #"Qwen/Qwen3-VL-8B-Instruct" #"deepseek-ai/DeepSeek-OCR" #"Qwen/Qwen2.5-VL-32B-Instruct" # Using a strong VLM Qwen/Qwen3-VL-8B-Instruct Qwen/Qwen3-VL-30B-A3B-Instruct Qwen/Qwen2.5-VL-32B-Instruct
+        )
+        if _is_vlm_error(vlm_text):
+            return vlm_text
+        if len(batch) == 1:
+            return [vlm_text]
+        per_page = split_page_marked_text(vlm_text, batch_pages)
+        if per_page is None:
+            # The markers came back wrong; ask again one page at a time
+            print(f"⚠️ Page markers missing for pages {batch_pages[0]} to {batch_pages[-1]}, describing them one by one...")
+            per_page = []
+            for i in batch:
+                page_result = describe_batch_remote([i])
+                if _is_vlm_error(page_result):
+                    return page_result
+                per_page.extend(page_result)
+        return per_page
+
+    def describe_batch_local(batch):
+        batch_pages = [image_page_numbers[i] for i in batch]
+        print(f"Processing pages {batch_pages[0]} to {batch_pages[-1]}...")
+         # System prompt for OpenRouter VLM
+        local_system_prompt = ("You're an image expert."
+                         "If the image contains text, extract and summarize it...")
+        # Prompt for OpenRouter VLM
+        local_user_prompt = ("Please describe the image in detail in a text format that allows you to understand its details.")
+        return ollama_describe_image(
+            image_bytes=[image_bytes_list[i] for i in batch],
+            model="qwen3-vl:2b-instruct",
+            prompt=local_user_prompt,
+            system_prompt=local_system_prompt
+            )
+
+    # All batches are in flight at once (up to the provider's limit); results come back in batch order
+    if not LOCAL:
+        batch_results = run_vlm_batches("deepinfra", batches, describe_batch_remote)
+        for batch, vlm_response_R in zip(batches, batch_results):
+            # One text per page, split on the page markers
+            vlm_texts.update(zip((image_page_numbers[i] for i in batch), vlm_response_R))
+    else :
+        batch_results = run_vlm_batches("ollama", batches, describe_batch_local)
+        for batch, vlm_response_L in zip(batches, batch_results):
+            # One description per page
+            vlm_texts.update(zip((image_page_numbers[i] for i in batch), vlm_response_L))
+
+    # Merge text-layer and VLM pages back in reading order, one PAGE_BREAK per page
+    if page_texts is not None:
+        page_texts.update(vlm_texts)
+        vlm_response = join_page_texts(page_texts, page_count)
+    else:
+        vlm_response = join_page_texts(vlm_texts, max(vlm_texts, default=0))
 
     print(vlm_response)
     print("✅ VLM processing complete.")
@@ -1436,10 +1706,11 @@ def DeepInfraInference(prompt: str = "", system_prompt: str = "", image_bytes_li
 
     # --- API Call Section (Modified for DeepInfra) ---
     try:
+        # Copy: the option templates are shared by concurrent calls
         if model_name in parameter_option.keys():
-            parameter = parameter_option[model_name]
+            parameter = dict(parameter_option[model_name])
         else:
-            parameter = parameter_option['normal']
+            parameter = dict(parameter_option['normal'])
         parameter['model'] = model_name
         parameter['messages'] = messages
         response = requests.post(
@@ -1853,33 +2124,37 @@ def get_image_embedding_jinna_api_local(
     text: str = None, 
     search_text: str = None,
     image_bytes_list: List[bytes] = None, 
-    model_name: str = "jinaai/jina-embeddings-v4"
+    model_name: str = "jinaai/jina-embeddings-v4",
+    pil_images: List[Image.Image] = None,
 ) -> Union[Optional[List[float]], Optional[List[List[float]]]]:
     """
     Gets a multimodal embedding locally using SentenceTransformer (Jina v4).
 
     - If 'text' is provided: Generates a hypothetical document description using an LLM, 
-      then embeds that description. Returns one embedding (List[float]).
+      then embeds that description. Returns one float32 embedding (np.ndarray).
     - If 'image_bytes_list' is provided: Embeds a batch of images. 
-      Returns a list of embeddings (List[List[float]]).
+      Returns a list of float32 embeddings (List[np.ndarray]).
+    - If 'pil_images' is provided: Same as 'image_bytes_list' for images that are
+      already decoded (e.g. by the ingest pipeline's preprocess stage).
     
     Args:
         text: The text string to embed.
         image_bytes_list: A list of raw image bytes to embed.
         model_name: The HuggingFace model ID to use.
+        pil_images: A list of decoded PIL images to embed.
 
     Returns:
-        A single embedding vector (List[float]) if 'text' was used.
-        A list of embedding vectors (List[List[float]]) if 'image_bytes_list' was used.
+        A single float32 embedding vector (np.ndarray) if 'text' was used.
+        A list of float32 embedding vectors (List[np.ndarray]) if images were used.
         None on failure.
     """
     global _JINA_MODEL_INSTANCE
 
     # 1. Input Validation
-    if (text or search_text) and image_bytes_list:
+    if (text or search_text) and (image_bytes_list or pil_images):
         print("Error: Provide either 'text' OR 'image_bytes_list', not both.")
         return None
-    if not text and not search_text and not image_bytes_list:
+    if not text and not search_text and not image_bytes_list and not pil_images:
         print("Error: Must provide either 'text' or 'image_bytes_list'.")
         return None
 
@@ -1931,36 +2206,55 @@ Output only the descriptive paragraph. No introductory text.
                 # model.to("cpu")
                 clear_gpu()
             
-            # Convert numpy array to list
             print(f"✅ Generated Jina v4 embedding for text.")
-            return embedding[0].tolist()
+            return to_float32(embedding[0])
         
         # 4. Handle Image Input (Retrieval Passage)
-        elif image_bytes_list:
-            print(f"Generating Jina v4 embedding (Type: {len(image_bytes_list)} Images)...")
-            
+        else:
             # Convert raw bytes to PIL Images
-            pil_images = []
-            for img_bytes in image_bytes_list:
-                pil_images.append(Image.open(io.BytesIO(img_bytes)))
+            if pil_images is None:
+                pil_images = []
+                for img_bytes in image_bytes_list:
+                    pil_images.append(Image.open(io.BytesIO(img_bytes)))
+            print(f"Generating Jina v4 embedding (Type: {len(pil_images)} Images)...")
             
-            # Encode images (Batch processing is handled automatically by SentenceTransformer)
+            # Encode images in the largest batches the GPU takes (see utils/gpu_batching.py)
             # Task 'retrieval.passage' optimizes the embedding for being indexed
             # Note: Ensure the specific Jina model supports image inputs (like Jina-CLIP or specific V4 variants)
-            # model.to(device)
-            with torch.no_grad():
-                embeddings = model.encode(pil_images,batch_size=1, convert_to_numpy=True) # task="retrieval.passage" is implied for non-query inputs usually, or add if model supports
-                # model.to("cpu")
-                clear_gpu()
+            embeddings = run_adaptive_batches(
+                model_name, pil_images,
+                lambda batch: model.encode(batch, batch_size=len(batch), convert_to_numpy=True),
+            )
             
             print(f"✅ Generated {len(embeddings)} Jina v4 embeddings for images.")
-            return embeddings.tolist()
+            # One contiguous float32 row per image
+            return list(to_float32(embeddings))
 
     except Exception as e:
         print(f"An unexpected error occurred during local embedding generation: {e}")
         return None
 
 
+def warm_embedding_batch_sizes(model_name: str = "jinaai/jina-embeddings-v4") -> bool:
+    """
+    Probes the largest image batch the local Jina model takes for each
+    GPU_BATCH_PROBE_SIZES page size, so the first documents already run at it.
+    """
+    if not LOCAL or model is None:
+        return False
+    try:
+        for width, height in parse_probe_sizes():
+            make_pages = lambda n: [Image.new("RGB", (width, height), color="white") for _ in range(n)]
+            probe_batch_size(
+                model_name, resolution_bucket(make_pages(1)), make_pages,
+                lambda batch: model.encode(batch, batch_size=len(batch), convert_to_numpy=True),
+            )
+        return True
+    except Exception as e:
+        print(f"❌ Batch size probe failed: {e}")
+        return False
+
+
 def get_image_embedding_local_api_colpali_engine(
     text: str = None, 
     image_bytes_list: List[bytes] = None, 
@@ -2372,12 +2666,9 @@ Output only the descriptive paragraph. No introductory text.
                     print(f"Error processing image: {e}")
                     images.append(Image.new("RGB", (512, 512), color="white"))  # Placeholder
 
-            # Batch process (small batches to avoid OOM)
-            batch_size = 1  # Adjust based on GPU memory
-            all_embeddings = []
-            for i in range(0, len(images), batch_size):
-                batch_images = images[i:i + batch_size]
-                print(f"Processing batch {i//batch_size + 1} with {len(batch_images)} images...")
+            # Batches as large as the GPU allows; an OOM splits the batch (see utils/gpu_batching.py)
+            def embed_batch(batch_images):
+                print(f"Processing batch of {len(batch_images)} images...")
 
                 # Step 2a: Preprocess to pixel_values [batch, 3, 512, 512]
                 # Provide dummy text input to satisfy processor requirements
@@ -2440,8 +2731,9 @@ Output only the descriptive paragraph. No introductory text.
                         batch_emb = full_outputs.last_hidden_state.mean(dim=1)  # Pool to [batch, 2048]
 
                 # Convert to list
-                batch_emb_list = batch_emb.cpu().numpy().tolist()
-                all_embeddings.extend(batch_emb_list)
+                return batch_emb.cpu().numpy().tolist()
+
+            all_embeddings = run_adaptive_batches(model_name, images, embed_batch, bucket="512x512")
 
             # Check count
             if len(all_embeddings) != len(image_bytes_list):
@@ -2671,7 +2963,13 @@ Output only the descriptive paragraph.
 #  LEGACY & NEW: DATABASE SAVE/SEARCH
 # ==============================================================================
     
-def encode_text_for_embedding(text: str, target_dimensions: int = 2048, is_query: bool = False) -> list[float]:
+def _text_embedding_cache_key(text: str, target_dimensions: int, is_query: bool, task: str = 'retrieval') -> str:
+    # Local model and Jina API vectors are cached apart; Ollama fallback results are never cached
+    model_id = "jinaai/jina-embeddings-v4" if model is not None else "jina-api/jina-embeddings-v4"
+    return embedding_cache_key(model_id, task, is_query, target_dimensions, text)
+
+
+def encode_text_for_embedding(text: str, target_dimensions: int = 2048, is_query: bool = False) -> np.ndarray:
     """
     Convert text into an embedding vector using pre-loaded model (FAST).
     Falls back to Ollama if pre-loaded model unavailable.
@@ -2683,7 +2981,7 @@ def encode_text_for_embedding(text: str, target_dimensions: int = 2048, is_query
                   การใช้ task ที่ถูกต้องช่วยให้ cross-lingual search ทำงานได้ดี
     
     Returns:
-        list[float]: embedding vector (2048 dims)
+        np.ndarray: float32 embedding vector (2048 dims)
     """
     global model  # Use the pre-loaded model
     
@@ -2696,27 +2994,24 @@ def encode_text_for_embedding(text: str, target_dimensions: int = 2048, is_query
     # Note: is_query ยังคงใช้ประโยชน์สำหรับ logging และ API fallback
     task = 'retrieval'  # Jina v4 ใช้ task เดียวกันสำหรับทั้ง query และ passage
     
+    # Same text, model and settings: reuse the vector (see utils/embedding_cache.py)
+    cache_key = _text_embedding_cache_key(text, target_dimensions, is_query)
+    cached = text_embedding_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
     try:
         # Use the pre-loaded Jina embedding model (FAST - no reload)
         if model is not None:
             mode_str = 'QUERY' if is_query else 'DOCUMENT'
             print(f"⚡ Using PRE-LOADED Jina model (task={task}, mode={mode_str}) for embedding...")
-            embedding = model.encode(text, task=task)
-            embedding_list = embedding.tolist()
-            
-            # Adjust dimensions to target_dimensions (2048)
-            current_dim = len(embedding_list)
-            if current_dim < target_dimensions:
-                # Pad with zeros
-                padding = [0.0] * (target_dimensions - current_dim)
-                embedding_list.extend(padding)
-                print(f"✅ Padded embedding from {current_dim} to {target_dimensions} dimensions")
-            elif current_dim > target_dimensions:
-                # Truncate
-                embedding_list = embedding_list[:target_dimensions]
-                print(f"✅ Truncated embedding from {current_dim} to {target_dimensions} dimensions")
+            embedding = model.encode(text, task=task, convert_to_numpy=True)
             
-            return embedding_list
+            # Adjust dimensions to target_dimensions (2048): zero-pad or truncate
+            current_dim = len(embedding)
+            if current_dim != target_dimensions:
+                print(f"✅ Resized embedding from {current_dim} to {target_dimensions} dimensions")
+            return text_embedding_cache.put(cache_key, fit_dimensions(embedding, target_dimensions))
         else:
             print("⚠️ Model not initialized (model=None). Using Jinna API (Provider API) fallback ...")
             # ส่ง is_query ไปยัง API เพื่อใช้ task ที่ถูกต้อง
@@ -2726,13 +3021,7 @@ def encode_text_for_embedding(text: str, target_dimensions: int = 2048, is_query
                 embedding_list = get_image_embedding_jinna_api(text=text)  # retrieval.passage
             if embedding_list and len(embedding_list) > 0:
                 # Adjust dimensions for API fallback too
-                current_dim = len(embedding_list)
-                if current_dim < target_dimensions:
-                    padding = [0.0] * (target_dimensions - current_dim)
-                    embedding_list.extend(padding)
-                elif current_dim > target_dimensions:
-                    embedding_list = embedding_list[:target_dimensions]
-                return embedding_list
+                return text_embedding_cache.put(cache_key, fit_dimensions(embedding_list, target_dimensions))
             else:
                 raise ValueError("Ollama returned empty embedding")
             
@@ -2744,20 +3033,143 @@ def encode_text_for_embedding(text: str, target_dimensions: int = 2048, is_query
                 embedding_result = embedding_list[0]
                 # Adjust dimensions for Ollama fallback
                 current_dim = len(embedding_result)
-                if current_dim < target_dimensions:
-                    padding = [0.0] * (target_dimensions - current_dim)
-                    embedding_result.extend(padding)
-                    print(f"✅ Padded Ollama embedding from {current_dim} to {target_dimensions} dimensions")
-                elif current_dim > target_dimensions:
-                    embedding_result = embedding_result[:target_dimensions]
-                    print(f"✅ Truncated Ollama embedding from {current_dim} to {target_dimensions} dimensions")
-                return embedding_result
+                if current_dim != target_dimensions:
+                    print(f"✅ Resized Ollama embedding from {current_dim} to {target_dimensions} dimensions")
+                return fit_dimensions(embedding_result, target_dimensions)
             else:
                 raise ValueError("Ollama returned empty embedding")
         except Exception as ollama_error:
             print(f"❌ ALL embedding methods failed: {ollama_error}")
             raise ValueError(f"Embedding failed: {ollama_error}")
 
+
+TEXT_EMBED_BATCH_SIZE = int(os.getenv("TEXT_EMBED_BATCH_SIZE", "16"))
+
+
+def get_embedding_token_counter():
+    """
+    Token counter of the pre-loaded embedding model, for sizing text chunks.
+    Returns None when the model (or its tokenizer) is not available.
+    """
+    tokenizer = getattr(model, "tokenizer", None) if model is not None else None
+    if tokenizer is None or not hasattr(tokenizer, "encode"):
+        return None
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
+
+def encode_texts_for_embedding(texts: List[str], target_dimensions: int = 2048, is_query: bool = False,
+                               batch_size: int = TEXT_EMBED_BATCH_SIZE) -> List[np.ndarray]:
+    """
+    Batched version of encode_text_for_embedding for many passages (e.g. chunks).
+
+    The pre-loaded Jina model encodes `batch_size` texts per forward pass; without
+    it the Jina API is called per text, then Ollama for the whole list.
+
+    Returns:
+        One float32 vector (target_dimensions) per input text, in input order.
+    """
+    if not texts:
+        return []
+    if any(not text or not text.strip() for text in texts):
+        raise ValueError("Cannot create embedding from empty text")
+
+    # Only texts that are not cached yet are embedded
+    cache_keys = [_text_embedding_cache_key(text, target_dimensions, is_query) for text in texts]
+    results: List[Optional[np.ndarray]] = [text_embedding_cache.get(key) for key in cache_keys]
+    missing = [i for i, embedding in enumerate(results) if embedding is None]
+    if not missing:
+        return results
+    missing_texts = [texts[i] for i in missing]
+
+    try:
+        if model is not None:
+            print(f"⚡ Using PRE-LOADED Jina model for {len(missing_texts)} texts (batch_size={batch_size})...")
+            with torch.no_grad():
+                embeddings = model.encode(missing_texts, task='retrieval', batch_size=batch_size, convert_to_numpy=True)
+        else:
+            print("⚠️ Model not initialized (model=None). Using Jinna API (Provider API) fallback ...")
+            embeddings = []
+            for text in missing_texts:
+                if is_query:
+                    embedding = get_image_embedding_jinna_api(search_text=text)
+                else:
+                    embedding = get_image_embedding_jinna_api(text=text)
+                if not embedding:
+                    raise ValueError("Jina API returned empty embedding")
+                embeddings.append(embedding)
+        stored = text_embedding_cache.put_many([
+            (cache_keys[i], fit_dimensions(embedding, target_dimensions)) for i, embedding in zip(missing, embeddings)
+        ])
+        for i, embedding in zip(missing, stored):
+            results[i] = embedding
+        return results
+    except Exception as e:
+        print(f"❌ Jina batch embedding error: {e}. Trying Ollama fallback...")
+        embeddings = ollama_embed_text(text=missing_texts, model="qwen3-embedding:0.6b")
+        if len(embeddings) != len(missing_texts) or any(not embedding for embedding in embeddings):
+            raise ValueError(f"Embedding failed: {e}")
+        for i, embedding in zip(missing, embeddings):
+            results[i] = fit_dimensions(embedding, target_dimensions)
+        return results
+
+
+def _encode_text_group(key, texts: List[str]) -> List[np.ndarray]:
+    target_dimensions, is_query = key
+    return encode_texts_for_embedding(texts, target_dimensions=target_dimensions, is_query=is_query)
+
+
+# Texts of concurrent requests share forward passes; sorted by length so each
+# padded sub-batch of TEXT_EMBED_BATCH_SIZE holds texts of similar length
+_text_embedding_scheduler = MicroBatchScheduler(_encode_text_group, sort_key=len, name="text-embedding-batcher")
+
+
+def encode_text_for_embedding_batched(text: str, target_dimensions: int = 2048, is_query: bool = False) -> np.ndarray:
+    """
+    encode_text_for_embedding() for request handlers: the text is embedded
+    together with the texts of concurrent requests (see utils/embed_scheduler.py).
+    """
+    if not EMBED_BATCHING_ENABLED:
+        return encode_text_for_embedding(text, target_dimensions=target_dimensions, is_query=is_query)
+    return encode_texts_for_embedding_batched([text], target_dimensions, [is_query])[0]
+
+
+def encode_texts_for_embedding_batched(texts: List[str], target_dimensions: int = 2048,
+                                       is_query: Union[bool, List[bool]] = False) -> List[np.ndarray]:
+    """
+    Many texts of one request, each with its own is_query flag, embedded through
+    the cross-request scheduler (or one encode_texts_for_embedding call per flag
+    when batching is disabled).
+
+    Returns:
+        One float32 vector (target_dimensions) per input text, in input order.
+    """
+    flags = [bool(flag) for flag in is_query] if isinstance(is_query, (list, tuple)) else [bool(is_query)] * len(texts)
+    if len(flags) != len(texts):
+        raise ValueError(f"Expected {len(texts)} is_query flags, got {len(flags)}")
+    if any(not text or not text.strip() for text in texts):
+        raise ValueError("Cannot create embedding from empty text")
+
+    if EMBED_BATCHING_ENABLED:
+        # Cached texts are answered right away instead of waiting for a batch
+        # (a miss is counted once, by encode_texts_for_embedding)
+        pending = []
+        for text, flag in zip(texts, flags):
+            cached = text_embedding_cache.get(_text_embedding_cache_key(text, target_dimensions, flag), count_miss=False)
+            pending.append(cached if cached is not None else _text_embedding_scheduler.submit((target_dimensions, flag), text))
+        return [item if isinstance(item, np.ndarray) else item.result() for item in pending]
+
+    results: List[Optional[np.ndarray]] = [None] * len(texts)
+    for flag in set(flags):
+        indexes = [i for i, item_flag in enumerate(flags) if item_flag == flag]
+        embeddings = encode_texts_for_embedding([texts[i] for i in indexes], target_dimensions, is_query=flag)
+        for i, embedding in zip(indexes, embeddings):
+            results[i] = embedding
+    return results
+
+
+def get_text_embedding_scheduler_stats() -> Dict[str, Any]:
+    return _text_embedding_scheduler.stats()
+
 def clean_text(input_text: str) -> str:
     """
     (Original function, unchanged)
@@ -2777,89 +3189,194 @@ def save_vector_to_db(user_id, chat_history_id, uploaded_file_id, file_name, tex
     UPDATED:
     - Takes 'uploaded_file_id' instead of 'chat_history_id' to link to the file.
     - Takes 'page_number' (defaults to -1).
+    - Single-row convenience wrapper around EmbeddingBulkWriter; use the writer
+      directly to store a whole document.
     """
-    # Convert Python list to PostgreSQL vector literal (e.g., '[0.1, 0.2, 0.3]')
-    vector_literal = f"[{', '.join(map(str, embedding))}]"
-    conn = None
     try:
-        # Clean text before inserting
-        text = clean_text(text)
-        
-        print(f"🔍 DEBUG save_vector_to_db:")
-        print(f"  - user_id: {user_id}")
-        print(f"  - chat_history_id: {chat_history_id}")
-        print(f"  - uploaded_file_id: {uploaded_file_id}")
-        print(f"  - file_name: {file_name}")
-        print(f"  - text length: {len(text)}")
-        print(f"  - embedding dims: {len(embedding)}")
-        print(f"  - page_number: {page_number}")
-
-        conn = get_db_connection()
-        if not conn:
-            raise Exception("❌ Could not connect to database")
-        
-        print(f"✅ Database connection established")
-        
-        cur = conn.cursor()
-
-        query = """
-            INSERT INTO document_embeddings (user_id, chat_history_id, uploaded_file_id, extracted_text, embedding, page_number)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        """
-        
-        print(f"🔍 Executing query with parameters: user_id={user_id}, chat_history_id={chat_history_id}, uploaded_file_id={uploaded_file_id}")
-
-        cur.execute(query, (user_id, chat_history_id, uploaded_file_id, text, vector_literal, page_number))
-
-        conn.commit()
-        cur.close()
-        print("✅ Legacy vector saved to database successfully (page: -1).")
+        with EmbeddingBulkWriter(uploaded_file_id, replace_existing=False) as writer:
+            writer.add_texts(user_id, chat_history_id, [(text, embedding, page_number)])
+        print(f"✅ Legacy vector saved to database successfully (file: {file_name}, page: {page_number}).")
         return True
-        
     except Exception as e:
         print(f"❌ Failed to save legacy vector: {e}")
         import traceback
         traceback.print_exc()
-        if conn:
-            conn.rollback()
         return False
-        
-    finally:
-        if conn:
-            conn.close()
-            print("✅ Database connection closed")
 
 # --- NEW: Save Page Vector Function ---
 def save_page_vector_to_db(user_id, chat_history_id, uploaded_file_id, page_number, embedding):
     """
     Save image embedding to the 'document_page_embeddings' table (New).
+    Single-row convenience wrapper around EmbeddingBulkWriter.
     """
-    vector_literal = f"[{', '.join(map(str, embedding))}]"
-    conn = None
     try:
-        conn = get_db_connection()
-        if not conn:
+        with EmbeddingBulkWriter(uploaded_file_id, replace_existing=False) as writer:
+            writer.add_pages(user_id, chat_history_id, [(page_number, embedding)])
+        print(f"✅ Page image vector saved to database (Page: {page_number}).")
+    except Exception as e:
+        print(f"❌ Failed to save page image vector (Page: {page_number}): {e}")
+
+
+class EmbeddingBulkWriter:
+    """
+    Stores all embedding rows of one document in a single transaction.
+
+        with EmbeddingBulkWriter(uploaded_file_id) as writer:
+            writer.add_pages(user_id, chat_history_id, [(page_number, embedding), ...])
+            writer.add_texts(user_id, chat_history_id, [(text, embedding, page_number), ...])
+
+    Rows are streamed with a binary COPY (float32 vectors, no text formatting) and committed
+    when the block exits cleanly; any exception rolls everything back, so a
+    half-indexed file is never searchable. With replace_existing=True the file's
+    previous rows are deleted in the same transaction, which makes a retried
+    ingestion job idempotent.
+    """
+
+    def __init__(self, uploaded_file_id: int, replace_existing: bool = True):
+        self.uploaded_file_id = uploaded_file_id
+        self.replace_existing = replace_existing
+        self.conn = None
+        self.cur = None
+        self.rows_written = {"document_embeddings": 0, "document_page_embeddings": 0}
+
+    def __enter__(self):
+        self.conn = get_db_connection()
+        if not self.conn:
             raise Exception("Could not connect to database")
-            
-        cur = conn.cursor()
+        # __exit__ does not run when __enter__ raises: hand the connection back here
+        try:
+            self.cur = self.conn.cursor()
+            # The pool's statement_timeout would cancel the COPY of a large document
+            self.cur.execute("SET LOCAL statement_timeout = %s;", (DB_BULK_STATEMENT_TIMEOUT_MS,))
+            if self.replace_existing:
+                self.cur.execute("DELETE FROM document_embeddings WHERE uploaded_file_id = %s;", (self.uploaded_file_id,))
+                self.cur.execute("DELETE FROM document_page_embeddings WHERE uploaded_file_id = %s;", (self.uploaded_file_id,))
+        except Exception:
+            try:
+                self.conn.rollback()
+            except Exception:
+                pass
+            self.conn.close()
+            self.conn = self.cur = None
+            raise
+        return self
+
+    def add_pages(self, user_id: int, chat_history_id: int, rows: List[tuple]):
+        """rows: [(page_number, embedding), ...] for 'document_page_embeddings'."""
+        if not rows:
+            return
+        copy_rows_binary(
+            self.cur,
+            "document_page_embeddings",
+            ("user_id", "chat_history_id", "uploaded_file_id", "page_number", "embedding"),
+            (
+                (user_id, chat_history_id, self.uploaded_file_id, page_number, to_float32(embedding))
+                for page_number, embedding in rows
+            ),
+        )
+        self.rows_written["document_page_embeddings"] += len(rows)
+
+    def add_texts(self, user_id: int, chat_history_id: int, rows: List[tuple]):
+        """rows: [(text, embedding, page_number), ...] for 'document_embeddings'."""
+        if not rows:
+            return
+        copy_rows_binary(
+            self.cur,
+            "document_embeddings",
+            ("user_id", "chat_history_id", "uploaded_file_id", "extracted_text", "embedding", "page_number"),
+            (
+                (user_id, chat_history_id, self.uploaded_file_id, clean_text(text), to_float32(embedding), page_number)
+                for text, embedding, page_number in rows
+            ),
+        )
+        self.rows_written["document_embeddings"] += len(rows)
 
-        print(f"user_id:{user_id}")
-        print(f"chat_id:{chat_history_id}")
+    def add_pages_from_checkpoints(self, user_id: int, chat_history_id: int) -> int:
+        """
+        Moves the file's 'ingest_page_checkpoints' rows (see job_queue.PageCheckpoint)
+        into 'document_page_embeddings'. The checkpoints are only gone once the
+        whole transaction commits.
 
-        query = """
-            INSERT INTO document_page_embeddings (user_id, chat_history_id, uploaded_file_id, page_number, embedding)
-            VALUES (%s, %s, %s, %s, %s)
+        Returns:
+            Number of pages published.
         """
+        self.cur.execute(
+            """
+            INSERT INTO document_page_embeddings (user_id, chat_history_id, uploaded_file_id, page_number, embedding)
+            SELECT %s, %s, uploaded_file_id, page_number, embedding
+            FROM ingest_page_checkpoints WHERE uploaded_file_id = %s
+            ORDER BY page_number;
+            """,
+            (user_id, chat_history_id, self.uploaded_file_id)
+        )
+        count = self.cur.rowcount
+        self.cur.execute("DELETE FROM ingest_page_checkpoints WHERE uploaded_file_id = %s;", (self.uploaded_file_id,))
+        self.rows_written["document_page_embeddings"] += count
+        return count
 
-        cur.execute(query, (user_id, chat_history_id, uploaded_file_id, page_number, vector_literal))
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.conn.commit()
+                print(f"✅ Bulk write committed for file {self.uploaded_file_id}: {self.rows_written}")
+            else:
+                self.conn.rollback()
+                print(f"❌ Bulk write rolled back for file {self.uploaded_file_id}: {exc}")
+        finally:
+            self.cur.close()
+            self.conn.close()
+        return False
+
+
+def copy_file_embeddings(source_file_id: int, user_id: int, chat_history_id: int, uploaded_file_id: int) -> int:
+    """
+    Copies every 'document_embeddings' and 'document_page_embeddings' row of an
+    already indexed file to a new file record (same content, other chat/user),
+    in one transaction. Used to skip re-extraction and re-embedding of duplicates.
+    Rows the target file already has (from an earlier attempt of the job) are
+    replaced, so running the copy again never duplicates them.
 
+    Returns:
+        Number of rows copied (0 when the source has none or on failure).
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        if not conn:
+            raise Exception("Could not connect to database")
+        cur = conn.cursor()
+        cur.execute("SET LOCAL statement_timeout = %s;", (DB_BULK_STATEMENT_TIMEOUT_MS,))
+        cur.execute("DELETE FROM document_embeddings WHERE uploaded_file_id = %s;", (uploaded_file_id,))
+        cur.execute("DELETE FROM document_page_embeddings WHERE uploaded_file_id = %s;", (uploaded_file_id,))
+        cur.execute(
+            """
+            INSERT INTO document_embeddings (user_id, chat_history_id, uploaded_file_id, extracted_text, embedding, page_number)
+            SELECT %s, %s, %s, extracted_text, embedding, page_number
+            FROM document_embeddings WHERE uploaded_file_id = %s
+            ORDER BY id;
+            """,
+            (user_id, chat_history_id, uploaded_file_id, source_file_id)
+        )
+        copied = cur.rowcount
+        cur.execute(
+            """
+            INSERT INTO document_page_embeddings (user_id, chat_history_id, uploaded_file_id, page_number, embedding)
+            SELECT %s, %s, %s, page_number, embedding
+            FROM document_page_embeddings WHERE uploaded_file_id = %s
+            ORDER BY id;
+            """,
+            (user_id, chat_history_id, uploaded_file_id, source_file_id)
+        )
+        copied += cur.rowcount
         conn.commit()
         cur.close()
-        print(f"✅ Page image vector saved to database (Page: {page_number}).")
+        print(f"♻️ Copied {copied} embedding rows from file {source_file_id} to file {uploaded_file_id}.")
+        return copied
     except Exception as e:
-        print(f"❌ Failed to save page image vector (Page: {page_number}): {e}")
+        print(f"❌ Failed to copy embeddings from file {source_file_id}: {e}")
         if conn:
             conn.rollback()
+        return 0
     finally:
         if conn:
             conn.close()
@@ -2878,7 +3395,7 @@ def search_similar_documents_by_chat(query_text: str, user_id: int, chat_history
     #     query_embedding = get_image_embedding_jinna_api(search_text=query_text)
     # else :
     #     query_embedding = get_image_embedding_jinna_api_local(search_text=query_text)
-    query_vector = f"[{', '.join(map(str, query_embedding))}]"
+    query_vector = to_float32(query_embedding)
     
     conn = None
     try:
@@ -2891,24 +3408,26 @@ def search_similar_documents_by_chat(query_text: str, user_id: int, chat_history
         # Step 2: Search within same user and same chat
         # JOIN with uploaded_files to filter by chat_history_id
         print(f"🔍 Searching legacy documents for chat_id={chat_history_id}, threshold={threshold_text}, top_k={top_k}...")
-        query = """
-            SELECT 
-                t1.id AS page_embedding_id, 
-                t2.file_name, 
-                t2.object_name,
-                t1.page_number,
-                t1.extracted_text,
-                t1.embedding <-> %s AS distance
-            FROM document_embeddings AS t1
-            INNER JOIN uploaded_files AS t2 ON t1.uploaded_file_id = t2.id
-            WHERE t2.user_id = %s
-                AND t2.chat_history_id = %s
-                AND (t1.embedding <-> %s) <= %s
-            ORDER BY distance
-            LIMIT %s
-        """
-        cur.execute(query, (query_vector, user_id, chat_history_id, query_vector, threshold_text, top_k))
-        results = cur.fetchall()
+        # Small chats are answered from the in-process vector matrix (utils/chat_vector_cache.py)
+        results = search_chat_vectors(cur, CHAT_TEXT_CHUNKS, user_id, chat_history_id, query_vector, top_k, threshold_text)
+        if results is None:
+            query = prepare_nearest_neighbour_query(
+                cur,
+                columns="""
+                    t1.id AS page_embedding_id, 
+                    t2.file_name, 
+                    t2.object_name,
+                    t1.page_number,
+                    t1.extracted_text""",
+                from_where="""
+                FROM document_embeddings AS t1
+                INNER JOIN uploaded_files AS t2 ON t1.uploaded_file_id = t2.id
+                WHERE t2.user_id = %s
+                    AND t2.chat_history_id = %s""",
+                top_k=top_k,
+            )
+            cur.execute(query, (query_vector, user_id, chat_history_id, query_vector, top_k, threshold_text))
+            results = cur.fetchall()
         cur.close()
 
         # Step 3: Return results
@@ -2938,7 +3457,26 @@ from typing import List, Dict, Any
 # Assuming get_image_embedding_jinna_api and get_db_connection are defined elsewhere
 # import { get_image_embedding_jinna_api, get_db_connection } from ...
 
-def search_similar_pages(query_text: str, user_id: int, chat_history_id: int, top_k: int = 5, threshold: float = 1.0) -> List[Dict[str, Any]]:
+def embed_page_search_text(query_text: str) -> Optional[np.ndarray]:
+    """
+    Query vector of the page searches (Jina v4, local model or API), served from
+    the embedding cache when the same query text was embedded before.
+    """
+    model_id = "jina-api/jina-embeddings-v4" if not LOCAL else "jinaai/jina-embeddings-v4"
+    cache_key = embedding_cache_key(model_id, "retrieval.query", True, 0, query_text)
+    cached = text_embedding_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    if not LOCAL:
+        query_embedding = get_image_embedding_jinna_api(search_text=query_text)
+    else:
+        query_embedding = get_image_embedding_jinna_api_local(search_text=query_text)
+    if query_embedding is None or len(query_embedding) == 0:
+        return None
+    return text_embedding_cache.put(cache_key, query_embedding)
+
+
+def search_similar_pages(query_text: str, user_id: int, chat_history_id: int, top_k: int = 5, threshold: float = 1.0, normalize: bool = True) -> List[Dict[str, Any]]:
     """
     Search (New) from 'document_page_embeddings' table.
     
@@ -2948,21 +3486,19 @@ def search_similar_pages(query_text: str, user_id: int, chat_history_id: int, to
         chat_history_id: The current chat ID.
         top_k: Max number of pages to return *before* normalization/filtering.
         threshold: Max L2 distance for the *initial* SQL query. Results > threshold are excluded by SQL.
+        normalize: False returns the raw distance-ordered matches, see normalize_page_matches().
     
     Returns:
         A list of dicts, e.g.:
         [{'page_id': 12, 'file_name': 'report.pdf', ..., 'distance': 0.25, 'normalized_distance': 0.1}, ...]
     """
     # Step 1: Encode the query text using the *CLIP* model
-    if not LOCAL:
-        query_embedding = get_image_embedding_jinna_api(search_text=query_text)
-    else :
-        query_embedding = get_image_embedding_jinna_api_local(search_text=query_text)
-    if not query_embedding:
+    query_embedding = embed_page_search_text(query_text)
+    if query_embedding is None or len(query_embedding) == 0:
         print("❌ Failed to get CLIP embedding for query.")
         return []
         
-    query_vector = f"[{', '.join(map(str, query_embedding))}]"
+    query_vector = to_float32(query_embedding)
     
     conn = None
     try:
@@ -2975,78 +3511,35 @@ def search_similar_pages(query_text: str, user_id: int, chat_history_id: int, to
         # Step 2: Search within same user and same chat
         # The SQL query remains the same, using the 'threshold' for a coarse first pass
         # and 'top_k' to limit the initial result set.
-        query = """
-            SELECT 
-                t1.id AS page_embedding_id, 
-                t2.file_name, 
-                t2.object_name,
-                t1.page_number,
-                t1.embedding <-> %s AS distance
-            FROM document_page_embeddings AS t1
-            INNER JOIN uploaded_files AS t2 ON t1.uploaded_file_id = t2.id
-            WHERE t2.user_id = %s 
-              AND t2.chat_history_id = %s
-              AND (t1.embedding <-> %s) <= %s
-            ORDER BY distance
-            LIMIT %s
-        """
+        # Small chats are answered from the in-process vector matrix (utils/chat_vector_cache.py)
+        results = search_chat_vectors(cur, CHAT_PAGES, user_id, chat_history_id, query_vector, top_k, threshold)
+        if results is None:
+            query = prepare_nearest_neighbour_query(
+                cur,
+                columns="""
+                    t1.id AS page_embedding_id, 
+                    t2.file_name, 
+                    t2.object_name,
+                    t1.page_number""",
+                from_where="""
+                FROM document_page_embeddings AS t1
+                INNER JOIN uploaded_files AS t2 ON t1.uploaded_file_id = t2.id
+                WHERE t2.user_id = %s 
+                  AND t2.chat_history_id = %s""",
+                top_k=top_k,
+            )
 
-        cur.execute(query, (query_vector, user_id, chat_history_id, query_vector, threshold, top_k))
-        results = cur.fetchall() # This is the raw list of tuples
+            cur.execute(query, (query_vector, user_id, chat_history_id, query_vector, top_k, threshold))
+            results = cur.fetchall() # This is the raw list of tuples
         cur.close()
         print(f"✅ Found {len(results)} raw pages within SQL threshold {threshold}.")
 
-        # --- START: New logic for Normalization and 0.3 Threshold ---
-        if not results:
-            print("ℹ️ No pages found, returning empty list.")
-            return []
-
-        # Get all distances to find min/max for normalization
-        all_distances = [row[4] for row in results]
-        min_dist = min(all_distances)
-        max_dist = max(all_distances)
-        dist_range = max_dist - min_dist
-        
-        print(f"ℹ️ Normalizing distances: min={min_dist:.4f}, max={max_dist:.4f}, range={dist_range:.4f}")
-
-        processed_results = []
-        for row in results:
-            original_distance = row[4]
-            
-            # Handle division by zero if all distances are identical (dist_range == 0)
-            if dist_range == 0:
-                # If all distances are the same, all results are equally good
-                similarity_score = 1.0
-            else:
-                # Min-Max normalization: (value - min) / (max - min)
-                normalized_distance = (original_distance - min_dist) / dist_range
-                # Convert distance to similarity: lower distance = higher similarity
-                similarity_score = 1.0 - normalized_distance
-            
-            processed_results.append({
-                'page_embedding_id': row[0],
-                'file_name': row[1],
-                'object_name': row[2],
-                'page_number': row[3],
-                'distance': original_distance,
-                'similarity_score': similarity_score,
-                'double-precision': f'{similarity_score:.10f}'  # Show full precision
-            })
-        
-        print(f"processed_results : {processed_results}")
-
-        # Now, filter based on the *new* similarity threshold (higher is better)
-        similarity_threshold = 0.5  # Keep results with similarity >= 0.5
-        final_filtered_results = [
-            item for item in processed_results 
-            if item['similarity_score'] >= similarity_threshold
-        ]
-        
-        print(f"ℹ️ Filtered to {len(final_filtered_results)} pages (similarity_score >= {similarity_threshold}).")
-        # --- END: New logic ---
+        matches = _page_match_rows(results)
+        if not normalize:
+            return matches
 
         # Step 3: Return *final filtered* results
-        return final_filtered_results
+        return normalize_page_matches(matches)
 
     except Exception as e:
         print("❌ Failed to perform page similarity search:", e)
@@ -3074,7 +3567,7 @@ def search_similar_documents_by_active_user(query_text: str, user_id: int, top_k
     #     query_embedding = get_image_embedding_jinna_api(search_text=query_text)
     # else :
     #     query_embedding = get_image_embedding_jinna_api_local(search_text=query_text)
-    query_vector = f"[{', '.join(map(str, query_embedding))}]"  
+    query_vector = to_float32(query_embedding)
 
     conn = None
     try:
@@ -3083,22 +3576,21 @@ def search_similar_documents_by_active_user(query_text: str, user_id: int, top_k
         cur = conn.cursor()
 
         # JOIN uploaded_files and filter by active_users array using ANY()
-        query = """
-            SELECT 
+        query = prepare_nearest_neighbour_query(
+            cur,
+            columns="""
                 t1.id AS page_embedding_id, 
                 t2.file_name, 
                 t2.object_name,
                 t1.page_number,
-                t1.extracted_text,
-                t1.embedding <-> %s AS distance
+                t1.extracted_text""",
+            from_where="""
             FROM document_embeddings AS t1
             INNER JOIN uploaded_files AS t2 ON t1.uploaded_file_id = t2.id
-            WHERE %s = ANY(t2.active_users)
-              AND (t1.embedding <-> %s) <= %s
-            ORDER BY distance
-            LIMIT %s
-        """
-        cur.execute(query, (query_vector, user_id, query_vector, threshold_text, top_k))
+            WHERE %s = ANY(t2.active_users)""",
+            top_k=top_k,
+        )
+        cur.execute(query, (query_vector, user_id, query_vector, top_k, threshold_text))
         results = cur.fetchall()
         cur.close()
 
@@ -3118,19 +3610,16 @@ def search_similar_documents_by_active_user(query_text: str, user_id: int, top_k
         if conn: conn.close()
 
 
-def search_similar_pages_by_active_user(query_text: str, user_id: int, top_k: int = 5, threshold: float = 1.0) -> List[Dict[str, Any]]:
+def search_similar_pages_by_active_user(query_text: str, user_id: int, top_k: int = 5, threshold: float = 1.0, normalize: bool = True) -> List[Dict[str, Any]]:
     """
     New Page Search: Finds document pages (images) in files where the user is an 'active_user'.
     """
     # 1. Generate Query Embedding (CLIP/Jina)
-    if not LOCAL:
-        query_embedding = get_image_embedding_jinna_api(search_text=query_text)
-    else:
-        query_embedding = get_image_embedding_jinna_api_local(search_text=query_text)
+    query_embedding = embed_page_search_text(query_text)
 
-    if not query_embedding: return []
+    if query_embedding is None or len(query_embedding) == 0: return []
 
-    query_vector = f"[{', '.join(map(str, query_embedding))}]"
+    query_vector = to_float32(query_embedding)
 
     conn = None
     try:
@@ -3139,59 +3628,28 @@ def search_similar_pages_by_active_user(query_text: str, user_id: int, top_k: in
         cur = conn.cursor()
 
         # 2. Search DB (Filter by active_users)
-        query = """
-            SELECT 
+        query = prepare_nearest_neighbour_query(
+            cur,
+            columns="""
                 t1.id AS page_embedding_id, 
                 t2.file_name, 
                 t2.object_name,
-                t1.page_number,
-                t1.embedding <-> %s AS distance
+                t1.page_number""",
+            from_where="""
             FROM document_page_embeddings AS t1
             INNER JOIN uploaded_files AS t2 ON t1.uploaded_file_id = t2.id
-            WHERE %s = ANY(t2.active_users)
-              AND (t1.embedding <-> %s) <= %s
-            ORDER BY distance
-            LIMIT %s
-        """
-        cur.execute(query, (query_vector, user_id, query_vector, threshold, top_k))
+            WHERE %s = ANY(t2.active_users)""",
+            top_k=top_k,
+        )
+        cur.execute(query, (query_vector, user_id, query_vector, top_k, threshold))
         results = cur.fetchall()
         cur.close()
 
         # 3. Normalize & Filter (Same logic as standard search)
-        if not results: return []
-
-        all_distances = [row[4] for row in results]
-        min_dist = min(all_distances)
-        max_dist = max(all_distances)
-        dist_range = max_dist - min_dist
-        
-        processed_results = []
-        for row in results:
-            original_distance = row[4]
-            
-            if dist_range == 0:
-                similarity_score = 1.0
-            else:
-                normalized_distance = (original_distance - min_dist) / dist_range
-                similarity_score = 1.0 - normalized_distance
-            
-            processed_results.append({
-                'page_embedding_id': row[0],
-                'file_name': row[1],
-                'object_name': row[2],
-                'page_number': row[3],
-                'distance': original_distance,
-                'similarity_score': similarity_score,
-                'double-precision': f'{similarity_score:.10f}'
-            })
-
-        print(f"processed_results : {processed_results}")
-        
-        # Filter by similarity threshold (higher is better)
-        similarity_threshold = 0.5
-        final_filtered_results = [item for item in processed_results if item['similarity_score'] >= similarity_threshold]
-        
-        return final_filtered_results
+        matches = _page_match_rows(results)
+        if not normalize:
+            return matches
+        return normalize_page_matches(matches)
 
     except Exception as e:
         print(f"Error in search_similar_pages_by_active_user: {e}")
@@ -3210,7 +3668,7 @@ def search_similar_documents_by_active_user_all(query_text: str, user_id: int, t
     #     query_embedding = get_image_embedding_jinna_api(search_text=query_text)
     # else :
     #     query_embedding = get_image_embedding_jinna_api_local(search_text=query_text)
-    query_vector = f"[{', '.join(map(str, query_embedding))}]"
+    query_vector = to_float32(query_embedding)
 
     conn = None
     try:
@@ -3219,22 +3677,21 @@ def search_similar_documents_by_active_user_all(query_text: str, user_id: int, t
         cur = conn.cursor()
 
         # JOIN uploaded_files and filter by active_users array using ANY()
-        query = """
-            SELECT 
+        query = prepare_nearest_neighbour_query(
+            cur,
+            columns="""
                 t1.id AS page_embedding_id, 
                 t2.file_name, 
                 t2.object_name,
                 t1.page_number,
-                t1.extracted_text,
-                t1.embedding <-> %s AS distance
+                t1.extracted_text""",
+            from_where="""
             FROM document_embeddings AS t1
             INNER JOIN uploaded_files AS t2 ON t1.uploaded_file_id = t2.id
-            WHERE %s = ANY(t2.active_users)
-              AND (t1.embedding <-> %s) <= %s
-            ORDER BY distance
-            LIMIT %s
-        """
-        cur.execute(query, (query_vector, -1, query_vector, threshold_text, top_k))
+            WHERE %s = ANY(t2.active_users)""",
+            top_k=top_k,
+        )
+        cur.execute(query, (query_vector, -1, query_vector, top_k, threshold_text))
         results = cur.fetchall()
         cur.close()
 
@@ -3254,19 +3711,16 @@ def search_similar_documents_by_active_user_all(query_text: str, user_id: int, t
         if conn: conn.close()
 
 
-def search_similar_pages_by_active_user_all(query_text: str, user_id: int, top_k: int = 5, threshold: float = 1.0) -> List[Dict[str, Any]]:
+def search_similar_pages_by_active_user_all(query_text: str, user_id: int, top_k: int = 5, threshold: float = 1.0, normalize: bool = True) -> List[Dict[str, Any]]:
     """
     New Page Search: Finds document pages (images) in all files where the user is an 'active_user'.
     """
     # 1. Generate Query Embedding (CLIP/Jina)
-    if not LOCAL:
-        query_embedding = get_image_embedding_jinna_api(search_text=query_text)
-    else:
-        query_embedding = get_image_embedding_jinna_api_local(search_text=query_text)
+    query_embedding = embed_page_search_text(query_text)
 
-    if not query_embedding: return []
+    if query_embedding is None or len(query_embedding) == 0: return []
 
-    query_vector = f"[{', '.join(map(str, query_embedding))}]"
+    query_vector = to_float32(query_embedding)
 
     conn = None
     try:
@@ -3274,59 +3728,31 @@ def search_similar_pages_by_active_user_all(query_text: str, user_id: int, top_k
         if not conn: raise Exception("DB Connection failed")
         cur = conn.cursor()
 
-        # 2. Search DB (Filter by active_users)
-        query = """
-            SELECT 
+        # 2. Search DB: bit-quantized candidates re-ranked by exact distance (global knowledge base)
+        query = prepare_binary_rerank_query(
+            cur,
+            columns="""
                 t1.id AS page_embedding_id, 
                 t2.file_name, 
                 t2.object_name,
-                t1.page_number,
-                t1.embedding <-> %s AS distance
+                t1.page_number""",
+            from_where="""
             FROM document_page_embeddings AS t1
             INNER JOIN uploaded_files AS t2 ON t1.uploaded_file_id = t2.id
-            WHERE %s = t2.chat_history_id
-              AND (t1.embedding <-> %s) <= %s
-            ORDER BY distance
-            LIMIT %s
-        """
-        cur.execute(query, (query_vector, -1, query_vector, threshold, top_k))
+            WHERE t1.chat_history_id = %s
+              AND t2.chat_history_id = %s""",
+            top_k=top_k,
+        )
+        cur.execute(query, (query_vector, -1, -1, query_vector, top_k, threshold))
         results = cur.fetchall()
         cur.close()
 
         # 3. Normalize & Filter (Same logic as standard search)
-        if not results: return []
+        matches = _page_match_rows(results)
+        if not normalize:
+            return matches
+        return normalize_page_matches(matches)
 
-        all_distances = [row[4] for row in results]
-        min_dist = min(all_distances)
-        max_dist = max(all_distances)
-        dist_range = max_dist - min_dist
-        
-        processed_results = []
-        for row in results:
-            original_distance = row[4]
-            
-            if dist_range == 0:
-                similarity_score = 1.0
-            else:
-                normalized_distance = (original_distance - min_dist) / dist_range
-                similarity_score = 1.0 - normalized_distance
-            
-            processed_results.append({
-                'page_embedding_id': row[0],
-                'file_name': row[1],
-                'object_name': row[2],
-                'page_number': row[3],
-                'distance': original_distance,
-                'similarity_score': similarity_score,
-                'double-precision': f'{similarity_score:.10f}'
-            })
-
-        print(f"processed_results : {processed_results}")
-        
-        # Filter by similarity threshold (higher is better)
-        similarity_threshold = 0.5
-        final_filtered_results = [item for item in processed_results if item['similarity_score'] >= similarity_threshold]
-        return final_filtered_results
     except Exception as e:
         print(f"Error in search_similar_pages_by_active_user_all: {e}")
         return []
@@ -3521,27 +3947,32 @@ def process_pages_with_vlm(search_results: List[Dict[str, Any]], original_query:
     
     page_references = [] # To tell the VLM what it's looking at
 
+    # 1. Fetch each file once and group the requested pages per file
+    pages_by_object = {}
     for result in search_results:
         object_name = result['object_name']
-        page_num_1_idx = result['page_number']
-        file_name = result['file_name']
-        
-        # 1. Fetch file from cache or MinIO
         if object_name not in file_cache:
             print(f"Fetching '{object_name}' from MinIO...")
-            file_bytes = get_file_from_minio(object_name)
-            if file_bytes:
-                file_cache[object_name] = file_bytes
-            else:
-                print(f"⚠️ Could not fetch file {object_name}. Skipping page {page_num_1_idx}.")
-                continue
-        
-        file_bytes = file_cache[object_name]
-        
-        # 2. Extract the specific page as an image
-        # Page number is 1-indexed in DB, convert to 0-indexed for fitz
-        page_num_0_idx = page_num_1_idx - 1 
-        image_bytes = convert_pdf_page_to_image(file_bytes, page_num_0_idx, dpi=100)
+            file_cache[object_name] = get_file_from_minio(object_name)
+            if not file_cache[object_name]:
+                print(f"⚠️ Could not fetch file {object_name}. Skipping page {result['page_number']}.")
+        if file_cache[object_name]:
+            # Page number is 1-indexed in DB, convert to 0-indexed for fitz
+            pages_by_object.setdefault(object_name, []).append(result['page_number'] - 1)
+
+    # 2. Render each file's pages in one pass over a single open document
+    rendered_pages = {}
+    for object_name, page_numbers_0_idx in pages_by_object.items():
+        for page_num_0_idx, image_bytes in iter_pdf_page_images(file_cache[object_name], page_numbers_0_idx, dpi=100):
+            rendered_pages[(object_name, page_num_0_idx)] = image_bytes
+
+    for result in search_results:
+        object_name = result['object_name']
+        page_num_1_idx = result['page_number']
+        file_name = result['file_name']
+        if not file_cache.get(object_name):
+            continue
+        image_bytes = rendered_pages.get((object_name, page_num_1_idx - 1))
         
         if image_bytes:
             image_bytes_list.append(image_bytes)
@@ -3866,6 +4297,26 @@ Provide your response in Markdown format, following the tagging guidelines provi
 #  NEW: OLLAMA INFERENCE FUNCTIONS
 # ==============================================================================
 
+# Requests in flight to the Ollama server, process-wide; match the server's
+# OLLAMA_NUM_PARALLEL so list inputs fill its parallel slots without queueing there.
+_ollama_slots = threading.BoundedSemaphore(max(1, OLLAMA_NUM_PARALLEL))
+_ollama_session = requests.Session()
+_ollama_session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=max(10, OLLAMA_NUM_PARALLEL)))
+_ollama_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=max(10, OLLAMA_NUM_PARALLEL)))
+
+
+def _ollama_map(fn, items: List[Any]) -> List[Any]:
+    """fn(item) for every item, up to OLLAMA_NUM_PARALLEL at once; results in input order."""
+    def call(item):
+        with _ollama_slots:
+            return fn(item)
+
+    if len(items) <= 1:
+        return [call(item) for item in items]
+    workers = min(len(items), max(1, OLLAMA_NUM_PARALLEL))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ollama") as pool:
+        return list(pool.map(call, items))
+
 
 def ollama_generate_text(prompt: Union[str, List[str]], model: str = "llama3.2:3b", system_prompt: str = "") -> Union[str, List[str]]:
     """
@@ -3886,8 +4337,7 @@ def ollama_generate_text(prompt: Union[str, List[str]], model: str = "llama3.2:3
         prompts = prompt
         single = False
     
-    results = []
-    for p in prompts:
+    def generate(p):
         url = API_OLLAMA
         payload = {
             "model": model,
@@ -3898,15 +4348,17 @@ def ollama_generate_text(prompt: Union[str, List[str]], model: str = "llama3.2:3
             payload["system"] = system_prompt
         
         try:
-            response = requests.post(url, json=payload)
+            response = _ollama_session.post(url, json=payload)
             response.raise_for_status()
             data = response.json()
-            results.append(data.get("response", "No response generated."))
+            return data.get("response", "No response generated.")
         except requests.exceptions.RequestException as e:
-            results.append(f"Error calling Ollama API: {e}")
+            return f"Error calling Ollama API: {e}"
         except Exception as e:
-            results.append(f"An unexpected error occurred: {e}")
+            return f"An unexpected error occurred: {e}"
     
+    # Prompts run concurrently (see _ollama_map), results keep the input order
+    results = _ollama_map(generate, prompts)
     return results[0] if single else results
 
 def ollama_embed_text(text: Union[str, List[str]], model: str = "nomic-embed-text") -> List[List[float]]:
@@ -3956,7 +4408,7 @@ def ollama_describe_image(image_bytes: Union[bytes, List[bytes]], model: str = "
     Returns:
         Description text(s) or error message(s).
     """
-    clear_gpu()
+    # No clear_gpu() here: the model runs in the Ollama server, not in this process
     if isinstance(image_bytes, bytes):
         images = [image_bytes]
         single = True
@@ -3964,9 +4416,7 @@ def ollama_describe_image(image_bytes: Union[bytes, List[bytes]], model: str = "
         images = image_bytes
         single = False
     
-    results = []
-    for img_bytes in images:
-        import base64
+    def describe(img_bytes):
         base64_image = base64.b64encode(img_bytes).decode('utf-8')
         
         url = API_OLLAMA
@@ -3979,18 +4429,21 @@ def ollama_describe_image(image_bytes: Union[bytes, List[bytes]], model: str = "
         }
         
         try:
-            response = requests.post(url, json=payload)
+            response = _ollama_session.post(url, json=payload)
             response.raise_for_status()
             data = response.json()
             # print("Raw output")
             # print(data)
-            results.append(data.get("response", "No description generated."))
+            description = data.get("response", "No description generated.")
         except requests.exceptions.RequestException as e:
-            results.append(f"Error calling Ollama vision API: {e}")
+            description = f"Error calling Ollama vision API: {e}"
         except Exception as e:
-            results.append(f"An unexpected error occurred: {e}")
-        print(f"Description: {results[0]}")
-    clear_gpu()
+            description = f"An unexpected error occurred: {e}"
+        print(f"Description: {description}")
+        return description
+    
+    # Images run concurrently (see _ollama_map), results keep the input order
+    results = _ollama_map(describe, images)
     return results[0] if single else results
 
 def ollama_embed_image(image_bytes: Union[bytes, List[bytes]], vision_model: str = "llava", embed_model: str = "nomic-embed-text", prompt: str = "Describe this image in detail.") -> List[List[float]]:
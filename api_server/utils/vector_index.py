@@ -0,0 +1,367 @@
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import psycopg2
+import psycopg2.extensions
+
+from utils.db_pool import get_pooled_connection
+
+# ==============================================================================
+#  APPROXIMATE NEAREST-NEIGHBOUR INDEXES (pgvector HNSW)
+# ==============================================================================
+# VECTOR(2048) is over pgvector's 2000-dimension HNSW limit, so db.ts adds a
+# generated `embedding_half HALFVEC(2048)` copy (pgvector >= 0.7) to
+# document_embeddings and document_page_embeddings; Postgres keeps it in sync on
+# every INSERT/COPY. This module
+#   - builds the HNSW indexes on that column (CONCURRENTLY, one builder per
+#     cluster) and rebuilds them when VECTOR_INDEX_M / _EF_CONSTRUCTION change;
+#   - writes the search SQL: candidates are ordered by the indexable halfvec
+#     distance with LIMIT k, then the exact float32 distance is reported and the
+#     threshold applied to it;
+#   - sets hnsw.ef_search and iterative scans (pgvector >= 0.8) per query with
+#     SET LOCAL, so the chat / user filters cannot starve the LIMIT.
+# The chat / user filters are applied after the index scan, so without iterative
+# scans (pgvector 0.7, or VECTOR_INDEX_ITERATIVE_SCAN=off) a chat whose rows are
+# not among the first ef_search global candidates would get no rows: the exact
+# sequential-scan SQL is used then, as it is without halfvec support.
+#
+# The page table also has a generated `embedding_bit BIT(2048)` (binary_quantize,
+# 1 bit per dimension) with a partial Hamming HNSW index over the global
+# knowledge base rows only (chat_history_id = -1). The two-stage search of the
+# knowledge base takes VECTOR_BINARY_CANDIDATES candidates from it and re-ranks
+# them by exact distance. This is an extra index next to the halfvec one, which
+# still serves the per-chat / per-user page searches: it adds storage rather
+# than replacing any, in exchange for a small, fast first stage.
+# Kept free of util.py imports so it can be used from any module.
+
+VECTOR_INDEX_ENABLED = os.getenv("VECTOR_INDEX_ENABLED", "true").lower() == "true"
+VECTOR_INDEX_BUILD_AT_STARTUP = os.getenv("VECTOR_INDEX_BUILD_AT_STARTUP", "true").lower() == "true"
+VECTOR_INDEX_M = int(os.getenv("VECTOR_INDEX_M", "16"))
+VECTOR_INDEX_EF_CONSTRUCTION = int(os.getenv("VECTOR_INDEX_EF_CONSTRUCTION", "64"))
+VECTOR_INDEX_EF_SEARCH = int(os.getenv("VECTOR_INDEX_EF_SEARCH", "100"))
+VECTOR_INDEX_ITERATIVE_SCAN = os.getenv("VECTOR_INDEX_ITERATIVE_SCAN", "strict_order")  # 'off' disables
+VECTOR_INDEX_BUILD_MEMORY = os.getenv("VECTOR_INDEX_BUILD_MEMORY", "")  # maintenance_work_mem for builds, e.g. '2GB'
+VECTOR_BINARY_RERANK_ENABLED = os.getenv("VECTOR_BINARY_RERANK_ENABLED", "true").lower() == "true"
+VECTOR_BINARY_CANDIDATES = int(os.getenv("VECTOR_BINARY_CANDIDATES", "400"))  # first-stage candidates re-ranked exactly
+
+VECTOR_DIMENSIONS = 2048
+HALFVEC_COLUMN = "embedding_half"
+BINARY_COLUMN = "embedding_bit"
+INDEXED_TABLES = ("document_embeddings", "document_page_embeddings")
+# Table -> predicate of its partial bit index; searches must filter on it (on t1)
+BINARY_INDEX_PREDICATES = {"document_page_embeddings": "chat_history_id = -1"}
+BINARY_INDEXED_TABLES = tuple(BINARY_INDEX_PREDICATES)
+
+_CAPABILITY_RECHECK_SEC = 60
+_BUILD_LOCK_KEY = 0x5EC7_1D8  # pg advisory lock: one index builder per cluster
+
+_capabilities: Optional[Dict[str, Any]] = None
+_capabilities_checked_at = 0.0
+_warned_no_iterative_scan = False
+_lock = threading.Lock()
+_stats = {"ann_queries": 0, "binary_rerank_queries": 0, "exact_queries": 0, "builds": [], "build_errors": 0}
+
+
+def hnsw_index_name(table: str) -> str:
+    return f"idx_{table}_hnsw"
+
+
+def binary_index_name(table: str) -> str:
+    return f"idx_{table}_bit_hnsw"
+
+
+def _version_tuple(version: str) -> Tuple[int, ...]:
+    return tuple(int(part) for part in version.split(".") if part.isdigit())
+
+
+def _has_column(cur, column: str, tables: Tuple[str, ...]) -> bool:
+    cur.execute(
+        """
+        SELECT count(DISTINCT table_name) FROM information_schema.columns
+        WHERE column_name = %s AND table_name = ANY(%s)
+        """,
+        (column, list(tables))
+    )
+    return cur.fetchone()[0] == len(tables)
+
+
+def _detect_capabilities(cur) -> Dict[str, Any]:
+    cur.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+    row = cur.fetchone()
+    version = row[0] if row else ""
+    supported = _version_tuple(version) >= (0, 7)
+    return {
+        "pgvector": version or None,
+        "halfvec": supported and _has_column(cur, HALFVEC_COLUMN, INDEXED_TABLES),
+        "binary": supported and _has_column(cur, BINARY_COLUMN, BINARY_INDEXED_TABLES),
+        "iterative_scan": _version_tuple(version) >= (0, 8),
+    }
+
+
+def get_vector_capabilities(conn) -> Dict[str, Any]:
+    """
+    What the database supports, detected once per process (re-checked every
+    minute until the halfvec / bit columns show up). Runs at the start of the
+    caller's transaction and rolls it back.
+    """
+    global _capabilities, _capabilities_checked_at
+    with _lock:
+        if _capabilities is not None and (
+            (_capabilities["halfvec"] and _capabilities["binary"])
+            or time.time() - _capabilities_checked_at < _CAPABILITY_RECHECK_SEC
+        ):
+            return _capabilities
+    try:
+        cur = conn.cursor()
+        capabilities = _detect_capabilities(cur)
+        cur.close()
+    except psycopg2.Error as e:
+        print(f"⚠️ Could not detect pgvector capabilities, using exact search: {e}")
+        capabilities = {"pgvector": None, "halfvec": False, "binary": False, "iterative_scan": False}
+    conn.rollback()
+    with _lock:
+        _capabilities, _capabilities_checked_at = capabilities, time.time()
+    return capabilities
+
+
+def _set_hnsw_search(cur, capabilities: Dict[str, Any], candidates: int):
+    # SET LOCAL: reverted when the connection goes back to the pool (rollback)
+    cur.execute("SELECT set_config('hnsw.ef_search', %s, true)", (str(min(1000, max(VECTOR_INDEX_EF_SEARCH, candidates))),))
+    if capabilities["iterative_scan"] and VECTOR_INDEX_ITERATIVE_SCAN != "off":
+        cur.execute("SELECT set_config('hnsw.iterative_scan', %s, true)", (VECTOR_INDEX_ITERATIVE_SCAN,))
+
+
+def _filtered_ann_available(capabilities: Dict[str, Any]) -> bool:
+    """HNSW on the halfvec copy is only safe for filtered searches with iterative scans."""
+    global _warned_no_iterative_scan
+    if not capabilities["halfvec"]:
+        return False
+    if capabilities["iterative_scan"] and VECTOR_INDEX_ITERATIVE_SCAN != "off":
+        return True
+    if not _warned_no_iterative_scan:
+        _warned_no_iterative_scan = True
+        print(f"⚠️ pgvector {capabilities['pgvector']} without iterative index scans: "
+              "filtered vector searches stay exact (needs pgvector >= 0.8 and VECTOR_INDEX_ITERATIVE_SCAN != 'off').")
+    return False
+
+
+def prepare_nearest_neighbour_query(cur, columns: str, from_where: str, top_k: int, alias: str = "t1") -> str:
+    """
+    SQL of a top-k search within a distance threshold.
+
+    Args:
+        columns: Select list, without the distance.
+        from_where: FROM / JOIN / WHERE part (filters only, no distance condition).
+        top_k: Used to size hnsw.ef_search for this transaction.
+
+    Query parameters, in order: query vector, the from_where parameters,
+    query vector, top_k, threshold. Rows come back as (columns..., distance),
+    ordered by the exact distance.
+    """
+    capabilities = get_vector_capabilities(cur.connection) if VECTOR_INDEX_ENABLED else {"halfvec": False}
+    if _filtered_ann_available(capabilities):
+        order_by = f"{alias}.{HALFVEC_COLUMN} <-> %s::halfvec({VECTOR_DIMENSIONS})"
+        _set_hnsw_search(cur, capabilities, top_k)
+        counter = "ann_queries"
+    else:
+        order_by = f"{alias}.embedding <-> %s"
+        counter = "exact_queries"
+    with _lock:
+        _stats[counter] += 1
+
+    return f"""
+        SELECT * FROM (
+            SELECT
+                {columns},
+                {alias}.embedding <-> %s AS distance
+            {from_where}
+            ORDER BY {order_by}
+            LIMIT %s
+        ) AS nearest
+        WHERE distance <= %s
+        ORDER BY distance
+    """
+
+
+def prepare_binary_rerank_query(cur, columns: str, from_where: str, top_k: int, alias: str = "t1") -> str:
+    """
+    Two-stage variant of prepare_nearest_neighbour_query() for the tables in
+    BINARY_INDEX_PREDICATES: the Hamming distance of the bit-quantized vectors
+    picks max(VECTOR_BINARY_CANDIDATES, top_k) candidates through the partial
+    bit HNSW index, only those get the exact float32 distance, and the best
+    top_k within the threshold are returned. `from_where` must contain the
+    index predicate on `alias` (e.g. t1.chat_history_id = -1) so the planner
+    can use the partial index and all candidates pass the filter. Same
+    parameters and row shape; falls back to prepare_nearest_neighbour_query()
+    when the bit column is not available.
+    """
+    capabilities = get_vector_capabilities(cur.connection) if VECTOR_INDEX_ENABLED else {"binary": False}
+    if not (VECTOR_BINARY_RERANK_ENABLED and capabilities["binary"]):
+        return prepare_nearest_neighbour_query(cur, columns, from_where, top_k, alias)
+
+    candidates = max(VECTOR_BINARY_CANDIDATES, top_k)
+    _set_hnsw_search(cur, capabilities, candidates)
+    with _lock:
+        _stats["binary_rerank_queries"] += 1
+
+    return f"""
+        SELECT * FROM (
+            SELECT * FROM (
+                SELECT
+                    {columns},
+                    {alias}.embedding <-> %s AS distance
+                {from_where}
+                ORDER BY {alias}.{BINARY_COLUMN} <~> binary_quantize(%s::vector)::bit({VECTOR_DIMENSIONS})
+                LIMIT {int(candidates)}
+            ) AS candidates
+            ORDER BY distance
+            LIMIT %s
+        ) AS nearest
+        WHERE distance <= %s
+        ORDER BY distance
+    """
+
+
+def _index_specs(capabilities: Dict[str, Any]) -> List[Tuple[str, str, str, str, Optional[str]]]:
+    """(table, index name, column, operator class, partial index predicate) of every index to maintain."""
+    specs = []
+    if capabilities["halfvec"] and capabilities["iterative_scan"] and VECTOR_INDEX_ITERATIVE_SCAN != "off":
+        specs += [(table, hnsw_index_name(table), HALFVEC_COLUMN, "halfvec_l2_ops", None) for table in INDEXED_TABLES]
+    if capabilities["binary"] and VECTOR_BINARY_RERANK_ENABLED:
+        specs += [
+            (table, binary_index_name(table), BINARY_COLUMN, "bit_hamming_ops", predicate)
+            for table, predicate in BINARY_INDEX_PREDICATES.items()
+        ]
+    return specs
+
+
+def _index_definition(cur, name: str) -> Optional[Tuple[str, bool]]:
+    cur.execute(
+        """
+        SELECT pg_get_indexdef(i.indexrelid), i.indisvalid
+        FROM pg_index AS i
+        JOIN pg_class AS c ON c.oid = i.indexrelid
+        WHERE c.relname = %s
+        """,
+        (name,)
+    )
+    return cur.fetchone()
+
+
+def _build_index(cur, table: str, name: str, column: str, opclass: str, predicate: Optional[str]):
+    cur.execute(
+        f"CREATE INDEX CONCURRENTLY {name} ON {table} "
+        f"USING hnsw ({column} {opclass}) "
+        f"WITH (m = {int(VECTOR_INDEX_M)}, ef_construction = {int(VECTOR_INDEX_EF_CONSTRUCTION)})"
+        + (f" WHERE {predicate}" if predicate else "")
+    )
+
+
+def ensure_vector_indexes() -> Dict[str, str]:
+    """
+    Creates the missing HNSW indexes and rebuilds the ones that are invalid
+    (interrupted concurrent build) or were built with other m / ef_construction
+    (or another partial-index predicate).
+    A changed index is built under a temporary name and swapped in, so searches
+    keep an index while it builds.
+
+    Returns:
+        {index name: 'created' | 'rebuilt' | 'ok' | 'error'}
+    """
+    result: Dict[str, str] = {}
+    if not VECTOR_INDEX_ENABLED:
+        return result
+
+    conn = None
+    try:
+        conn = get_pooled_connection()
+        specs = _index_specs(get_vector_capabilities(conn))
+        if not specs:
+            print("ℹ️ pgvector halfvec / bit columns not available, vector searches stay exact.")
+            return result
+
+        conn.autocommit = True  # CREATE INDEX CONCURRENTLY cannot run in a transaction
+        cur = conn.cursor()
+        cur.execute("SELECT pg_try_advisory_lock(%s)", (_BUILD_LOCK_KEY,))
+        if not cur.fetchone()[0]:
+            print("ℹ️ Vector indexes are being built by another process.")
+            return result
+        try:
+            cur.execute("SET statement_timeout = 0")
+            if VECTOR_INDEX_BUILD_MEMORY:
+                cur.execute("SELECT set_config('maintenance_work_mem', %s, false)", (VECTOR_INDEX_BUILD_MEMORY,))
+            params = (f"m='{int(VECTOR_INDEX_M)}'", f"ef_construction='{int(VECTOR_INDEX_EF_CONSTRUCTION)}'")
+
+            for table, name, column, opclass, predicate in specs:
+                start = time.time()
+                try:
+                    existing = _index_definition(cur, name)
+                    if (existing and existing[1] and all(p in existing[0] for p in params)
+                            and (" WHERE " in existing[0]) == bool(predicate)):
+                        result[name] = "ok"
+                        continue
+                    if existing and not existing[1]:
+                        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                        existing = None
+
+                    if existing is None:
+                        print(f"🏗️ Building HNSW index {name} (m={VECTOR_INDEX_M}, ef_construction={VECTOR_INDEX_EF_CONSTRUCTION})...")
+                        _build_index(cur, table, name, column, opclass, predicate)
+                        result[name] = "created"
+                    else:
+                        print(f"🏗️ Rebuilding HNSW index {name} with m={VECTOR_INDEX_M}, ef_construction={VECTOR_INDEX_EF_CONSTRUCTION}...")
+                        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}_new")
+                        _build_index(cur, table, f"{name}_new", column, opclass, predicate)
+                        cur.execute("BEGIN")
+                        cur.execute(f"DROP INDEX {name}")
+                        cur.execute(f"ALTER INDEX {name}_new RENAME TO {name}")
+                        cur.execute("COMMIT")
+                        result[name] = "rebuilt"
+                    with _lock:
+                        _stats["builds"].append({"index": name, "result": result[name], "sec": round(time.time() - start, 2)})
+                    print(f"✅ HNSW index {name} {result[name]} in {time.time() - start:.1f}s")
+                except psycopg2.Error as e:
+                    if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                        cur.execute("ROLLBACK")
+                    result[name] = "error"
+                    with _lock:
+                        _stats["build_errors"] += 1
+                    print(f"❌ Failed to build HNSW index {name} on {table}: {e}")
+        finally:
+            cur.execute("RESET statement_timeout")
+            cur.execute("RESET maintenance_work_mem")
+            cur.execute("SELECT pg_advisory_unlock(%s)", (_BUILD_LOCK_KEY,))
+            cur.close()
+        return result
+    except Exception as e:
+        print(f"❌ Vector index maintenance failed: {e}")
+        return result
+    finally:
+        if conn:
+            conn.close()
+
+
+def start_vector_index_build() -> threading.Thread:
+    """ensure_vector_indexes() in a daemon thread; builds on large tables take a while."""
+    thread = threading.Thread(target=ensure_vector_indexes, name="vector-index-build", daemon=True)
+    thread.start()
+    return thread
+
+
+def get_vector_index_stats() -> Dict[str, Any]:
+    with _lock:
+        stats = dict(_stats)
+        stats["builds"] = list(_stats["builds"])
+        stats["capabilities"] = dict(_capabilities) if _capabilities else None
+    stats.update({
+        "enabled": VECTOR_INDEX_ENABLED,
+        "m": VECTOR_INDEX_M,
+        "ef_construction": VECTOR_INDEX_EF_CONSTRUCTION,
+        "ef_search": VECTOR_INDEX_EF_SEARCH,
+        "iterative_scan": VECTOR_INDEX_ITERATIVE_SCAN,
+        "binary_rerank": VECTOR_BINARY_RERANK_ENABLED,
+        "binary_candidates": VECTOR_BINARY_CANDIDATES,
+    })
+    return stats
@@ -0,0 +1,125 @@
+import base64
+import io
+import struct
+from typing import Any, Iterable, Sequence
+
+import numpy as np
+import psycopg2
+import psycopg2.extensions
+
+try:
+    from pgvector.psycopg2 import register_vector as _register_pgvector
+except ImportError:  # pgvector is optional, see _Float32VectorAdapter
+    _register_pgvector = None
+
+# ==============================================================================
+#  FLOAT32 VECTOR PATH (model -> Postgres)
+# ==============================================================================
+# Embeddings stay contiguous float32 numpy arrays from the model to the database:
+#   - query parameters: numpy arrays are adapted by pgvector's psycopg2 adapter,
+#     registered on every pooled connection (see db_pool.py);
+#   - bulk inserts: rows are streamed with COPY ... (FORMAT BINARY), vectors in
+#     pgvector's binary wire format, so no per-float text formatting or parsing.
+# Kept free of util.py imports so it can be used from any module.
+
+_PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+_PGCOPY_TRAILER = struct.pack(">h", -1)
+
+
+def to_float32(embedding: Any) -> np.ndarray:
+    """A contiguous float32 copy (or view) of a vector: list, tuple, numpy or torch-on-cpu array."""
+    return np.ascontiguousarray(embedding, dtype=np.float32)
+
+
+def fit_dimensions(embedding: Any, target_dimensions: int) -> np.ndarray:
+    """Zero-pads or truncates a vector to target_dimensions, as float32."""
+    vector = to_float32(embedding)
+    current_dim = vector.shape[0]
+    if current_dim < target_dimensions:
+        return np.concatenate([vector, np.zeros(target_dimensions - current_dim, dtype=np.float32)])
+    if current_dim > target_dimensions:
+        return np.ascontiguousarray(vector[:target_dimensions])
+    return vector
+
+
+class _Float32VectorAdapter:
+    """Fallback psycopg2 adapter for numpy vectors when the pgvector package is not installed."""
+
+    def __init__(self, value: np.ndarray):
+        self._value = value
+
+    def getquoted(self) -> bytes:
+        return ("'[" + ",".join(map(repr, self._value.ravel().tolist())) + "]'").encode()
+
+
+def register_vector_adapters(conn) -> bool:
+    """
+    Lets numpy arrays be passed directly as vector query parameters on `conn`.
+
+    Returns:
+        True when pgvector's adapter is used, False for the built-in fallback.
+    """
+    if _register_pgvector is not None:
+        try:
+            _register_pgvector(conn)
+            conn.rollback()  # register_vector looks up the type OIDs in a transaction
+            return True
+        except psycopg2.Error as e:
+            conn.rollback()
+            print(f"⚠️ pgvector adapter registration failed, using text fallback: {e}")
+    psycopg2.extensions.register_adapter(np.ndarray, _Float32VectorAdapter)
+    return False
+
+
+def _encode_copy_field(value: Any) -> bytes:
+    if value is None:
+        return struct.pack(">i", -1)
+    if isinstance(value, np.ndarray):
+        # pgvector binary format: int16 dim, int16 unused, dim x float4 (big-endian)
+        dim = value.shape[0]
+        return struct.pack(">ihh", 4 + 4 * dim, dim, 0) + value.astype(">f4", copy=False).tobytes()
+    if isinstance(value, (bool, np.bool_)):
+        return struct.pack(">ib", 1, int(value))
+    if isinstance(value, (int, np.integer)):
+        return struct.pack(">ii", 4, int(value))  # INTEGER (int4) columns
+    if isinstance(value, str):
+        data = value.encode("utf-8")
+        return struct.pack(">i", len(data)) + data
+    raise TypeError(f"Unsupported COPY value type: {type(value).__name__}")
+
+
+def copy_rows_binary(cur, table: str, columns: Sequence[str], rows: Iterable[Sequence[Any]]) -> int:
+    """
+    Inserts rows with a single COPY ... FROM STDIN (FORMAT BINARY).
+
+    Supported values: None, int (INTEGER columns), str (TEXT), bool and float32
+    numpy arrays (VECTOR columns). Other column types need their own encoder.
+
+    Returns:
+        Number of rows sent.
+    """
+    buffer = io.BytesIO()
+    buffer.write(_PGCOPY_HEADER)
+    field_count = struct.pack(">h", len(columns))
+    count = 0
+    for row in rows:
+        buffer.write(field_count)
+        for value in row:
+            buffer.write(_encode_copy_field(value))
+        count += 1
+    buffer.write(_PGCOPY_TRAILER)
+    if not count:
+        return 0
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT BINARY)", buffer)
+    return count
+
+
+def encode_vector_base64(embedding: Any) -> str:
+    """Base64 of the vector as little-endian float32, 4 bytes per dimension."""
+    return base64.b64encode(to_float32(embedding).astype("<f4", copy=False).tobytes()).decode("ascii")
+
+
+def encode_vector_bytes(embedding: Any) -> bytes:
+    """The vector as raw little-endian float32 bytes."""
+    return to_float32(embedding).astype("<f4", copy=False).tobytes()